@@ -542,7 +542,8 @@ def uninstall(self, project=None, project_id=None):
         if project_id is None:
             project_id = project._id
         # De-index all the artifacts belonging to this tool in one fell swoop
-        index_tasks.solr_del_tool.post(project_id, self.config.options['mount_point'])
+        index_tasks.solr_del_tool.post(project_id, self.config.options['mount_point'],
+                                       self.config._id)
         
         for d in model.Discussion.query.find({
                 'project_id': project_id,
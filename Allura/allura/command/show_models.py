@@ -16,14 +16,17 @@
 #       under the License.
 
 import sys
+import time
+import multiprocessing
 from collections import defaultdict
 from contextlib import contextmanager
 from itertools import groupby
 
 from paste.deploy.converters import asbool
 from pylons import tmpl_context as c, app_globals as g
-from pymongo.errors import DuplicateKeyError, InvalidDocument, OperationFailure
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
+from ming import mim, Index
 from ming.orm import mapper, session, Mapper
 from ming.orm.declarative import MappedClass
 
@@ -82,11 +85,17 @@ class ReindexCommand(base.Command):
         help='Max number of artifacts to index in one Solr update command')
     parser.add_option('--ming-config', dest='ming_config', help='Path (absolute, or relative to '
                       'Allura root) to .ini file defining ming configuration.')
+    parser.add_option('--workers', dest='workers', type=int, default=1,
+                      help='Number of processes to reindex projects in parallel')
+    parser.add_option('--resume', action='store_true', dest='resume',
+                      help='Skip the projects finished by an interrupted reindex with the same options')
+    parser.add_option(
+        '--refs-chunk', dest='refs_chunk', type=int, default=1000,
+        help='Number of artifact references and shortlinks to create at once')
 
     def command(self):
         from allura import model as M
         self.basic_setup()
-        graph = build_model_inheritance_graph()
         if self.options.project:
             q_project = dict(shortname=self.options.project)
         elif self.options.project_regex:
@@ -102,48 +111,140 @@ def command(self):
         if not self.options.solr and not self.options.refs:
             self.options.solr = self.options.refs = True
 
-        for projects in utils.chunked_find(M.Project, q_project):
-            for p in projects:
-                c.project = p
-                base.log.info('Reindex project %s', p.shortname)
-                # Clear index for this project
-                if self.options.solr and not self.options.skip_solr_delete:
-                    g.solr.delete(q='project_id_s:%s' % p._id)
-                if self.options.refs:
-                    M.ArtifactReference.query.remove(
-                        {'artifact_reference.project_id': p._id})
-                    M.Shortlink.query.remove({'project_id': p._id})
-                app_config_ids = [ac._id for ac in p.app_configs]
-                # Traverse the inheritance graph, finding all artifacts that
-                # belong to this project
-                for _, a_cls in dfs(M.Artifact, graph):
-                    base.log.info('  %s', a_cls)
-                    ref_ids = []
-                    # Create artifact references and shortlinks
-                    for a in a_cls.query.find(dict(app_config_id={'$in': app_config_ids})):
-                        if self.options.verbose:
-                            base.log.info('      %s', a.shorthand_id())
-                        if self.options.refs:
-                            try:
-                                M.ArtifactReference.from_artifact(a)
-                                M.Shortlink.from_artifact(a)
-                            except:
-                                base.log.exception(
-                                    'Making ArtifactReference/Shortlink from %s', a)
-                                continue
-                        ref_ids.append(a.index_id())
-                    M.main_orm_session.flush()
-                    M.artifact_orm_session.clear()
-                    try:
-                        self._chunked_add_artifacts(ref_ids)
-                    except CompoundError, err:
-                        base.log.exception(
-                            'Error indexing artifacts:\n%r', err)
-                        base.log.error('%s', err.format_error())
-                    M.main_orm_session.flush()
-                    M.main_orm_session.clear()
+        self.graph = build_model_inheritance_graph()
+        run = self.run_name
+        if self.options.resume:
+            done = M.ReindexCheckpoint.done(run)
+            base.log.info('Resuming reindex %s, %d projects already done', run, len(done))
+        else:
+            M.ReindexCheckpoint.clear(run)
+            done = set()
+
+        self.stats = defaultdict(lambda: [0, 0.0])
+        if self.options.workers > 1:
+            project_ids = [p._id
+                           for projects in utils.chunked_find(M.Project, q_project)
+                           for p in projects if p._id not in done]
+            self._reindex_in_workers(project_ids)
+        else:
+            for projects in utils.chunked_find(M.Project, q_project):
+                for p in projects:
+                    if p._id in done:
+                        continue
+                    self._finished_project(p._id, self._reindex_project(p))
+        for cls_name, (count, seconds) in sorted(self.stats.items()):
+            base.log.info('%s: %d artifacts, %.1f/s', cls_name, count, count / (seconds or 1))
         base.log.info('Reindex %s', 'queued' if self.options.tasks else 'done')
 
+    @property
+    def run_name(self):
+        """Identifies a reindex of the same projects with the same options,
+        for --resume"""
+        return ' '.join('%s=%s' % (k, getattr(self.options, k)) for k in (
+            'project', 'project_regex', 'neighborhood', 'solr', 'refs', 'tasks', 'solr_hosts'))
+
+    def _reindex_in_workers(self, project_ids):
+        from allura import model as M
+        global _worker_command
+        _worker_command = self
+        M.main_orm_session.flush()
+        M.main_orm_session.clear()
+        pool = multiprocessing.Pool(self.options.workers, initializer=_init_reindex_worker)
+        try:
+            for project_id, stats in pool.imap_unordered(_reindex_project_in_worker, project_ids):
+                if stats is not None:
+                    self._finished_project(project_id, stats)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _finished_project(self, project_id, stats):
+        from allura import model as M
+        M.ReindexCheckpoint.add(self.run_name, project_id)
+        for cls_name, (count, seconds) in stats.iteritems():
+            self.stats[cls_name][0] += count
+            self.stats[cls_name][1] += seconds
+
+    def _reindex_project(self, p):
+        """Reindex all the artifacts of project ``p``.
+
+        Returns {artifact class name: (number of artifacts, seconds taken)}.
+        """
+        from allura import model as M
+        stats = {}
+        c.project = p
+        base.log.info('Reindex project %s', p.shortname)
+        # Clear index for this project
+        if self.options.solr and not self.options.skip_solr_delete:
+            g.solr.delete(q='project_id_s:%s' % p._id)
+            # so add_artifacts doesn't skip anything as unchanged
+            M.ArtifactReference.query.update(
+                {'artifact_reference.project_id': p._id},
+                {'$unset': {'index_fingerprint': 1}}, multi=True)
+        if self.options.refs:
+            M.ArtifactReference.query.remove(
+                {'artifact_reference.project_id': p._id})
+            M.Shortlink.query.remove({'project_id': p._id})
+        app_config_ids = [ac._id for ac in p.app_configs]
+        # Traverse the inheritance graph, finding all artifacts that
+        # belong to this project
+        for _, a_cls in dfs(M.Artifact, self.graph):
+            base.log.info('  %s', a_cls)
+            started = time.time()
+            ref_ids = []
+            # Create artifact references and shortlinks
+            artifacts = a_cls.query.find(dict(app_config_id={'$in': app_config_ids}))
+            for chunk in utils.chunked_iter(artifacts, self.options.refs_chunk):
+                chunk = list(chunk)
+                if self.options.verbose:
+                    for a in chunk:
+                        base.log.info('      %s', a.shorthand_id())
+                if self.options.refs:
+                    chunk = self._make_refs(chunk)
+                ref_ids.extend(a.index_id() for a in chunk)
+            M.main_orm_session.flush()
+            M.artifact_orm_session.clear()
+            try:
+                self._chunked_add_artifacts(ref_ids)
+            except CompoundError, err:
+                base.log.exception(
+                    'Error indexing artifacts:\n%r', err)
+                base.log.error('%s', err.format_error())
+            M.main_orm_session.flush()
+            M.main_orm_session.clear()
+            if ref_ids:
+                seconds = time.time() - started
+                stats[a_cls.__name__] = (len(ref_ids), seconds)
+                base.log.info('  %s: %d artifacts, %.1f/s',
+                              a_cls.__name__, len(ref_ids), len(ref_ids) / (seconds or 1))
+        return stats
+
+    def _make_refs(self, artifacts):
+        """Create the ArtifactReferences and Shortlinks of ``artifacts`` in
+        bulk, or one at a time if that fails, to skip just the bad ones.
+
+        Returns the artifacts which have references.
+        """
+        from allura import model as M
+        try:
+            M.ArtifactReference.from_artifacts(artifacts)
+            M.Shortlink.from_artifacts(artifacts)
+            return artifacts
+        except Exception:
+            pass
+        referenced = []
+        for a in artifacts:
+            try:
+                M.ArtifactReference.from_artifact(a)
+                M.Shortlink.from_artifact(a)
+            except:
+                base.log.exception(
+                    'Making ArtifactReference/Shortlink from %s', a)
+                continue
+            referenced.append(a)
+        return referenced
+
     @property
     def add_artifact_kwargs(self):
         if self.options.solr_hosts:
@@ -151,9 +252,6 @@ def add_artifact_kwargs(self):
         return {}
 
     def _chunked_add_artifacts(self, ref_ids):
-        # ref_ids contains solr index ids which can easily be over
-        # 100 bytes. Here we allow for 160 bytes avg, plus
-        # room for other document overhead.
         for chunk in utils.chunked_list(ref_ids, self.options.max_chunk):
             if self.options.tasks:
                 self._post_add_artifacts(chunk)
@@ -165,23 +263,14 @@ def _chunked_add_artifacts(self, ref_ids):
 
     def _post_add_artifacts(self, chunk):
         """
-        Post task, recursively splitting and re-posting if the resulting
-        mongo document is too large.
+        Post task.  Big chunks are stored outside the task document by
+        MonQTask.post, so this is always a single task.
         """
-        try:
-            with self.ming_config(self.options.ming_config):
-                add_artifacts.post(chunk,
-                                   update_solr=self.options.solr,
-                                   update_refs=self.options.refs,
-                                   **self.add_artifact_kwargs)
-        except InvalidDocument as e:
-            # there are many types of InvalidDocument, only recurse if its
-            # expected to help
-            if e.args[0].startswith('BSON document too large'):
-                self._post_add_artifacts(chunk[:len(chunk) // 2])
-                self._post_add_artifacts(chunk[len(chunk) // 2:])
-            else:
-                raise
+        with self.ming_config(self.options.ming_config):
+            add_artifacts.post(chunk,
+                               update_solr=self.options.solr,
+                               update_refs=self.options.refs,
+                               **self.add_artifact_kwargs)
 
     @property
     def ming_config(self):
@@ -199,6 +288,28 @@ def noop_cm(*args):
         return contextmanager(noop_cm)
 
 
+# the ReindexCommand which forked the --workers processes
+_worker_command = None
+
+
+def _init_reindex_worker():
+    from allura import model as M
+    # don't share the parent's session state
+    M.main_orm_session.clear()
+    M.artifact_orm_session.clear()
+    M.project_orm_session.clear()
+
+
+def _reindex_project_in_worker(project_id):
+    from allura import model as M
+    try:
+        project = M.Project.query.get(_id=project_id)
+        return project_id, _worker_command._reindex_project(project)
+    except Exception:
+        base.log.exception('Error reindexing project %s', project_id)
+        return project_id, None
+
+
 class EnsureIndexCommand(base.Command):
     min_args = 1
     max_args = 1
@@ -246,6 +357,13 @@ def command(self):
         base.log.info('Done updating indexes')
 
     def _update_indexes(self, collection, indexes):
+        if isinstance(collection, mim.Collection):
+            # mim ignores partialFilterExpression, and would make a partial
+            # index unique among all the documents
+            indexes = [
+                Index(fields=i.fields, **dict(i.index_options, unique=False))
+                if i.unique and i.index_options.get('partialFilterExpression') else i
+                for i in indexes]
         uindexes = dict(
             # convert list to tuple so it's hashable for 'set'
             (tuple(i.index_spec), i)
@@ -282,18 +400,24 @@ def _update_indexes(self, collection, indexes):
         for iname, keys in unique_flag_drop.iteritems():
             self._recreate_index(collection, iname, list(keys), unique=False)
         for iname, keys in unique_flag_add.iteritems():
-            self._recreate_index(collection, iname, list(keys), unique=True)
+            options = dict(unique=True)
+            # a partial index is only unique among the documents it filters
+            partial = uindexes[keys].index_options.get('partialFilterExpression')
+            if partial:
+                options['partialFilterExpression'] = partial
+            self._recreate_index(collection, iname, list(keys), **options)
 
         # Ensure all indexes
         for keys, idx in uindexes.iteritems():
             base.log.info('...... ensure %s:%s', collection.name, idx)
+            partial = idx.index_options.get('partialFilterExpression')
             while True:
                 try:
                     collection.ensure_index(idx.index_spec, **idx.index_options)
                     break
                 except DuplicateKeyError, err:
                     base.log.info('Found dupe key(%s), eliminating dupes', err)
-                    self._remove_dupes(collection, idx.index_spec)
+                    self._remove_dupes(collection, idx.index_spec, partial)
         for keys, idx in indexes.iteritems():
             base.log.info('...... ensure %s:%s', collection.name, idx)
             collection.ensure_index(idx.index_spec, background=True, **idx.index_options)
@@ -331,10 +455,10 @@ def _recreate_index(self, collection, iname, keys, **creation_options):
                       collection.name, superset_index)
         collection.drop_index(superset_index)
 
-    def _remove_dupes(self, collection, spec):
+    def _remove_dupes(self, collection, spec, query=None):
         iname = collection.create_index(spec)
         fields = [f[0] for f in spec]
-        q = collection.find({}, fields=fields).sort(spec)
+        q = collection.find(query or {}, fields=fields).sort(spec)
 
         def keyfunc(doc):
             return tuple(doc.get(f, None) for f in fields)
@@ -15,9 +15,13 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import errno
 import logging
+import multiprocessing
 import os
+import resource
 import time
+import threading
 import Queue
 from contextlib import contextmanager
 from datetime import datetime, timedelta
@@ -28,6 +32,7 @@
 import pylons
 from setproctitle import setproctitle, getproctitle
 import tg
+from ming.orm import ThreadLocalORMSession
 from paste.deploy import loadapp
 from paste.deploy.converters import asint
 from webob import Request
@@ -54,6 +59,20 @@ def proctitle(title):
         raise
 
 
+def rss_mb():
+    '''Resident memory of this process in MB'''
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / (1024 * 1024)
+    except (IOError, IndexError, ValueError):
+        # no /proc, settle for the peak (reported in KB on Linux, bytes on OS X)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            maxrss /= 1024
+        return maxrss / 1024
+
+
 class TaskdCommand(base.Command):
     summary = 'Task server'
     parser = base.Command.standard_parser(verbose=True)
@@ -61,12 +80,39 @@ class TaskdCommand(base.Command):
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
                       help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
+    parser.add_option('--processes', dest='processes', type='int', default=1,
+                      help='number of worker processes to fork.  The task app is loaded once in a master process '
+                      'which then supervises the workers, restarting any that die.  Default is 1 (no master process)')
+    parser.add_option('--threads', dest='threads', type='int', default=1,
+                      help='number of worker threads to run in each worker process (1 by default)')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=1,
+                      help='claim up to this many ready tasks of the same priority at once, and run them in order.  '
+                      'Saves round trips to mongo on a busy queue (1 by default)')
+    parser.add_option('--max-tasks-per-worker', dest='max_tasks', type='int', default=0,
+                      help='restart a worker process after it has run this many tasks, to release memory '
+                      '(0, the default, for no limit)')
+    parser.add_option('--max-rss-mb', dest='max_rss_mb', type='int', default=0,
+                      help='restart a worker process after a task leaves it using more than this many MB of '
+                      'memory (0, the default, for no limit)')
 
     def command(self):
+        from allura import model as M
         setproctitle('taskd')
         self.basic_setup()
         self.keep_running = True
         self.restart_when_done = False
+        self.tasks = {}
+        # tasks claimed by --batch-size but not started yet, per thread
+        self.claimed = {}
+        self.workers = {}
+        self.supervised = False
+        self.tasks_run = 0
+        self.tasks_run_lock = threading.Lock()
+        self.lanes = M.MonQLanes.from_config()
+        self.worker_lanes = self.lanes.assign(
+            self.options.processes * self.options.threads)
+        # tasks running in each lane, shared by all the pool's workers
+        self.lane_busy = multiprocessing.Array('i', len(self.lanes.names))
         base.log.info('Starting taskd, pid %s' % os.getpid())
         signal.signal(signal.SIGHUP, self.graceful_restart)
         signal.signal(signal.SIGTERM, self.graceful_stop)
@@ -77,7 +123,10 @@ def command(self):
         signal.siginterrupt(signal.SIGHUP, False)
         signal.siginterrupt(signal.SIGTERM, False)
         signal.siginterrupt(signal.SIGUSR1, False)
-        self.worker()
+        if self.options.processes > 1:
+            self.master()
+        else:
+            self.worker()
 
     def graceful_restart(self, signum, frame):
         base.log.info(
@@ -85,24 +134,155 @@ def graceful_restart(self, signum, frame):
             (os.getpid(), signum))
         self.keep_running = False
         self.restart_when_done = True
+        self.signal_workers(signal.SIGTERM)
 
     def graceful_stop(self, signum, frame):
         base.log.info(
             'taskd pid %s recieved signal %s preparing to do a graceful stop' %
             (os.getpid(), signum))
         self.keep_running = False
+        self.signal_workers(signal.SIGTERM)
 
     def log_current_task(self, signum, frame):
-        entry = 'taskd pid %s is currently handling task %s' % (
-            os.getpid(), getattr(self, 'task', None))
+        tasks = [t for t in self.tasks.values() if t is not None]
+        # claimed tasks are busy under this process too, so taskd_cleanup
+        # must see them as handled rather than forsaken
+        for claimed in self.claimed.values():
+            tasks.extend(list(claimed))
+        tasks = tasks or [None]
+        entry = '; '.join(
+            'taskd pid %s is currently handling task %s' % (os.getpid(), t)
+            for t in tasks)
         status_log.info(entry)
         base.log.info(entry)
 
-    def worker(self):
-        from allura import model as M
+    def signal_workers(self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                # already gone, master() will reap it
+                pass
+
+    def load_task_app(self):
+        return loadapp('config:%s#task' %
+                       self.args[0], relative_to=os.getcwd())
+
+    def master(self):
+        """Load the task app once, then fork and supervise worker processes.
+
+        Workers share the loaded app with the master copy-on-write.  Any
+        worker that exits while taskd is still running is replaced.  On
+        SIGHUP or SIGTERM, workers are told to stop after their current task;
+        once they have all exited the master stops too (restarting itself for
+        SIGHUP, so that new code is picked up).
+        """
+        setproctitle('taskd master')
+        wsgi_app = self.load_task_app()
+        # don't carry the master's identity maps into the workers
+        ThreadLocalORMSession.close_all()
+        for slot in range(self.options.processes):
+            if self.keep_running:
+                self.spawn_worker(wsgi_app, slot)
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            if not pid:
+                time.sleep(1)
+                continue
+            slot = self.workers.pop(pid, None)
+            if not self.keep_running:
+                base.log.info('taskd worker pid %s stopped' % pid)
+                continue
+            if status == 0:
+                # recycled by --max-tasks-per-worker or --max-rss-mb
+                base.log.info('taskd worker pid %s finished, replacing it' % pid)
+                self.spawn_worker(wsgi_app, slot)
+                continue
+            base.log.warn('taskd worker pid %s exited with status %s, replacing it' %
+                          (pid, status))
+            # a worker that dies mid-task can't give back its lane slot
+            self.reset_lane_counts()
+            # don't spin if workers are dying as soon as they start
+            time.sleep(1)
+            self.spawn_worker(wsgi_app, slot)
+        base.log.info('taskd master pid %s stopping gracefully.' % os.getpid())
+
+        if self.restart_when_done:
+            base.log.info('taskd master pid %s restarting itself' % os.getpid())
+            os.execv(sys.argv[0], sys.argv)
+
+    def spawn_worker(self, wsgi_app, slot):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = slot
+            base.log.info('taskd master pid %s started worker pid %s' %
+                          (os.getpid(), pid))
+            return pid
+        # in the worker process from here on
+        exit_code = 0
+        try:
+            setproctitle('taskd')
+            self.workers = {}
+            self.supervised = True
+            # the master handles restarts, so a worker just stops on SIGHUP
+            signal.signal(signal.SIGHUP, self.graceful_stop)
+            # pymongo notices the pid change and opens new sockets, but
+            # anything already loaded in the ORM session belongs to the master
+            ThreadLocalORMSession.close_all()
+            self.worker(wsgi_app, slot)
+        except BaseException:
+            base.log.exception('taskd worker pid %s died' % os.getpid())
+            exit_code = 1
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
+
+    def worker(self, wsgi_app=None, slot=0):
+        if wsgi_app is None:
+            wsgi_app = self.load_task_app()
         name = '%s pid %s' % (os.uname()[1], os.getpid())
-        wsgi_app = loadapp('config:%s#task' %
-                           self.args[0], relative_to=os.getcwd())
+        # the pool's workers are numbered process by process, thread by thread
+        first = slot * self.options.threads
+        if self.options.threads > 1:
+            # fork the markdown render workers while there is only one thread,
+            # see MarkdownWatchdog
+            app_globals = pylons.config['pylons.app_globals']
+            if app_globals.markdown_render_watchdog is not None:
+                app_globals.markdown_render_watchdog.start(app_globals)
+            threads = [threading.Thread(target=self.worker_loop,
+                                        args=(name, wsgi_app, first + i),
+                                        name='taskd-thread-%s' % i)
+                       for i in range(self.options.threads)]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            # join with a timeout so that signals are still handled
+            # by the main thread
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(1)
+        else:
+            self.worker_loop(name, wsgi_app, first)
+        base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
+
+        if self.restart_when_done:
+            base.log.info('taskd pid %s restarting itself' % os.getpid())
+            os.execv(sys.argv[0], sys.argv)
+
+    def worker_loop(self, name, wsgi_app, worker_num):
+        from allura import model as M
+        thread_name = threading.current_thread().name
+        dedicated_lane = self.worker_lanes[worker_num]
+        if dedicated_lane:
+            base.log.info('taskd pid %s %s only runs tasks in lane %s' %
+                          (os.getpid(), thread_name, dedicated_lane))
         poll_interval = asint(pylons.config.get('monq.poll_interval', 10))
         only = self.options.only
         if only:
@@ -114,8 +294,18 @@ def start_response(status, headers, exc_info=None):
                     'Unexpected http response from taskd request: %s.  Headers: %s',
                     status, headers)
 
-        def waitfunc_noq():
-            time.sleep(poll_interval)
+        if M.MonQSignal.enabled():
+            wakeup = M.MonQSignal()
+
+            def waitfunc_noq():
+                # wait in short steps so a graceful stop isn't held up
+                deadline = time.time() + poll_interval
+                while self.keep_running and time.time() < deadline:
+                    if wakeup.wait(min(1, deadline - time.time()), only=only):
+                        return
+        else:
+            def waitfunc_noq():
+                time.sleep(poll_interval)
 
         def check_running(func):
             def waitfunc_checks_running():
@@ -130,24 +320,40 @@ def waitfunc_checks_running():
         while self.keep_running:
             try:
                 while self.keep_running:
-                    self.task = M.MonQTask.get(
-                        process=name,
-                        waitfunc=waitfunc,
-                        only=only)
-                    if self.task:
-                        with(proctitle("taskd:{0}:{1}".format(
-                                self.task.task_name, self.task._id))):
-                            # Build the (fake) request
-                            request_path = '/--%s--/%s/' % (self.task.task_name,
-                                                            self.task._id)
-                            r = Request.blank(request_path,
-                                              base_url=tg.config['base_url'].rstrip(
-                                                  '/') + request_path,
-                                              environ={'task': self.task,
-                                                       'nocapture': self.options.nocapture,
-                                                       })
-                            list(wsgi_app(r.environ, start_response))
-                            self.task = None
+                    lanes = lambda: self.open_lanes(dedicated_lane)
+                    if self.options.batch_size > 1:
+                        tasks = M.MonQTask.get_many(
+                            self.options.batch_size,
+                            process=name,
+                            waitfunc=waitfunc,
+                            only=only,
+                            lanes=lanes)
+                    else:
+                        task = M.MonQTask.get(
+                            process=name,
+                            waitfunc=waitfunc,
+                            only=only,
+                            lanes=lanes)
+                        tasks = [task] if task else []
+                    self.claimed[thread_name] = tasks
+                    try:
+                        while tasks and self.keep_running:
+                            lane = tasks[0].lane or self.lanes.default
+                            if not self.enter_lane(lane, dedicated_lane):
+                                # lane filled up since we claimed the task
+                                break
+                            try:
+                                task = self.tasks[thread_name] = tasks.pop(0)
+                                self.run_task(task, wsgi_app, start_response)
+                                self.tasks[thread_name] = None
+                            finally:
+                                self.leave_lane(lane)
+                            self.check_recycle()
+                    finally:
+                        self.claimed.pop(thread_name, None)
+                        if tasks:
+                            # stopping, or something went wrong mid-batch
+                            M.MonQTask.release(tasks, process=name)
             except Exception as e:
                 if self.keep_running:
                     base.log.exception(
@@ -155,11 +361,88 @@ def waitfunc_checks_running():
                     time.sleep(10)
                 else:
                     base.log.exception('taskd error %s' % e)
-        base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
-        if self.restart_when_done:
-            base.log.info('taskd pid %s restarting itself' % os.getpid())
-            os.execv(sys.argv[0], sys.argv)
+    def check_recycle(self):
+        '''Count a finished task, and stop this worker process once it has hit
+        --max-tasks-per-worker or --max-rss-mb.  A worker forked by the master
+        just exits and the master starts a fresh one; a lone taskd process
+        restarts itself.'''
+        with self.tasks_run_lock:
+            self.tasks_run += 1
+            tasks_run = self.tasks_run
+        reason = None
+        if self.options.max_tasks and tasks_run >= self.options.max_tasks:
+            reason = 'has run %s tasks' % tasks_run
+        elif self.options.max_rss_mb:
+            rss = rss_mb()
+            if rss > self.options.max_rss_mb:
+                reason = 'is using %sMB of memory' % rss
+        if reason and self.keep_running:
+            base.log.info('taskd pid %s %s, recycling it' % (os.getpid(), reason))
+            self.keep_running = False
+            if not self.supervised:
+                self.restart_when_done = True
+
+    def open_lanes(self, dedicated_lane=None):
+        '''Lanes a worker may take a task from right now, or None for any'''
+        if dedicated_lane:
+            return [dedicated_lane]
+        lanes = [name for i, name in enumerate(self.lanes.names)
+                 if self.lanes.max_workers[name] is None or
+                 self.lane_busy[i] < self.lanes.max_workers[name]]
+        if len(lanes) == len(self.lanes.names):
+            return None
+        return lanes
+
+    def enter_lane(self, lane, dedicated_lane=None):
+        '''Count a task starting in a lane, unless the lane is already full
+        (workers dedicated to the lane always get in)'''
+        if lane not in self.lanes.names:
+            # posted under some other lane configuration
+            lane = self.lanes.default
+        i = self.lanes.names.index(lane)
+        limit = self.lanes.max_workers[lane]
+        with self.lane_busy.get_lock():
+            if lane != dedicated_lane and limit is not None and self.lane_busy[i] >= limit:
+                return False
+            self.lane_busy[i] += 1
+        return True
+
+    def leave_lane(self, lane):
+        if lane not in self.lanes.names:
+            lane = self.lanes.default
+        i = self.lanes.names.index(lane)
+        with self.lane_busy.get_lock():
+            self.lane_busy[i] = max(0, self.lane_busy[i] - 1)
+
+    def reset_lane_counts(self):
+        # count from the tasks still running in the pool, rather than guess
+        # what a dead worker was doing.  Tasks claimed by --batch-size but not
+        # started yet don't hold a lane.
+        from allura import model as M
+        names = ['%s pid %s' % (os.uname()[1], pid) for pid in self.workers]
+        busy = M.MonQTask.query.find(
+            {'state': 'busy', 'process': {'$in': names},
+             'time_start': {'$ne': None}}).all()
+        ThreadLocalORMSession.close_all()
+        with self.lane_busy.get_lock():
+            for i, name in enumerate(self.lanes.names):
+                self.lane_busy[i] = sum(
+                    1 for t in busy if (t.lane or self.lanes.default) == name)
+
+    def run_task(self, task, wsgi_app, start_response):
+        with(proctitle("taskd:{0}:{1}".format(
+                task.task_name, task._id))):
+            # Build the (fake) request
+            request_path = '/--%s--/%s/' % (task.task_name,
+                                            task._id)
+            r = Request.blank(request_path,
+                              base_url=tg.config['base_url'].rstrip(
+                                  '/') + request_path,
+                              environ={'task': task,
+                                       'nocapture': self.options.nocapture,
+                                       })
+            list(wsgi_app(r.environ, start_response))
 
 
 class TaskCommand(base.Command):
@@ -169,9 +452,11 @@ class TaskCommand(base.Command):
                       help='state of processes to examine')
     parser.add_option('-t', '--timeout', dest='timeout', type=int, default=60,
                       help='timeout (in seconds) for busy tasks')
+    parser.add_option('-m', '--minutes', dest='minutes', type=int, default=10,
+                      help='window (in minutes) of finished tasks to include in metrics')
     min_args = 2
     max_args = None
-    usage = '<ini file> [list|retry|purge|timeout|commit]'
+    usage = '<ini file> [list|retry|purge|timeout|commit|metrics]'
 
     def command(self):
         self.basic_setup()
@@ -181,7 +466,8 @@ def command(self):
             retry=self._retry,
             purge=self._purge,
             timeout=self._timeout,
-            commit=self._commit)
+            commit=self._commit,
+            metrics=self._metrics)
         tab[cmd]()
 
     def _list(self):
@@ -208,8 +494,7 @@ def _purge(self):
         '''Purge completed tasks'''
         from allura import model as M
         base.log.info('Purge complete/forget tasks')
-        M.MonQTask.query.remove(
-            dict(state='complete', result_type='forget'))
+        M.MonQTask.purge(dict(state='complete', result_type='forget'))
 
     def _timeout(self):
         '''Reset tasks that have been busy too long to 'ready' state'''
@@ -224,3 +509,9 @@ def _commit(self):
         from allura.tasks import index_tasks
         base.log.info('Commit to solr')
         index_tasks.commit.post()
+
+    def _metrics(self):
+        '''Print queue and task timing metrics'''
+        from allura import model as M
+        since = datetime.utcnow() - timedelta(minutes=self.options.minutes)
+        sys.stdout.write(M.MonQMetrics.collect(since).render())
@@ -20,6 +20,9 @@
 import signal
 import socket
 import subprocess
+from datetime import datetime, timedelta
+
+from paste.deploy.converters import asint
 from ming.orm.ormsession import ThreadLocalORMSession
 
 from allura import model as M
@@ -36,7 +39,11 @@ class TaskdCleanupCommand(base.Command):
     parser.add_option('-n', '--num-retry-status-check',
                       dest='num_retry', type='int', default=5,
                       help='number of retries to read taskd status log after sending USR1 signal (5 by default)')
-    usage = '<ini file> [-k] <taskd status log file>'
+    parser.add_option('-a', '--archive-after-days',
+                      dest='archive_days', type='int', default=None,
+                      help='archive finished tasks older than this many days (monq.archive_after_days '
+                      'by default, 0 to disable)')
+    usage = '<ini file> [-k] [-a days] <taskd status log file>'
     min_args = 2
     max_args = 2
 
@@ -104,6 +111,8 @@ def command(self):
         base.log.info('Checking suspicious list for incomplete tasks')
         self._check_suspicious_tasks()
         ThreadLocalORMSession.flush_all()
+
+        self.archived = self._archive_tasks()
         self.print_summary()
 
     def print_summary(self):
@@ -117,6 +126,18 @@ def print_summary(self):
                     '...to kill these processes run command with -k flag if you are sure they are really stuck')
         if self.error_tasks:
             base.log.info('Tasks marked as \'error\': %s' % self.error_tasks)
+        if self.archived:
+            base.log.info('Archived %s finished tasks' % self.archived)
+
+    def _archive_tasks(self):
+        days = self.options.archive_days
+        if days is None:
+            days = asint(self.config.get('monq.archive_after_days', 7))
+        if days <= 0:
+            return 0
+        older_than = datetime.utcnow() - timedelta(days=days)
+        base.log.info('Archiving finished tasks older than %s' % older_than)
+        return M.MonQTask.archive(older_than)
 
     def _busy_tasks(self, pid=None):
         regex = '^%s ' % self.hostname
@@ -122,6 +122,13 @@ def _make_core_app(root, global_conf, full_stack=True, **app_conf):
     # Configure the Pylons environment
     load_environment(global_conf, app_conf)
 
+    # Fork the markdown render workers before the server starts any threads.
+    # taskd forks its worker processes later, and they start their own
+    if config.get('override_root') != 'task':
+        app_globals = config['pylons.app_globals']
+        if app_globals.markdown_render_watchdog is not None:
+            app_globals.markdown_render_watchdog.start(app_globals)
+
     app = tg.TGApp()
 
     for mw_ep in h.iter_entry_points('allura.middleware'):
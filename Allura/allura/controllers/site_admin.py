@@ -613,8 +613,19 @@ def resubmit(self, task_id):
         if task is None:
             raise HTTPNotFound()
         task.state = 'ready'
+        task.retries = 0
         redirect('../view/%s' % task._id)
 
+    @expose(content_type='text/plain')
+    def metrics(self, minutes=10):
+        """Queue and task timing metrics, in the Prometheus text format"""
+        try:
+            minutes = int(minutes)
+        except ValueError:
+            minutes = 10
+        since = datetime.utcnow() - timedelta(minutes=minutes)
+        return M.monq_model.MonQMetrics.collect(since).render()
+
     @expose('json:')
     def task_doc(self, task_name, **kw):
         """Return a task's docstring"""
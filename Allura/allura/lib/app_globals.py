@@ -51,6 +51,7 @@
 from jinja2 import Markup
 
 import allura.tasks.event_tasks
+import allura.tasks.markdown_tasks
 from allura import model as M
 from allura.lib.markdown_extensions import (
     ForgeExtension,
@@ -62,6 +63,7 @@
 from allura.lib import helpers as h
 from allura.lib.widgets import analytics
 from allura.lib.security import Credentials
+from allura.lib.exceptions import MarkdownRenderTimeout
 from allura.lib.solr import MockSOLR, make_solr_from_config
 from allura.model.session import artifact_orm_session
 
@@ -70,15 +72,53 @@
 
 class ForgeMarkdown(markdown.Markdown):
 
+    def __init__(self, *args, **kwargs):
+        # renderings are shared through ``render_cache`` (see
+        # :class:`allura.model.markdown_cache.MarkdownRenderCache`) between
+        # converters of the same ``flavor``, i.e. made with the same options
+        self.render_cache = kwargs.pop('render_cache', None)
+        self.flavor = kwargs.pop('flavor', None)
+        # the forge_markdown() options, for Globals.markdown_flavor() to make
+        # this converter again in a render_watchdog worker or a task
+        self.forge_options = kwargs.pop('forge_options', None)
+        self.render_watchdog = kwargs.pop('render_watchdog', None)
+        markdown.Markdown.__init__(self, *args, **kwargs)
+
+    def plain_text(self, source):
+        escaped = cgi.escape(h.really_unicode(source))
+        return h.html.literal(u'<pre>%s</pre>' % escaped)
+
     def convert(self, source, render_limit=True):
         if render_limit and len(source) > asint(config.get('markdown_render_max_length', 40000)):
             # if text is too big, markdown can take a long time to process it,
             # so we return it as a plain text
             log.info('Text is too big. Skipping markdown processing')
-            escaped = cgi.escape(h.really_unicode(source))
-            return h.html.literal(u'<pre>%s</pre>' % escaped)
+            return self.plain_text(source)
+        cache_key = None
+        if self.render_cache is not None and self.flavor and self.render_cache.cacheable(source):
+            cache_key = self.render_cache.key(source, self.flavor, self.cache_bugfix_rev)
+            html = self.render_cache.get(cache_key, self.flavor)
+            if isinstance(html, M.PlainTextFallback):
+                return html
+            if html is not None:
+                return h.html.literal(html)
         try:
-            return markdown.Markdown.convert(self, source)
+            if (self.render_watchdog is not None and self.flavor and
+                    self.render_watchdog.watches(source)):
+                html = self.render_watchdog.convert(self.flavor, self.forge_options, source)
+            else:
+                html = markdown.Markdown.convert(self, source)
+            if cache_key is not None:
+                self.render_cache.set(cache_key, self.flavor, html)
+            return html
+        except MarkdownRenderTimeout:
+            log.warn('Markdown rendering timed out, showing it as plain text: %s',
+                     source[:200], exc_info=True)
+            if cache_key is not None and self.render_cache.shared_size:
+                # render it in the background, for the next request to find
+                allura.tasks.markdown_tasks.render_markdown.post(
+                    self.flavor, self.forge_options, source)
+            return M.PlainTextFallback(self.plain_text(source))
         except Exception:
             log.info('Invalid markdown: %s  Upwards trace is %s', source,
                      ''.join(traceback.format_stack()), exc_info=True)
@@ -87,6 +127,22 @@ def convert(self, source, render_limit=True):
             return h.html.literal(u"""<p><strong>ERROR!</strong> The markdown supplied could not be parsed correctly.
             Did you forget to surround a code snippet with "~~~~"?</p><pre>%s</pre>""" % escaped)
 
+    # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+    cache_bugfix_rev = 3
+
+    def cached_html(self, cache, source_text, md5=None):
+        """Return the html stored in MarkdownCache ``cache`` if it is a valid
+        rendering of ``source_text``, else None.
+
+        """
+        if not cache or cache.md5 is None:
+            return None
+        if md5 is None:
+            md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
+        if cache.md5 == md5 and getattr(cache, 'fix7528', False) == self.cache_bugfix_rev:
+            return h.html.literal(cache.html)
+        return None
+
     def cached_convert(self, artifact, field_name):
         """Convert ``artifact.field_name`` markdown source to html, caching
         the result if the render time is greater than the defined threshold.
@@ -104,13 +160,14 @@ def cached_convert(self, artifact, field_name):
                 field_name, artifact.__class__.__name__)
             return self.convert(source_text)
 
-        bugfix_rev = 3  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+        bugfix_rev = self.cache_bugfix_rev
         md5 = None
         # If a cached version exists and it is valid, return it.
         if cache.md5 is not None:
             md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
-            if cache.md5 == md5 and getattr(cache, 'fix7528', False) == bugfix_rev:
-                return h.html.literal(cache.html)
+            html = self.cached_html(cache, source_text, md5)
+            if html is not None:
+                return html
 
         # Convert the markdown and time the result.
         start = time.time()
@@ -125,6 +182,9 @@ def cached_convert(self, artifact, field_name):
             log.warn('Skipping Markdown caching - The value for config param '
                      '"markdown_cache_threshold" must be a float.')
 
+        if isinstance(html, M.PlainTextFallback):
+            # the rendering timed out, it's not worth keeping
+            return html
         if threshold is not None and render_time > threshold:
             # Save the cache
             if md5 is None:
@@ -320,6 +380,46 @@ def __missing__(self, key):
 
         self.tmpdir = os.getenv('TMPDIR', '/tmp')
 
+    @LazyProperty
+    def search_cache(self):
+        """Return a :class:`allura.lib.search.SearchResultCache`, or None if
+        search results aren't cached."""
+        from allura.lib.search import SearchResultCache
+        return SearchResultCache.from_config(config)
+
+    @LazyProperty
+    def search_breaker(self):
+        """Return a :class:`allura.lib.utils.CircuitBreaker` for solr
+        searches, or None if ``solr.circuit_breaker.failures`` isn't set."""
+        failures = asint(config.get('solr.circuit_breaker.failures', 0))
+        if not failures:
+            return None
+        return utils.CircuitBreaker(
+            'solr', max_failures=failures,
+            window=float(config.get('solr.circuit_breaker.window', 60)),
+            slow=float(config.get('solr.circuit_breaker.slow', 0)) or None,
+            reset_timeout=float(config.get('solr.circuit_breaker.reset_timeout', 30)))
+
+    @LazyProperty
+    def shortlink_cache(self):
+        """Return a :class:`allura.model.index.ShortlinkCache`, or None if
+        resolved shortlinks aren't cached."""
+        from allura.model.index import ShortlinkCache
+        return ShortlinkCache.from_config(config)
+
+    @LazyProperty
+    def markdown_render_cache(self):
+        """Return a :class:`allura.model.markdown_cache.MarkdownRenderCache`,
+        or None if markdown renderings aren't cached."""
+        return M.MarkdownRenderCache.from_config(config)
+
+    @LazyProperty
+    def markdown_render_watchdog(self):
+        """Return a :class:`allura.lib.markdown_watchdog.MarkdownWatchdog`,
+        or None if markdown is rendered in the calling process."""
+        from allura.lib.markdown_watchdog import MarkdownWatchdog
+        return MarkdownWatchdog.from_config(config)
+
     @LazyProperty
     def spam_checker(self):
         """Return a SpamFilter implementation.
@@ -437,12 +537,17 @@ def highlight(self, text, lexer=None, filename=None):
 
     def forge_markdown(self, **kwargs):
         '''return a markdown.Markdown object on which you can call convert'''
+        flavor = ','.join(['forge'] + ['%s=%s' % kv for kv in sorted(kwargs.items())])
         return ForgeMarkdown(
             # 'fenced_code'
             extensions=['fenced_code', 'codehilite',
                         ForgeExtension(
                             **kwargs), 'tables', 'toc', 'nl2br'],
-            output_format='html4')
+            output_format='html4',
+            flavor=flavor,
+            forge_options=kwargs,
+            render_cache=self.markdown_render_cache,
+            render_watchdog=self.markdown_render_watchdog)
 
     @property
     def markdown(self):
@@ -464,7 +569,17 @@ def markdown_commit(self):
         """
         app = getattr(c, 'app', None)
         return ForgeMarkdown(extensions=[CommitMessageExtension(app), 'nl2br'],
-                             output_format='html4')
+                             output_format='html4',
+                             flavor='commit',
+                             render_cache=self.markdown_render_cache,
+                             render_watchdog=self.markdown_render_watchdog)
+
+    def markdown_flavor(self, flavor, options=None):
+        """Return a converter like the ForgeMarkdown with ``flavor`` and
+        ``forge_options``, for the current project and tool."""
+        if flavor == 'commit':
+            return self.markdown_commit
+        return self.forge_markdown(**h.encode_keys(options or {}))
 
     @property
     def production_mode(self):
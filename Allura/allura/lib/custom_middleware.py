@@ -23,7 +23,7 @@
 import pkg_resources
 from paste import fileapp
 from paste.deploy.converters import aslist
-from pylons import tmpl_context as c
+from pylons import tmpl_context as c, app_globals as g
 from pylons.util import call_wsgi_application
 from timermiddleware import Timer, TimerMiddleware
 from webob import exc, Request
@@ -340,6 +340,19 @@ def timers(self):
     def before_logging(self, stat_record):
         if hasattr(c, "app") and hasattr(c.app, "config"):
             stat_record.add('request_category', c.app.config.tool_name.lower())
+        shortlink_cache = getattr(g, 'shortlink_cache', None)
+        if shortlink_cache is not None:
+            # totals for this process, not just this request
+            stat_record.add('shortlink_cache', dict(
+                hits=shortlink_cache.hits,
+                misses=shortlink_cache.misses,
+                size=len(shortlink_cache)))
+        markdown_render_cache = getattr(g, 'markdown_render_cache', None)
+        if markdown_render_cache is not None:
+            stat_record.add('markdown_render_cache', markdown_render_cache.stats)
+        markdown_render_watchdog = getattr(g, 'markdown_render_watchdog', None)
+        if markdown_render_watchdog is not None:
+            stat_record.add('markdown_render_timeouts', markdown_render_watchdog.timeouts)
         return stat_record
 
     def entry_point_timers(self):
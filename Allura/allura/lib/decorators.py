@@ -50,6 +50,24 @@ def myotherfunc():
         # No email notifications will be sent for c.project during this task
         pass
 
+    @task(coalesce=True)
+    def mythirdfunc(node_id):
+        # Posting this while an identical call (same arguments and context) is
+        # still waiting to run reuses the waiting task
+        pass
+
+    @task(max_retries=5, retry_backoff=30, retry_on=(SolrError, socket.error))
+    def myfourthfunc(ref_ids):
+        # If this raises one of the retry_on exceptions it is queued to run
+        # again, after 30s, then 60s, 120s... up to 5 times, before it is left
+        # in the error state
+        pass
+
+    A ``.post_many()`` function is added too, which queues many calls at once
+    with a single database write.  It takes a list of ``(args, kwargs)`` pairs:
+
+    myfunc.post_many([((1,), {}), ((2,), {'flag': True})])
+
     """
     def task_(func):
         def post(*args, **kwargs):
@@ -59,10 +77,26 @@ def post(*args, **kwargs):
                   kw.get('notifications_disabled') else h.null_contextmanager)
             with cm(project):
                 from allura import model as M
-                return M.MonQTask.post(func, args, kwargs, delay=delay)
+                return M.MonQTask.post(func, args, kwargs, delay=delay,
+                                       coalesce=kw.get('coalesce', False))
+
+        def post_many(calls, delay=0):
+            project = getattr(c, 'project', None)
+            cm = (h.notifications_disabled if project and
+                  kw.get('notifications_disabled') else h.null_contextmanager)
+            with cm(project):
+                from allura import model as M
+                return M.MonQTask.post_many(func, calls, delay=delay)
         # if decorating a class, have to make it a staticmethod
         # or it gets a spurious cls argument
         func.post = staticmethod(post) if inspect.isclass(func) else post
+        func.post_many = staticmethod(post_many) if inspect.isclass(func) else post_many
+        if kw.get('max_retries'):
+            # read by MonQTask when the task fails
+            func.retry_policy = dict(
+                max_retries=kw['max_retries'],
+                backoff=kw.get('retry_backoff', 60),
+                retry_on=kw.get('retry_on', Exception))
         return func
     if len(args) == 1 and callable(args[0]):
         return task_(args[0])
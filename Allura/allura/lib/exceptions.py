@@ -84,6 +84,10 @@ class InvalidNBFeatureValueError(ForgeError):
     pass
 
 
+class MarkdownRenderTimeout(ForgeError):
+    pass
+
+
 class CompoundError(ForgeError):
 
     def __repr__(self):
@@ -69,12 +69,14 @@ def __init__(self, app):
         markdown.Extension.__init__(self)
         self.app = app
         self._use_wiki = False
+        self.shortlinks = {}
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
         # remove default preprocessors and add our own
         md.preprocessors.clear()
         md.preprocessors['trac_refs'] = PatternReplacingProcessor(TracRef1(), TracRef2(), TracRef3(self.app))
+        md.preprocessors['shortlinks'] = ForgeLinkPreprocessor(md, ext=self)
         # remove all inlinepattern processors except short refs and links
         md.inlinePatterns.clear()
         md.inlinePatterns["link"] = markdown.inlinepatterns.LinkPattern(markdown.inlinepatterns.LINK_RE, md)
@@ -93,6 +95,7 @@ def extendMarkdown(self, md, md_globals):
 
     def reset(self):
         self.forge_link_tree_processor.reset()
+        self.shortlinks = {}
 
 
 class Pattern(object):
@@ -242,6 +245,7 @@ def __init__(self, wiki=False, email=False, macro_context=None):
         self._use_wiki = wiki
         self._is_email = email
         self._macro_context = macro_context
+        self.shortlinks = {}
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
@@ -250,6 +254,7 @@ def extendMarkdown(self, md, md_globals):
         md.preprocessors['html_block'].markdown_in_raw = True
         md.preprocessors.add('plain_text_block', PlainTextPreprocessor(md), "_begin")
         md.preprocessors.add('macro_include', ForgeMacroIncludePreprocessor(md), '_end')
+        md.preprocessors.add('shortlinks', ForgeLinkPreprocessor(md, ext=self), '_end')
         # this has to be before the 'escape' processor, otherwise weird
         # placeholders are inserted for escaped chars within urls, and then the
         # autolink can't match the whole url
@@ -271,6 +276,7 @@ def extendMarkdown(self, md, md_globals):
 
     def reset(self):
         self.forge_link_tree_processor.reset()
+        self.shortlinks = {}
 
 
 class ForgeLinkPattern(markdown.inlinepatterns.LinkPattern):
@@ -322,26 +328,68 @@ def _expand_alink(self, link, is_link_with_brackets):
         if is_link_with_brackets:
             classes = 'alink'
         href = link
-        shortlink = M.Shortlink.lookup(link)
-        if shortlink and shortlink.ref and not getattr(shortlink.ref.artifact, 'deleted', False):
-            href = shortlink.url
-            if getattr(shortlink.ref.artifact, 'is_closed', False):
+        target = self._lookup(link)
+        if target and not target.deleted:
+            href = target.url
+            if target.is_closed:
                 classes += ' strikethrough'
-            self.ext.forge_link_tree_processor.alinks.append(shortlink)
+            self.ext.forge_link_tree_processor.alinks.append(target)
         elif is_link_with_brackets:
             href = h.urlquote(link)
             classes += ' notfound'
         attach_link = link.split('/attachment/')
         if len(attach_link) == 2 and self.ext._use_wiki:
-            shortlink = M.Shortlink.lookup(attach_link[0])
-            if shortlink:
+            target = self._lookup(attach_link[0])
+            if target:
                 attach_status = ' notfound'
-                for attach in shortlink.ref.artifact.attachments:
+                for attach in target.ref.artifact.attachments:
                     if attach.filename == attach_link[1]:
                         attach_status = ''
                 classes += attach_status
         return href, classes
 
+    def _lookup(self, link):
+        '''Return the :class:`~allura.model.index.ShortlinkTarget` for
+        ``link``, preferably from the ones :class:`ForgeLinkPreprocessor`
+        already looked up'''
+        if link in self.ext.shortlinks:
+            return self.ext.shortlinks[link]
+        return M.Shortlink.resolve_links(link).get(link)
+
+
+class ForgeLinkPreprocessor(markdown.preprocessors.Preprocessor):
+
+    '''Resolves all the shortlinks that :class:`ForgeLinkPattern` may need
+    at once, with :meth:`~allura.model.index.Shortlink.resolve_links`,
+    instead of querying for each link as it is rendered.
+
+    Finds the candidates with the link patterns' own regexes, so it may find
+    more than end up being rendered as links (e.g. inside code blocks), and
+    links it misses are still looked up individually.
+    '''
+    # markdown.inlinepatterns.Pattern wraps these in one more group, which
+    # LINK_RE's backreference relies on, so keep the group numbers the same
+    link_re = re.compile(r'()' + markdown.inlinepatterns.LINK_RE, re.DOTALL | re.UNICODE)
+    short_ref_re = re.compile(r'()' + markdown.inlinepatterns.SHORT_REF_RE, re.DOTALL | re.UNICODE)
+
+    def __init__(self, md, ext):
+        markdown.preprocessors.Preprocessor.__init__(self, md)
+        self.ext = ext
+
+    def run(self, lines):
+        self.ext.shortlinks = {}
+        links = self.find_links('\n'.join(lines))
+        if links:
+            self.ext.shortlinks = M.Shortlink.resolve_links(*links)
+        return lines
+
+    def find_links(self, text):
+        links = set(m.group(9) for m in self.link_re.finditer(text))
+        links.update(m.group(2) for m in self.short_ref_re.finditer(text))
+        links.update([link.split('/attachment/')[0] for link in links if '/attachment/' in link])
+        links.discard('TOC')
+        return [link for link in links if link and ForgeLinkPattern.artifact_re.match(link)]
+
 
 class PlainTextPreprocessor(markdown.preprocessors.Preprocessor):
 
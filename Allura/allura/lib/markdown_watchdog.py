@@ -0,0 +1,171 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import os
+import math
+import logging
+import resource
+import threading
+import multiprocessing
+
+import markdown
+import pylons
+from pylons import tmpl_context as c, app_globals as g
+from paste.registry import Registry
+from paste.deploy.converters import asint
+from ming.orm import ThreadLocalORMSession
+
+import allura
+from allura.lib.exceptions import MarkdownRenderTimeout
+from allura.lib.security import Credentials
+
+log = logging.getLogger(__name__)
+
+
+class EmptyClass(object):
+    pass
+
+
+class MarkdownWatchdog(object):
+
+    '''
+    Renders markdown in a pool of worker processes, so that a pathological
+    text can't hold a web worker for longer than ``timeout`` seconds.
+
+    :meth:`convert` raises :class:`~allura.lib.exceptions.MarkdownRenderTimeout`
+    if the rendering takes longer than that.  The rendering goes on in its
+    worker until the worker has used that much CPU time, and is then killed
+    (by ``RLIMIT_CPU``) and replaced.
+
+    The web app forks the pool with :meth:`start` when it is loaded, before
+    the server starts any threads: a fork copies locks other threads may be
+    holding, and the workers would wait on them forever.  taskd does the
+    same in its worker processes that run several threads.  Any other
+    process forked after that (e.g. a server's, if it loads the app before
+    forking) starts its own pool on first use, which isn't safe if it runs
+    more than one thread by then, so threaded servers must load the app in
+    each of their processes.
+
+    Workers render with the project, tool and user of the caller, through a
+    converter made by :meth:`allura.lib.app_globals.Globals.markdown_flavor`.
+    Texts shorter than ``min_length`` aren't worth the round trip and are
+    left to the caller.
+    '''
+
+    def __init__(self, timeout=5, processes=2, min_length=0, background_timeout=120):
+        self.timeout = timeout
+        self.processes = processes
+        self.min_length = min_length
+        self.background_timeout = background_timeout
+        self.timeouts = 0
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Return a watchdog as configured by the
+        ``markdown_render_watchdog.*`` settings, or None if
+        ``markdown_render_watchdog.timeout`` isn't set."""
+        timeout = float(config.get('markdown_render_watchdog.timeout') or 0)
+        if timeout <= 0:
+            return None
+        return cls(timeout,
+                   processes=asint(config.get('markdown_render_watchdog.processes') or 2),
+                   min_length=asint(config.get('markdown_render_watchdog.min_length') or 0),
+                   background_timeout=float(config.get('markdown_render_watchdog.background_timeout') or 120))
+
+    def watches(self, source):
+        return len(source) >= self.min_length
+
+    def start(self, app_globals):
+        '''Fork the pool's workers, which render with ``app_globals``'''
+        with self._lock:
+            self._start(app_globals)
+
+    def _start(self, app_globals):
+        self._pool = multiprocessing.Pool(
+            self.processes, initializer=_init_worker,
+            initargs=(app_globals,))
+        self._pid = os.getpid()
+
+    def _get_pool(self):
+        with self._lock:
+            # a forked process can't use its parent's pool
+            if self._pool is None or self._pid != os.getpid():
+                self._start(g._current_obj())
+            return self._pool
+
+    def convert(self, flavor, options, source, timeout=None):
+        '''Render ``source`` with the converter of ``flavor`` and
+        ``options``, see :class:`~allura.lib.app_globals.ForgeMarkdown`'''
+        timeout = timeout or self.timeout
+        project = getattr(c, 'project', None)
+        app = getattr(c, 'app', None)
+        user = getattr(c, 'user', None)
+        result = self._get_pool().apply_async(_render, (
+            flavor, options, source,
+            getattr(project, '_id', None),
+            getattr(getattr(app, 'config', None), '_id', None),
+            getattr(user, '_id', None),
+            timeout))
+        try:
+            return result.get(timeout)
+        except multiprocessing.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise MarkdownRenderTimeout(
+                'Rendering %s markdown took over %ss' % (flavor, timeout))
+
+
+def _init_worker(app_globals):
+    registry = Registry()
+    registry.prepare()
+    registry.register(pylons.tmpl_context, EmptyClass())
+    registry.register(pylons.app_globals, app_globals)
+    registry.register(allura.credentials, Credentials())
+    # objects loaded by the parent are of no use here
+    ThreadLocalORMSession.close_all()
+
+
+def _limit_cpu(seconds):
+    '''Have this process killed once it has used ``seconds`` more CPU time'''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    limit = int(math.ceil(usage.ru_utime + usage.ru_stime + seconds))
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+
+
+def _render(flavor, options, source, project_id, app_config_id, user_id, timeout):
+    from allura import model as M
+    _limit_cpu(timeout)
+    try:
+        c.project = M.Project.query.get(_id=project_id) if project_id else None
+        c.app = None
+        if c.project and app_config_id:
+            app_config = M.AppConfig.query.get(_id=app_config_id)
+            if app_config:
+                c.app = c.project.app_instance(app_config)
+        c.user = M.User.query.get(_id=user_id) if user_id else None
+        if c.user is None:
+            c.user = M.User.anonymous()
+        md = g.markdown_flavor(flavor, options)
+        return markdown.Markdown.convert(md, source)
+    finally:
+        ThreadLocalORMSession.close_all()
@@ -16,7 +16,12 @@
 #       under the License.
 
 import re
+import copy
+import json
+import math
+import time
 import socket
+import hashlib
 from logging import getLogger
 from urllib import urlencode
 from itertools import imap
@@ -24,12 +29,14 @@
 import markdown
 import jinja2
 from tg import redirect, url
+from paste.deploy.converters import asint
 from pylons import tmpl_context as c, app_globals as g
 from pylons import request
 from pysolr import SolrError
 
 from allura.lib import helpers as h
 from allura.lib.solr import escape_solr_arg
+from allura.lib.utils import LRUCache
 
 log = getLogger(__name__)
 
@@ -77,6 +84,23 @@ def index(self):
         """
         raise NotImplementedError
 
+    # Fields of index() which often change on their own, e.g. the mod date.
+    # When nothing else changed (including any field their values are copied
+    # into by index()), add_artifacts just sets them in solr rather than
+    # sending the whole (solarized) document again.  They must not be the
+    # source of a copyField in the solr schema, which would then get both the
+    # old and new values.
+    index_hot_fields = ()
+
+    @classmethod
+    def index_fields_key(cls, app_config_id=None):
+        """Return a value which changes whenever the set of fields indexed by
+        this class (in app ``app_config_id``) does, e.g. due to configuration.
+
+        Used to invalidate the :func:`index_fields` cache.
+        """
+        return None
+
     def should_update_index(self, old_doc, new_doc):
         """Determines if solr index should be updated.
 
@@ -85,10 +109,17 @@ def should_update_index(self, old_doc, new_doc):
         """
         return old_doc != new_doc
 
-    def solarize(self):
-        doc = self.index()
+    def solarize(self, doc=None):
+        """Return the document to send to solr: :meth:`index` (or ``doc``, if
+        it has already been computed) with its markdown text converted to
+        plain text.
+
+        """
+        if doc is None:
+            doc = self.index()
         if doc is None:
             return None
+        doc = dict(doc)
         # if index() returned doc without text, assume empty text
         text = doc.get('text')
         if text is None:
@@ -96,8 +127,15 @@ def solarize(self):
 
         # Convert text to plain text (It usually contains markdown markup).
         # To do so, we convert markdown into html, and then strip all html tags.
-        text = g.markdown.convert(text)
-        doc['text'] = jinja2.Markup.escape(text).striptags()
+        # Reuse a rendering of the same text from a MarkdownCache if we can.
+        html = None
+        for cache_name in ('text_cache', 'description_cache'):
+            html = g.markdown.cached_html(getattr(self, cache_name, None), text)
+            if html is not None:
+                break
+        if html is None:
+            html = g.markdown.convert(text)
+        doc['text'] = jinja2.Markup.escape(html).striptags()
         return doc
 
     @classmethod
@@ -119,10 +157,48 @@ def translate_query(cls, q, fields):
         return q
 
 
+def index_fingerprint(doc, hot_fields=()):
+    """Return a hash of an :meth:`SearchIndexable.index` document, so that
+    unchanged documents need not be sent to solr again.
+
+    If ``hot_fields`` are given, the hash is in two parts, ``rest:hot``, so
+    that :func:`only_hot_fields_changed` can tell if just they changed.
+    """
+    if doc is None:
+        return None
+    if not hot_fields:
+        return _md5_json(doc)
+    hot = dict((name, doc.get(name)) for name in hot_fields)
+    rest = dict((k, v) for k, v in doc.iteritems() if k not in hot)
+    return '%s:%s' % (_md5_json(rest), _md5_json(hot))
+
+
+def only_hot_fields_changed(fingerprint, old_fingerprint):
+    """Whether two :func:`index_fingerprint` of a document only differ in
+    its hot fields."""
+    if not (fingerprint and old_fingerprint) or ':' not in old_fingerprint:
+        return False
+    rest, hot = fingerprint.split(':')
+    old_rest, old_hot = old_fingerprint.split(':')
+    return rest == old_rest and hot != old_hot
+
+
+def _md5_json(doc):
+    dumped = json.dumps(doc, sort_keys=True, default=unicode)
+    return hashlib.md5(dumped.encode('utf-8')).hexdigest()
+
+
 class SearchError(SolrError):
     pass
 
 
+class SearchUnavailable(SearchError):
+
+    """Raised when solr is down or too slow to use, rather than because of
+    the query."""
+    pass
+
+
 def inject_user(q, user=None):
     '''Replace $USER with current user's name.'''
     if user is None:
@@ -130,19 +206,229 @@ def inject_user(q, user=None):
     return q.replace('$USER', '"%s"' % user.username) if q else q
 
 
+def _is_outage(e):
+    """Whether a search error means solr is unavailable, rather than the
+    query being bad."""
+    if isinstance(e, socket.error):
+        return True
+    return not re.search(r'SyntaxError|ParseException|undefined field|can not sort|Cannot parse',
+                         str(e))
+
+
 def search(q, short_timeout=False, ignore_errors=True, **kw):
     q = inject_user(q)
+    cache = g.search_cache
+    if cache is not None:
+        key = cache.key(q, short_timeout, kw)
+        result = cache.get(key)
+        if result is not None:
+            return result
+    breaker = g.search_breaker
+    if breaker is not None and not breaker.allow():
+        if not ignore_errors:
+            raise SearchUnavailable('Search is temporarily unavailable')
+        return None
+    started = time.time()
+    # any unexpected error (e.g. httplib2's ServerNotFoundError) counts as
+    # a failure too, so that a trial call always closes or reopens the breaker
+    failed = True
     try:
         if short_timeout:
-            return g.solr_short_timeout.search(q, **kw)
+            result = g.solr_short_timeout.search(q, **kw)
         else:
-            return g.solr.search(q, **kw)
+            result = g.solr.search(q, **kw)
+        failed = False
     except (SolrError, socket.error) as e:
+        failed = outage = _is_outage(e)
         log.exception('Error in solr search')
         if not ignore_errors:
             match = re.search(r'<pre>(.*)</pre>', str(e))
-            raise SearchError('Error running search query: %s' %
-                              (match.group(1) if match else e))
+            error_cls = SearchUnavailable if outage else SearchError
+            raise error_cls('Error running search query: %s' %
+                            (match.group(1) if match else e))
+        return None
+    finally:
+        if breaker is not None:
+            breaker.record(time.time() - started, failed=failed)
+    if cache is not None:
+        cache.set(key, result)
+    return result
+
+
+class SearchResultCache(object):
+
+    """
+    Caches :func:`search` results for ``ttl`` seconds in this process, so
+    that pages which repeat the same queries don't all go to solr.
+
+    Entries are tagged with the project (and mount point) their query filters
+    on, so that :meth:`invalidate` can drop the results an indexing change
+    may affect.  Queries not limited to one project only expire.
+    """
+
+    def __init__(self, ttl, maxsize=1000):
+        self.ttl = ttl
+        self._results = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    @classmethod
+    def from_config(cls, config):
+        """Return a cache as configured by the ``solr.result_cache.*``
+        settings, or None if ``solr.result_cache.ttl`` isn't set."""
+        ttl = float(config.get('solr.result_cache.ttl') or 0)
+        if ttl <= 0:
+            return None
+        host = config.get('solr.result_cache.memcached_host')
+        if host:
+            try:
+                import pylibmc
+            except ImportError:
+                raise Exception('The pylibmc package needs to be installed to use '
+                                'solr.result_cache.memcached_host.  '
+                                'Run `pip install pylibmc` in your allura environment.')
+            return MemcachedSearchResultCache(ttl, pylibmc.Client([host]))
+        return cls(ttl, asint(config.get('solr.result_cache.size', 1000)))
+
+    @staticmethod
+    def key(q, short_timeout, params):
+        """Return a key for the search: ``(project_id, mount_point, query)``,
+        where the first two are None unless the query filters on them."""
+        params = dict(params, q=q, short_timeout=bool(short_timeout))
+        for name, value in params.items():
+            if isinstance(value, (list, tuple)):
+                params[name] = sorted(value) if name == 'fq' else list(value)
+        query = json.dumps(params, sort_keys=True, default=unicode)
+        filters = [q or ''] + list(params.get('fq') or [])
+        project_ids = set()
+        mount_points = set()
+        for f in filters:
+            project_ids.update(re.findall(r'project_id_s:"?(\w+)', f))
+            mount_points.update(re.findall(r'mount_point_s:"?([^"\s)]+)', f))
+        if len(project_ids) != 1:
+            return (None, None, query)
+        mount_point = mount_points.pop() if len(mount_points) == 1 else None
+        return (project_ids.pop(), mount_point, query)
+
+    def get(self, key):
+        # callers may modify the results, so don't hand out the cached copy
+        return copy.deepcopy(self._results.get(key))
+
+    def set(self, key, result):
+        if result is not None:
+            self._results.set(key, copy.deepcopy(result))
+
+    def invalidate(self, project_id, mount_point=None):
+        """Drop cached results for ``project_id`` (just the tool at
+        ``mount_point``, and project-wide queries, if given)."""
+        project_id = str(project_id)
+        self._results.discard_where(
+            lambda key: key[0] == project_id and
+            (mount_point is None or key[1] in (None, mount_point)))
+
+
+class MemcachedSearchResultCache(SearchResultCache):
+
+    """
+    A :class:`SearchResultCache` shared by all processes using the same
+    memcached, so that invalidation in the indexing tasks applies to the web
+    processes as well.
+
+    Invalidation bumps generation counters stored alongside the results,
+    and results cached under an older generation are ignored.
+    """
+
+    def __init__(self, ttl, client, prefix='allura:search:'):
+        self.ttl = ttl
+        self.client = client
+        self.prefix = prefix
+
+    def _entry_key(self, key):
+        return self.prefix + hashlib.md5(repr(key)).hexdigest()
+
+    def _generation_keys(self, key):
+        project_id, mount_point = key[:2]
+        if project_id is None:
+            return []
+        if mount_point is None:
+            # changed whenever anything in the project is
+            return [self.prefix + 'gen:%s' % project_id]
+        return [self.prefix + 'gen:%s:*' % project_id,
+                self.prefix + 'gen:%s:%s' % (project_id, mount_point)]
+
+    def _generations(self, key):
+        gen_keys = self._generation_keys(key)
+        found = self.client.get_multi([self._entry_key(key)] + gen_keys)
+        return found, [found.get(k, 0) for k in gen_keys]
+
+    def get(self, key):
+        found, generations = self._generations(key)
+        entry = found.get(self._entry_key(key))
+        if entry is None or entry[0] != generations:
+            return None
+        return entry[1]
+
+    def set(self, key, result):
+        if result is None:
+            return
+        found, generations = self._generations(key)
+        self.client.set(self._entry_key(key), (generations, result),
+                        time=int(math.ceil(self.ttl)))
+
+    def _incr(self, gen_key):
+        if not self.client.add(gen_key, 1):
+            self.client.incr(gen_key)
+
+    def invalidate(self, project_id, mount_point=None):
+        self._incr(self.prefix + 'gen:%s' % project_id)
+        if mount_point is None:
+            self._incr(self.prefix + 'gen:%s:*' % project_id)
+        else:
+            self._incr(self.prefix + 'gen:%s:%s' % (project_id, mount_point))
+
+
+def invalidate_search_cache(project_id, mount_point=None):
+    """Drop cached :func:`search` results which changes to ``project_id``
+    (the tool at ``mount_point``, if given) may affect."""
+    cache = g.search_cache
+    if cache is not None and project_id:
+        cache.invalidate(project_id, mount_point)
+
+
+# (class, app_config_id, class.index_fields_key()) -> fields, see index_fields
+_index_fields = LRUCache(maxsize=10000)
+
+
+def index_fields(atype, app_config_id=None):
+    """Return the fields indexed by ``atype`` objects (in app
+    ``app_config_id``, if given), for use with ``atype.translate_query``.
+
+    The field names are learned from a sample object's :meth:`index`, which
+    is expensive, so they are cached per class and app.  Only ``type_s`` has
+    its value in the returned dict, the other values are None.
+
+    Returns None if there is no object to sample.
+    """
+    key = (atype, app_config_id, atype.index_fields_key(app_config_id))
+    fields = _index_fields.get(key)
+    if fields is None:
+        query = dict(app_config_id=app_config_id) if app_config_id else {}
+        obj = atype.query.find(query).first()
+        if obj is None:
+            return None
+        doc = obj.index()
+        fields = dict.fromkeys(doc)
+        fields['type_s'] = doc.get('type_s')
+        _index_fields.set(key, fields)
+    return fields
+
+
+def invalidate_index_fields(atype=None, app_config_id=None):
+    """Drop this process's cached :func:`index_fields` of ``atype`` and/or
+    ``app_config_id`` (all of them, by default).
+
+    Other processes rely on :meth:`SearchIndexable.index_fields_key`.
+    """
+    _index_fields.discard_where(
+        lambda key: atype in (None, key[0]) and app_config_id in (None, key[1]))
 
 
 def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None, **kw):
@@ -150,11 +436,10 @@ def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filte
 
     Raises SearchError if SOLR returns an error.
     """
-    # first, grab an artifact and get the fields that it indexes
-    a = atype.query.find().first()
-    if a is None:
+    # get the fields that artifacts of this type index
+    fields = index_fields(atype, c.app.config._id)
+    if fields is None:
         return  # if there are no instance of atype, we won't find anything
-    fields = a.index()
     # Now, we'll translate all the fld:
     q = atype.translate_query(q, fields)
     fq = [
@@ -182,17 +467,16 @@ def site_admin_search(model, q, field, **kw):
 
     Raises SearchError if SOLR returns an error.
     """
-    # first, grab an object and get the fields that it indexes
-    obj = model.query.find().first()
-    if obj is None:
+    # get the fields that objects of this type index
+    fields = index_fields(model)
+    if fields is None:
         return  # if there are no objects, we won't find anything
-    fields = obj.index()
     if field == '__custom__':
         # custom query -> query as is
-        q = obj.translate_query(q, fields)
+        q = model.translate_query(q, fields)
     else:
         # construct query for a specific selected field
-        q = obj.translate_query(u'%s:%s' % (field, q), fields)
+        q = model.translate_query(u'%s:%s' % (field, q), fields)
     fq = [u'type_s:%s' % model.type_s]
     return search(q, fq=fq, ignore_errors=False, **kw)
 
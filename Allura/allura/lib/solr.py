@@ -15,12 +15,21 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import shlex
+import logging
+import threading
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
+from xml.etree import cElementTree as ET
 
 from tg import config
 from paste.deploy.converters import asbool
 import pysolr
 
+log = logging.getLogger(__name__)
+
 escape_rules = {'+': r'\+',
                '-': r'\-',
                '&': r'\&',
@@ -55,7 +64,13 @@ def make_solr_from_config(push_servers, query_server=None, **kwargs):
     """
     Make a :class:`Solr <Solr>` instance from config defaults.  Use
     `**kwargs` to override any value
+
+    A ``sqlite://<path>`` server makes an embedded
+    :class:`~allura.lib.sqlite_solr.SQLiteSolr` index instead.
     """
+    if push_servers[0].startswith('sqlite://'):
+        from allura.lib.sqlite_solr import SQLiteSolr
+        return SQLiteSolr(push_servers[0][len('sqlite://'):])
     solr_kwargs = dict(
         commit=asbool(config.get('solr.commit', True)),
         commitWithin=config.get('solr.commitWithin'),
@@ -65,6 +80,21 @@ def make_solr_from_config(push_servers, query_server=None, **kwargs):
     return Solr(push_servers, query_server, **solr_kwargs)
 
 
+class SolrPushError(pysolr.SolrError):
+
+    """Raised when an update failed on some of the push servers.
+
+    `errors`: dict of server url to the exception it raised.  The other
+    servers were updated.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(SolrPushError, self).__init__(
+            'Solr update failed on %s' % ', '.join(
+                '%s (%s)' % (url, e) for url, e in sorted(errors.items())))
+
+
 class Solr(object):
 
     """Solr interface that pushes updates to multiple solr instances.
@@ -75,10 +105,17 @@ class Solr(object):
     Also, accepts default values for `commit` and `commitWithin`
     and passes those values through to each `add` and `delete` call,
     unless explicitly overridden.
+
+    Updates are sent to all the push servers at once, from a pool of threads,
+    so a slow server doesn't hold up the others (each request is still limited
+    by `timeout`).  If any of them fail, :class:`SolrPushError` is raised after
+    the rest have finished.  Updates split into several requests (see
+    :meth:`delete_ids`) send up to `parallel_requests` of them to each server
+    at once.
     """
 
     def __init__(self, push_servers, query_server=None,
-                 commit=True, commitWithin=None, **kw):
+                 commit=True, commitWithin=None, parallel_requests=4, **kw):
         self.push_pool = [pysolr.Solr(s, **kw) for s in push_servers]
         if query_server:
             self.query_server = pysolr.Solr(query_server, **kw)
@@ -86,35 +123,138 @@ def __init__(self, push_servers, query_server=None,
             self.query_server = self.push_pool[0]
         self._commit = commit
         self.commitWithin = commitWithin
+        self.parallel_requests = parallel_requests
+        self._threads = None
+        self._threads_pid = None
+        self._threads_lock = threading.Lock()
+
+    def _thread_pool(self):
+        with self._threads_lock:
+            # a pool inherited across a fork (e.g. by taskd workers) has no threads
+            if self._threads is None or self._threads_pid != os.getpid():
+                self._threads = ThreadPool(
+                    len(self.push_pool) * self.parallel_requests)
+                self._threads_pid = os.getpid()
+            return self._threads
+
+    def _push(self, method, *args, **kw):
+        """Call ``method`` (the name of a :class:`pysolr.Solr` method, or a
+        function taking the :class:`pysolr.Solr` first) on each push server."""
+        if isinstance(method, basestring):
+            calls = [getattr(solr, method) for solr in self.push_pool]
+        else:
+            calls = [partial(method, solr) for solr in self.push_pool]
+        if len(self.push_pool) == 1:
+            return [calls[0](*args, **kw)]
+        pool = self._thread_pool()
+        results = [pool.apply_async(call, args, kw) for call in calls]
+        responses, errors = [], {}
+        for solr, result in zip(self.push_pool, results):
+            try:
+                responses.append(result.get())
+            except Exception as e:
+                log.error('Solr %s failed on %s: %s',
+                          getattr(method, '__name__', method), solr.url, e)
+                responses.append(None)
+                errors[solr.url] = e
+        if errors:
+            raise SolrPushError(errors)
+        return responses
 
     def add(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
         if self.commitWithin and 'commitWithin' not in kw:
             kw['commitWithin'] = self.commitWithin
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.add(*args, **kw))
-        return responses
+        if kw.get('commitWithin'):
+            # pysolr sets it as an xml attribute, which must be a string
+            kw['commitWithin'] = str(kw['commitWithin'])
+        return self._push('add', *args, **kw)
+
+    def update_fields(self, docs, **kw):
+        """Atomically set some fields of existing documents, leaving their
+        other fields as they are.  Each of ``docs`` has the ``id`` of the
+        document and the new values of the fields to set (None removes the
+        field).
+
+        Solr can only do this if the documents' fields are all stored.
+        """
+        if 'commit' not in kw:
+            kw['commit'] = self._commit
+        if self.commitWithin and 'commitWithin' not in kw:
+            kw['commitWithin'] = self.commitWithin
+        return self._push(_update_fields, docs, **kw)
 
     def delete(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.delete(*args, **kw))
-        return responses
+        return self._push('delete', *args, **kw)
+
+    def delete_ids(self, ids, chunk_size=1000, **kw):
+        """Delete the documents with these ``ids``.
+
+        Rather than one ``id:(...)`` query, which gets huge for many ids,
+        sends delete-by-id requests of at most ``chunk_size`` ids each, in
+        parallel, and commits once at the end (if ``commit``).
+        """
+        commit = kw.pop('commit', self._commit)
+        chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+        if not chunks:
+            return
+        pool = self._thread_pool()
+        results = [(solr, pool.apply_async(_delete_ids, (solr, chunk), dict(kw, commit=False)))
+                   for solr in self.push_pool for chunk in chunks]
+        errors = {}
+        for solr, result in results:
+            try:
+                result.get()
+            except Exception as e:
+                log.error('Solr delete failed on %s: %s', solr.url, e)
+                errors.setdefault(solr.url, e)
+        if commit:
+            for solr in self.push_pool:
+                if solr.url not in errors:
+                    solr.commit()
+        if errors:
+            raise SolrPushError(errors)
 
     def commit(self, *args, **kw):
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.commit(*args, **kw))
-        return responses
+        return self._push('commit', *args, **kw)
 
     def search(self, *args, **kw):
         return self.query_server.search(*args, **kw)
 
 
+def _update_fields(solr, docs, commitWithin=None, **kw):
+    """Send atomic "set" updates to a :class:`pysolr.Solr`, which (in
+    version 2) can only add whole documents."""
+    message = ET.Element('add')
+    if commitWithin:
+        message.set('commitWithin', str(commitWithin))
+    for doc in docs:
+        d = ET.SubElement(message, 'doc')
+        ET.SubElement(d, 'field', name='id').text = solr._from_python(doc['id'])
+        for name, value in sorted(doc.iteritems()):
+            if name == 'id':
+                continue
+            values = value if isinstance(value, (list, tuple)) else [value]
+            if not values or value is None:
+                ET.SubElement(d, 'field', name=name, update='set', null='true')
+            for v in values:
+                if v is not None:
+                    f = ET.SubElement(d, 'field', name=name, update='set')
+                    f.text = solr._from_python(v)
+    return solr._update(ET.tostring(message, encoding='utf-8'), **kw)
+
+
+def _delete_ids(solr, ids, **kw):
+    """Delete documents by id from a :class:`pysolr.Solr`, in one request.
+    (Its own :meth:`~pysolr.Solr.delete` takes just one id.)"""
+    message = '<delete>%s</delete>' % ''.join(
+        '<id>%s</id>' % escape(unicode(id)) for id in ids)
+    return solr._update(message, **kw)
+
+
 class MockSOLR(object):
 
     class MockHits(list):
@@ -134,7 +274,7 @@ def facets(self):
     def __init__(self):
         self.db = {}
 
-    def add(self, objects):
+    def add(self, objects, **kw):
         for o in objects:
             o['text'] = ''.join(o['text'])
             self.db[o['id']] = o
@@ -176,6 +316,19 @@ def search(self, q, fq=None, **kw):
                 result.append(obj)
         return result
 
+    def update_fields(self, docs, **kw):
+        for doc in docs:
+            stored = self.db[doc['id']]
+            for name, value in doc.iteritems():
+                if value is None:
+                    stored.pop(name, None)
+                else:
+                    stored[name] = value
+
+    def delete_ids(self, ids, **kw):
+        for id in ids:
+            self.db.pop(id, None)
+
     def delete(self, *args, **kwargs):
         if kwargs.get('q', None) == '*:*':
             self.db = {}
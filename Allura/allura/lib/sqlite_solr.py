@@ -0,0 +1,643 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+An embedded search backend with the interface of :class:`allura.lib.solr.Solr`,
+storing the index in a SQLite database and using its FTS5 full-text index.
+
+Use it by setting ``solr.server = sqlite:///path/to/index.db`` (or
+``sqlite://:memory:``).  It understands the subset of solr that Allura uses:
+the standard (lucene) query syntax and dismax, ``fq``, ``sort``, ``rows``,
+``start``, ``fl``, field facets and highlighting.  Field types follow the
+dynamic fields of Allura's solr schema (``_s``, ``_t``, ``_i``, ``_dt``, etc).
+"""
+
+import os
+import re
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from pysolr import SolrError, Results
+
+log = logging.getLogger(__name__)
+
+MUST, SHOULD, MUST_NOT = '+', '', '-'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS fields (
+    pk INTEGER PRIMARY KEY, doc_id TEXT NOT NULL, name TEXT NOT NULL, value);
+CREATE INDEX IF NOT EXISTS fields_name_value ON fields (name, value);
+CREATE INDEX IF NOT EXISTS fields_doc_id ON fields (doc_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(
+    value, content='fields', content_rowid='pk', tokenize='unicode61 remove_diacritics 2');
+'''
+# fields copied to another field when indexed, as in the solr schema
+COPY_FIELDS = {'labels_t': 'labels_ws'}
+
+# (path, pid) -> (connection, lock), shared by all instances in a process
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def field_type(name):
+    if name in ('text', 'title') or name.endswith(('_t', '_ws')):
+        return 'text'
+    if name.endswith(('_i', '_l')):
+        return 'int'
+    if name.endswith(('_f', '_d')):
+        return 'float'
+    if name.endswith('_b'):
+        return 'bool'
+    if name.endswith('_dt'):
+        return 'date'
+    return 'string'
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+_date_math_re = re.compile(r'([+-])(\d+)(YEAR|MONTH|DAY|HOUR|MINUTE|SECOND)S?|/(YEAR|MONTH|DAY|HOUR|MINUTE|SECOND)S?')
+
+
+def parse_date(value):
+    """Parse a solr date, including ``NOW`` date math like ``NOW-7DAYS/DAY``"""
+    if isinstance(value, datetime):
+        return value
+    value = _text(value).strip()
+    if value.startswith('NOW'):
+        dt = datetime.utcnow()
+        for sign, amount, unit, rounding in _date_math_re.findall(value[3:]):
+            if rounding:
+                parts = ['year', 'month', 'day', 'hour', 'minute', 'second']
+                keep = parts.index(rounding.lower()) + 1
+                dt = dt.replace(microsecond=0, **dict(
+                    (p, 1 if p in ('month', 'day') else 0) for p in parts[keep:]))
+                continue
+            amount = int(amount) * (-1 if sign == '-' else 1)
+            if unit == 'YEAR':
+                dt = dt.replace(year=dt.year + amount)
+            elif unit == 'MONTH':
+                months = dt.year * 12 + dt.month - 1 + amount
+                dt = dt.replace(year=months // 12, month=months % 12 + 1)
+            else:
+                dt += timedelta(**{unit.lower() + 's': amount})
+        return dt
+    for fmt in (DATE_FORMAT, '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise SolrError('Invalid Date String: %r' % value)
+
+
+def index_value(name, value):
+    """The value of field ``name`` as stored in the ``fields`` table"""
+    ftype = field_type(name)
+    if ftype == 'int':
+        return int(value)
+    if ftype == 'float':
+        return float(value)
+    if ftype == 'bool':
+        if isinstance(value, basestring):
+            value = value.strip()[:1].lower() in ('t', '1')
+        return u'true' if value else u'false'
+    if ftype == 'date':
+        return parse_date(value).strftime(DATE_FORMAT)
+    return _text(value)
+
+
+def query_value(name, value):
+    try:
+        return index_value(name, value)
+    except ValueError:
+        raise SolrError('Invalid value %r for field %s' % (value, name))
+
+
+class QueryParser(object):
+
+    """Parses the lucene query syntax into nested tuples:
+
+    ``('all',)``,
+    ``('term', field, value, kind)`` where kind is term, phrase, prefix or wildcard,
+    ``('range', field, low, high, include_low, include_high)``,
+    ``('bool', [(occur, query), ...])`` where occur is MUST, SHOULD or MUST_NOT.
+
+    ``fields`` are the default fields of terms without one, and ``required``
+    makes clauses without an operator required (like dismax's mm=100%).
+    """
+
+    special = set('()[]{}":^~\\')
+
+    def __init__(self, fields=('text',), required=False):
+        self.fields = list(fields)
+        self.required = required
+
+    def parse(self, q):
+        self.q, self.pos = q, 0
+        query = self._parse_bool(self.fields)
+        self._skip_ws()
+        if self.pos < len(self.q):
+            raise SolrError('Cannot parse %r: unexpected %r' % (q, self.q[self.pos]))
+        return query
+
+    def _skip_ws(self):
+        while self.pos < len(self.q) and self.q[self.pos].isspace():
+            self.pos += 1
+
+    def _peek_word(self, word):
+        end = self.pos + len(word)
+        return (self.q[self.pos:end] == word and
+                (end == len(self.q) or self.q[end].isspace() or self.q[end] in '()'))
+
+    def _parse_bool(self, fields):
+        clauses = []
+        conj = None
+        while True:
+            self._skip_ws()
+            if self.pos >= len(self.q) or self.q[self.pos] == ')':
+                break
+            if self._peek_word('AND') or self.q.startswith('&&', self.pos):
+                self.pos += 3 if self.q[self.pos] == 'A' else 2
+                conj = 'AND'
+                continue
+            if self._peek_word('OR') or self.q.startswith('||', self.pos):
+                self.pos += 2
+                conj = 'OR'
+                continue
+            mod = None
+            if self._peek_word('NOT'):
+                self.pos += 3
+                mod = MUST_NOT
+            elif self.q[self.pos] in '+-!':
+                mod = MUST if self.q[self.pos] == '+' else MUST_NOT
+                self.pos += 1
+            self._skip_ws()
+            query = self._parse_clause(fields)
+            # the same rules as lucene's QueryParser, for the OR default operator
+            if clauses and conj == 'AND' and clauses[-1][0] != MUST_NOT:
+                clauses[-1] = (MUST, clauses[-1][1])
+            if mod is not None:
+                occur = mod
+            elif conj == 'AND' or self.required:
+                occur = MUST
+            else:
+                occur = SHOULD
+            clauses.append((occur, query))
+            conj = None
+        if len(clauses) == 1 and clauses[0][0] != MUST_NOT:
+            return clauses[0][1]
+        return ('bool', clauses)
+
+    def _parse_clause(self, fields):
+        if self.pos >= len(self.q):
+            raise SolrError('Cannot parse %r: unexpected end of query' % self.q)
+        if self.q[self.pos] == '(':
+            self.pos += 1
+            query = self._parse_bool(fields)
+            self._expect(')')
+            self._skip_modifiers()
+            return query
+        if self.q[self.pos] != '"':
+            start = self.pos
+            token = self._read_token()
+            if self.pos < len(self.q) and self.q[self.pos] == ':' and token:
+                self.pos += 1
+                if token == '*' and self.q.startswith('*', self.pos):
+                    self.pos += 1
+                    return ('all',)
+                return self._parse_field_value([token])
+            self.pos = start
+        return self._parse_field_value(fields)
+
+    def _parse_field_value(self, fields):
+        c = self.q[self.pos:self.pos + 1]
+        if c == '(':
+            self.pos += 1
+            query = self._parse_bool(fields)
+            self._expect(')')
+        elif c in ('[', '{'):
+            query = self._parse_range(fields[0])
+        elif c == '"':
+            query = self._any_field(fields, self._read_phrase(), 'phrase')
+        else:
+            raw = self._read_token(raw=True)
+            if not raw:
+                raise SolrError('Cannot parse %r at %d' % (self.q, self.pos))
+            value = re.sub(r'\\(.)', r'\1', raw)
+            if raw == '*':
+                query = ('range', fields[0], None, None, True, True)
+            elif re.search(r'(?<!\\)[*?]', raw):
+                if re.match(r'^([^*?\\]|\\.)+\*$', raw):
+                    query = self._any_field(fields, value[:-1], 'prefix')
+                else:
+                    query = self._any_field(fields, raw, 'wildcard')
+            else:
+                query = self._any_field(fields, value, 'term')
+        self._skip_modifiers()
+        return query
+
+    def _any_field(self, fields, value, kind):
+        if len(fields) == 1:
+            return ('term', fields[0], value, kind)
+        return ('bool', [(SHOULD, ('term', f, value, kind)) for f in fields])
+
+    def _parse_range(self, field):
+        include_low = self.q[self.pos] == '['
+        self.pos += 1
+        self._skip_ws()
+        low = self._read_phrase() if self.q[self.pos:self.pos + 1] == '"' else self._read_token(range_end=True)
+        self._skip_ws()
+        if not self._peek_word('TO'):
+            raise SolrError('Cannot parse %r: expected TO' % self.q)
+        self.pos += 2
+        self._skip_ws()
+        high = self._read_phrase() if self.q[self.pos:self.pos + 1] == '"' else self._read_token(range_end=True)
+        self._skip_ws()
+        if self.q[self.pos:self.pos + 1] not in (']', '}'):
+            raise SolrError('Cannot parse %r: unterminated range' % self.q)
+        include_high = self.q[self.pos] == ']'
+        self.pos += 1
+        return ('range', field,
+                None if low == '*' else low, None if high == '*' else high,
+                include_low, include_high)
+
+    def _read_token(self, raw=False, range_end=False):
+        start = self.pos
+        while self.pos < len(self.q):
+            c = self.q[self.pos]
+            if c == '\\' and self.pos + 1 < len(self.q):
+                self.pos += 2
+                continue
+            if c.isspace() or (c in ']}' if range_end else c in self.special):
+                break
+            self.pos += 1
+        token = self.q[start:self.pos]
+        return token if raw else re.sub(r'\\(.)', r'\1', token)
+
+    def _read_phrase(self):
+        self._expect('"')
+        chars = []
+        while self.pos < len(self.q) and self.q[self.pos] != '"':
+            if self.q[self.pos] == '\\' and self.pos + 1 < len(self.q):
+                self.pos += 1
+            chars.append(self.q[self.pos])
+            self.pos += 1
+        self._expect('"')
+        return ''.join(chars)
+
+    def _skip_modifiers(self):
+        # boosts and fuzziness/proximity don't change what matches
+        while self.q[self.pos:self.pos + 1] in ('^', '~'):
+            self.pos += 1
+            while self.pos < len(self.q) and (self.q[self.pos].isdigit() or self.q[self.pos] == '.'):
+                self.pos += 1
+
+    def _expect(self, char):
+        if self.q[self.pos:self.pos + 1] != char:
+            raise SolrError('Cannot parse %r: expected %r at %d' % (self.q, char, self.pos))
+        self.pos += 1
+
+
+def fts_query(value, kind):
+    """A FTS5 query string for a term, phrase or prefix of a text field"""
+    if kind == 'wildcard':
+        # FTS5 only has prefix queries
+        value, kind = re.split(r'[*?]', value, 1)[0], 'prefix'
+    words = re.findall(r'\w+', value, re.UNICODE)
+    if not words:
+        return None
+    query = u'"%s"' % u' '.join(words)
+    return query + u' *' if kind == 'prefix' else query
+
+
+class SQLiteSolr(object):
+
+    """Search index in the SQLite database at ``path``, with the interface of
+    :class:`allura.lib.solr.Solr`.
+
+    Changes are visible to searches as soon as they're made, so ``commit``
+    and ``commitWithin`` are accepted but ignored.
+    """
+
+    def __init__(self, path, **kw):
+        self.path = path
+        self.url = 'sqlite://' + path
+
+    def _connection(self):
+        # connections can't be used across a fork, so there's one per process
+        key = (self.path, os.getpid())
+        with _connections_lock:
+            if key not in _connections:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                if self.path != ':memory:':
+                    conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(SCHEMA)
+                _connections[key] = (conn, threading.RLock())
+            return _connections[key]
+
+    def _execute(self, sql, params=()):
+        conn, lock = self._connection()
+        with lock:
+            return conn.execute(sql, params).fetchall()
+
+    def add(self, docs, commit=True, boost=None, commitWithin=None, **kw):
+        conn, lock = self._connection()
+        with lock, conn:
+            for doc in docs:
+                doc_id = _text(doc['id'])
+                self._delete_ids(conn, [doc_id])
+                conn.execute('INSERT INTO docs (id, doc) VALUES (?, ?)',
+                             (doc_id, json.dumps(doc, default=self._json_default)))
+                for name, values in doc.iteritems():
+                    if not isinstance(values, (list, tuple)):
+                        values = [values]
+                    for value in values:
+                        if value is None:
+                            continue
+                        for field in (name, COPY_FIELDS.get(name)):
+                            if field is not None:
+                                self._add_value(conn, doc_id, field, value)
+
+    def _add_value(self, conn, doc_id, name, value):
+        try:
+            value = index_value(name, value)
+        except ValueError:
+            raise SolrError('Invalid value %r for field %s of %s' % (value, name, doc_id))
+        pk = conn.execute('INSERT INTO fields (doc_id, name, value) VALUES (?, ?, ?)',
+                          (doc_id, name, value)).lastrowid
+        if field_type(name) == 'text':
+            conn.execute('INSERT INTO fts (rowid, value) VALUES (?, ?)', (pk, value))
+
+    @staticmethod
+    def _json_default(value):
+        if isinstance(value, datetime):
+            return value.strftime(DATE_FORMAT)
+        return _text(value)
+
+    def _delete_ids(self, conn, ids):
+        for doc_id in ids:
+            for pk, name, value in conn.execute(
+                    'SELECT pk, name, value FROM fields WHERE doc_id = ?', (doc_id,)).fetchall():
+                if field_type(name) == 'text':
+                    # FTS5 needs the old value to remove it from its index
+                    conn.execute("INSERT INTO fts (fts, rowid, value) VALUES ('delete', ?, ?)",
+                                 (pk, value))
+            conn.execute('DELETE FROM fields WHERE doc_id = ?', (doc_id,))
+            conn.execute('DELETE FROM docs WHERE id = ?', (doc_id,))
+
+    def delete(self, id=None, q=None, commit=True, **kw):
+        if id is None and q is None:
+            raise ValueError('You must specify "id" or "q".')
+        conn, lock = self._connection()
+        with lock, conn:
+            if id is not None:
+                ids = id if isinstance(id, (list, tuple)) else [id]
+            else:
+                where, params, _ = self._where(q, [], {})
+                ids = [row[0] for row in conn.execute(
+                    'SELECT docs.id FROM docs WHERE ' + where, params)]
+            self._delete_ids(conn, [_text(i) for i in ids])
+
+    def update_fields(self, docs, commit=True, **kw):
+        conn, lock = self._connection()
+        with lock:
+            updated = []
+            for doc in docs:
+                row = conn.execute('SELECT doc FROM docs WHERE id = ?', (_text(doc['id']),)).fetchone()
+                if row is None:
+                    continue
+                stored = json.loads(row[0])
+                for name, value in doc.iteritems():
+                    if value is None:
+                        stored.pop(name, None)
+                    else:
+                        stored[name] = value
+                updated.append(stored)
+            self.add(updated)
+
+    def delete_ids(self, ids, commit=True, **kw):
+        self.delete(id=list(ids))
+
+    def commit(self, *args, **kw):
+        pass
+
+    def optimize(self, *args, **kw):
+        self._execute("INSERT INTO fts (fts) VALUES ('optimize')")
+
+    def _where(self, q, fq, params):
+        """Compile ``q`` and the ``fq`` filters to a WHERE clause on docs.
+        Returns (sql, parameters, the positive text terms of ``q`` for scoring
+        and highlighting).
+        """
+        if params.get('qt') == 'dismax' or params.get('defType') in ('dismax', 'edismax'):
+            qf = params.get('qf') or 'text'
+            parser = QueryParser([f.split('^')[0] for f in qf.split()], required=True)
+        else:
+            parser = QueryParser([params.get('df', 'text')])
+        sql, args, terms = [], [], []
+        if q and q.strip():
+            query = parser.parse(q)
+            self._text_terms(query, terms)
+            sql.append(self._compile(query, args))
+        for f in fq or []:
+            sql.append(self._compile(QueryParser().parse(f), args))
+        return ' AND '.join(sql) or '1', args, terms
+
+    def _compile(self, query, args):
+        kind = query[0]
+        if kind == 'all':
+            return '1'
+        if kind == 'term':
+            _, field, value, term_kind = query
+            if field_type(field) == 'text':
+                match = fts_query(value, term_kind)
+                if match is None:
+                    return '0'
+                args.extend([match, field])
+                return ('docs.id IN (SELECT f.doc_id FROM fts JOIN fields f ON f.pk = fts.rowid '
+                        'WHERE fts MATCH ? AND f.name = ?)')
+            if term_kind in ('prefix', 'wildcard'):
+                if term_kind == 'prefix':
+                    pattern = re.sub(r'([*?\[])', r'[\1]', value) + '*'
+                else:
+                    pattern = re.sub(r'(\[)', r'[\1]', value)
+                args.extend([field, pattern])
+                return 'docs.id IN (SELECT doc_id FROM fields WHERE name = ? AND value GLOB ?)'
+            args.extend([field, query_value(field, value)])
+            return 'docs.id IN (SELECT doc_id FROM fields WHERE name = ? AND value = ?)'
+        if kind == 'range':
+            _, field, low, high, include_low, include_high = query
+            conditions = ['name = ?']
+            args.append(field)
+            if low is not None:
+                conditions.append('value >=' if include_low else 'value >')
+                args.append(query_value(field, low))
+            if high is not None:
+                conditions.append('value <=' if include_high else 'value <')
+                args.append(query_value(field, high))
+            return 'docs.id IN (SELECT doc_id FROM fields WHERE %s)' % ' AND '.join(
+                c if c == 'name = ?' else c + ' ?' for c in conditions)
+        clauses = query[1]
+        must = [self._compile(c, args) for o, c in clauses if o == MUST]
+        should = [self._compile(c, args) for o, c in clauses if o == SHOULD]
+        must_not = [self._compile(c, args) for o, c in clauses if o == MUST_NOT]
+        sql = must[:]
+        if should and not must:
+            sql.append('(%s)' % ' OR '.join(should))
+        sql.extend('NOT (%s)' % c for c in must_not)
+        return '(%s)' % (' AND '.join(sql) or '1')
+
+    def _text_terms(self, query, terms, negated=False):
+        if query[0] == 'term' and not negated and field_type(query[1]) == 'text':
+            match = fts_query(query[2], query[3])
+            if match is not None:
+                terms.append((query[1], match))
+        elif query[0] == 'bool':
+            for occur, clause in query[1]:
+                self._text_terms(clause, terms, negated or occur == MUST_NOT)
+
+    def search(self, q, **kw):
+        where, args, terms = self._where(q, _as_list(kw.get('fq')), kw)
+        rows = int(kw.get('rows', 10))
+        start = int(kw.get('start', 0))
+        conn, lock = self._connection()
+        with lock:
+            hits = conn.execute('SELECT count(*) FROM docs WHERE ' + where, args).fetchone()[0]
+            docs = []
+            if rows > 0:
+                scores, score_args = self._scores(terms, kw.get('qf'))
+                order, order_args = self._order_by(kw.get('sort') or 'score desc')
+                page = conn.execute(
+                    '%s SELECT docs.id, docs.doc, %s AS score FROM docs %s '
+                    'WHERE %s ORDER BY %s LIMIT ? OFFSET ?' % (
+                        scores,
+                        'coalesce(scores.score, 0)' if scores else '0',
+                        'LEFT JOIN scores ON scores.id = docs.id' if scores else '',
+                        where, order),
+                    score_args + args + order_args + [rows, start]).fetchall()
+                docs = [self._load_doc(doc, score, kw.get('fl')) for _, doc, score in page]
+            facets = {'facet_fields': {}, 'facet_queries': {}}
+            if str(kw.get('facet', '')).lower() == 'true':
+                for field in _as_list(kw.get('facet.field')):
+                    facets['facet_fields'][field] = self._facet(conn, field, where, args, kw)
+            highlighting = {}
+            if str(kw.get('hl', '')).lower() == 'true' and docs and terms:
+                highlighting = self._highlight(conn, [d['id'] for d in docs], terms, kw)
+        return Results(docs, hits, highlighting=highlighting, facets=facets)
+
+    def _scores(self, terms, qf):
+        """A ``scores`` CTE of doc id and relevance score, from FTS5's bm25 of
+        the query's text terms (weighted by the boosts in ``qf``)"""
+        if not terms:
+            return '', []
+        boosts = dict((f.split('^')[0], float(f.split('^')[1]) if '^' in f else 1.0)
+                      for f in (qf or '').split())
+        match = u' OR '.join(sorted(set(m for f, m in terms)))
+        fields = sorted(set(f for f, m in terms))
+        weights = ' '.join('WHEN %s THEN %r' % (_sql_str(f), boosts.get(f, 1.0)) for f in fields)
+        return ('WITH matches AS (SELECT rowid AS pk, -rank AS rank FROM fts WHERE fts MATCH ?), '
+                'scores AS (SELECT f.doc_id AS id, '
+                'sum(matches.rank * CASE f.name %s ELSE 0 END) AS score '
+                'FROM matches JOIN fields f ON f.pk = matches.pk GROUP BY f.doc_id)' % weights), [match]
+
+    def _order_by(self, sort):
+        order, args = [], []
+        for part in sort.split(','):
+            bits = part.split()
+            if not bits:
+                continue
+            field, direction = bits[0], (bits[1] if len(bits) > 1 else 'asc').upper()
+            if direction not in ('ASC', 'DESC'):
+                raise SolrError('Invalid sort %r' % sort)
+            if field == 'score':
+                order.append('score ' + direction)
+                continue
+            value = '(SELECT %s(value) FROM fields WHERE doc_id = docs.id AND name = ?)' % (
+                'min' if direction == 'ASC' else 'max')
+            # missing values sort last, like the solr schema's sortMissingLast
+            order.append('%s IS NULL, %s %s' % (value, value, direction))
+            args.extend([field, field])
+        order.append('docs.id')
+        return ', '.join(order), args
+
+    def _load_doc(self, doc, score, fl):
+        doc = json.loads(doc)
+        for name, value in doc.items():
+            if field_type(name) == 'date':
+                if isinstance(value, list):
+                    doc[name] = [parse_date(v) for v in value]
+                else:
+                    doc[name] = parse_date(value)
+        if fl:
+            fields = set(re.split(r'[\s,]+', fl.strip()))
+            if '*' not in fields:
+                doc = dict((k, v) for k, v in doc.iteritems() if k in fields)
+            if 'score' in fields:
+                doc['score'] = score
+        return doc
+
+    def _facet(self, conn, field, where, args, kw):
+        def param(name, default):
+            return kw.get('f.%s.facet.%s' % (field, name), kw.get('facet.' + name, default))
+        limit = int(param('limit', 100))
+        mincount = int(param('mincount', 0))
+        sort = param('sort', 'count' if limit > 0 else 'index')
+        order = 'value' if sort == 'index' else 'count(DISTINCT doc_id) DESC, value'
+        rows = conn.execute(
+            'SELECT value, count(DISTINCT doc_id) FROM fields WHERE name = ? AND '
+            'doc_id IN (SELECT docs.id FROM docs WHERE %s) GROUP BY value HAVING count(DISTINCT doc_id) >= ? '
+            'ORDER BY %s%s' % (where, order, ' LIMIT %d' % limit if limit >= 0 else ''),
+            [field] + args + [max(mincount, 1)]).fetchall()
+        result = []
+        for value, count in rows:
+            result.extend([value, count])
+        return result
+
+    def _highlight(self, conn, ids, terms, kw):
+        fields = re.split(r'[\s,]+', kw.get('hl.fl') or '') if kw.get('hl.fl') else \
+            [f.split('^')[0] for f in (kw.get('qf') or 'text').split()]
+        match = u' OR '.join(sorted(set(m for f, m in terms)))
+        rows = conn.execute(
+            'SELECT f.doc_id, f.name, snippet(fts, 0, ?, ?, ?, 32) '
+            'FROM fts JOIN fields f ON f.pk = fts.rowid '
+            'WHERE fts MATCH ? AND f.doc_id IN (%s) AND f.name IN (%s)' % (
+                ','.join('?' * len(ids)), ','.join('?' * len(fields))),
+            [kw.get('hl.simple.pre', '<em>'), kw.get('hl.simple.post', '</em>'), u'\u2026', match]
+            + ids + fields).fetchall()
+        highlighting = dict((doc_id, {}) for doc_id in ids)
+        for doc_id, field, snippet in rows:
+            highlighting[doc_id].setdefault(field, []).append(snippet)
+        return highlighting
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, basestring):
+        return [value]
+    return list(value)
+
+
+def _sql_str(value):
+    return "'%s'" % value.replace("'", "''")
@@ -18,6 +18,7 @@
 
 import time
 import string
+import threading
 import hashlib
 import binascii
 import logging.handlers
@@ -55,6 +56,8 @@
 from ming.odm.odmsession import ODMCursor
 
 
+log = logging.getLogger(__name__)
+
 MARKDOWN_EXTENSIONS = ['.markdown', '.mdown', '.mkdn', '.mkd', '.md']
 
 
@@ -450,6 +453,125 @@ def __keytransform__(self, key):
         return key.lower()
 
 
+class LRUCache(object):
+
+    """
+    A thread-safe, size-bounded mapping which discards the least recently
+    used entries first.  If ``ttl`` (seconds) is given, entries older than
+    that are treated as missing.
+
+    Keeps ``hits`` and ``misses`` counts of :meth:`get` calls.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (None, default))[1]
+
+    def discard_where(self, predicate):
+        """Remove all entries whose key matches ``predicate(key)``"""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CircuitBreaker(object):
+
+    """
+    Stops calls to a failing service for a while, so that they fail fast
+    instead of each waiting for a timeout.
+
+    Callers check :meth:`allow` before each call and :meth:`record` its
+    outcome.  After ``max_failures`` failed calls (or ones slower than
+    ``slow`` seconds) within ``window`` seconds, the breaker opens and
+    :meth:`allow` is False for ``reset_timeout`` seconds.  Then a single
+    trial call is allowed; the breaker closes again if it succeeds.
+    """
+
+    def __init__(self, name, max_failures=5, window=60, slow=None, reset_timeout=30):
+        self.name = name
+        self.max_failures = max_failures
+        self.window = window
+        self.slow = slow
+        self.reset_timeout = reset_timeout
+        self.opened = None
+        self._trial = False
+        self._failures = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+            if self._trial or time.time() < self.opened + self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record(self, elapsed, failed=False):
+        """Record a call which took ``elapsed`` seconds"""
+        failed = failed or bool(self.slow and elapsed > self.slow)
+        now = time.time()
+        with self._lock:
+            if self._trial:
+                self._trial = False
+                if failed:
+                    self.opened = now
+                else:
+                    log.info('%s circuit breaker closed', self.name)
+                    self.opened = None
+                    self._failures.clear()
+                return
+            if not failed or self.opened is not None:
+                return
+            self._failures.append(now)
+            while self._failures[0] < now - self.window:
+                self._failures.popleft()
+            if len(self._failures) >= self.max_failures:
+                log.warning('%s circuit breaker opened after %s failures',
+                            self.name, len(self._failures))
+                self.opened = now
+
+
 def postmortem_hook(etype, value, tb):  # pragma no cover
     import sys
     import pdb
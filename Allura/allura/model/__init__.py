@@ -21,7 +21,7 @@
 
 from .neighborhood import Neighborhood, NeighborhoodFile
 from .project import Project, ProjectCategory, TroveCategory, ProjectFile, AppConfig
-from .index import ArtifactReference, Shortlink
+from .index import ArtifactReference, Shortlink, IndexQueue, ReindexCheckpoint
 from .artifact import Artifact, MovedArtifact, Message, VersionedArtifact, Snapshot, Feed, AwardFile, Award, AwardGrant
 from .artifact import VotableArtifact
 from .discuss import Discussion, Thread, PostHistory, Post, DiscussionAttachment
@@ -34,8 +34,9 @@
 from .repository import MergeRequest, GitLikeTree
 from .stats import Stats
 from .oauth import OAuthToken, OAuthConsumerToken, OAuthRequestToken, OAuthAccessToken
-from .monq_model import MonQTask
+from .monq_model import MonQTask, MonQSignal, MonQLanes, MonQMetrics
 from .webhook import Webhook
+from .markdown_cache import RenderedMarkdown, MarkdownRenderCache, PlainTextFallback
 
 from .types import ACE, ACL, EVERYONE, ALL_PERMISSIONS, DENY_ALL, MarkdownCache
 from .session import main_doc_session, main_orm_session
@@ -52,7 +53,8 @@
 
 __all__ = [
     'Neighborhood', 'NeighborhoodFile', 'Project', 'ProjectCategory', 'TroveCategory', 'ProjectFile', 'AppConfig',
-    'ArtifactReference', 'Shortlink', 'Artifact', 'MovedArtifact', 'Message', 'VersionedArtifact', 'Snapshot', 'Feed',
+    'ArtifactReference', 'Shortlink', 'IndexQueue', 'ReindexCheckpoint', 'Artifact', 'MovedArtifact', 'Message',
+    'VersionedArtifact', 'Snapshot', 'Feed',
     'AwardFile', 'Award', 'AwardGrant', 'VotableArtifact', 'Discussion', 'Thread', 'PostHistory', 'Post',
     'DiscussionAttachment', 'BaseAttachment', 'AuthGlobals', 'User', 'ProjectRole', 'EmailAddress', 'OldProjectRole',
     'AuditLog', 'audit_log', 'AlluraUserProperty', 'File', 'Notification', 'Mailbox', 'Repository',
@@ -60,4 +62,5 @@
     'OAuthRequestToken', 'OAuthAccessToken', 'MonQTask', 'Webhook', 'ACE', 'ACL', 'EVERYONE', 'ALL_PERMISSIONS',
     'DENY_ALL', 'MarkdownCache', 'main_doc_session', 'main_orm_session', 'project_doc_session', 'project_orm_session',
     'artifact_orm_session', 'repository_orm_session', 'task_orm_session', 'ArtifactSessionExtension', 'repository',
-    'repo_refresh', 'SiteNotification']
+    'repo_refresh', 'SiteNotification', 'MonQSignal', 'MonQLanes',
+    'MonQMetrics', 'RenderedMarkdown', 'MarkdownRenderCache', 'PlainTextFallback']
@@ -82,6 +82,7 @@ def before_save(data):
                 c.project.last_updated = datetime.utcnow()
 
     type_s = 'Generic Artifact'
+    index_hot_fields = ('mod_date_dt',)
 
     # Artifact base schema
     _id = FieldProperty(S.ObjectId)
@@ -164,8 +165,12 @@ def related_artifacts(self):
 
         """
         related_artifacts = []
-        for ref_id in self.refs + self.backrefs:
-            ref = ArtifactReference.query.get(_id=ref_id)
+        ref_ids = self.refs + self.backrefs
+        refs = ArtifactReference.query.find(dict(_id={'$in': ref_ids})).all()
+        ArtifactReference.load_many(refs)
+        refs = dict((ref._id, ref) for ref in refs)
+        for ref_id in ref_ids:
+            ref = refs.get(ref_id)
             if ref is None:
                 continue
             artifact = ref.artifact
@@ -17,14 +17,16 @@
 
 import re
 import logging
-from itertools import groupby
-from cPickle import dumps, loads
+import importlib
+from datetime import datetime
+from cPickle import loads
 from collections import defaultdict
 from urllib import unquote
 
 import bson
 import pymongo
-from pylons import tmpl_context as c
+from pylons import tmpl_context as c, app_globals as g
+from paste.deploy.converters import asint
 
 from ming import collection, Field, Index
 from ming import schema as S
@@ -33,9 +35,10 @@
 from ming.orm import ForeignIdProperty, RelationProperty
 
 from allura.lib import helpers as h
+from allura.lib.utils import LRUCache
 
 from .session import main_doc_session, main_orm_session
-from .project import Project
+from .project import Project, AppConfig
 
 log = logging.getLogger(__name__)
 
@@ -44,11 +47,15 @@
     'artifact_reference', main_doc_session,
     Field('_id', str),
     Field('artifact_reference', dict(
-        cls=S.Binary(),
+        # pickled class, in references made before cls_name
+        cls=S.Binary(if_missing=None),
+        cls_name=S.String(if_missing=None),  # see ArtifactClassRegistry
         project_id=S.ObjectId(),
         app_config_id=S.ObjectId(),
         artifact_id=S.Anything(if_missing=None))),
     Field('references', [str], index=True),
+    # hash of the artifact's index() as last sent to solr, see add_artifacts
+    Field('index_fingerprint', str, if_missing=None),
     Index('artifact_reference.project_id'),  # used in ReindexCommand
 )
 
@@ -66,9 +73,52 @@
     Index('project_id', 'link'),
 )
 
+IndexQueueDoc = collection(
+    'index_queue', main_doc_session,
+    Field('_id', str),  # ArtifactReference._id
+    Field('queued', datetime, index=True),
+)
+
+ReindexCheckpointDoc = collection(
+    'reindex_checkpoint', main_doc_session,
+    Field('_id', S.ObjectId()),
+    Field('run', str),
+    Field('project_id', S.ObjectId()),
+    Field('finished', datetime, if_missing=datetime.utcnow),
+    Index('run', 'project_id'),
+)
+
 # Class definitions
 
 
+class ArtifactClassRegistry(object):
+
+    '''Maps artifact classes to the names ArtifactReferences store for them,
+    ``module:ClassName``, and back.  A class that is moved or renamed can
+    :meth:`register` its old name, so existing references still load.'''
+
+    def __init__(self):
+        self._classes = {}
+
+    @staticmethod
+    def name(cls):
+        return '%s:%s' % (cls.__module__, cls.__name__)
+
+    def register(self, cls, *old_names):
+        for name in (self.name(cls),) + old_names:
+            self._classes[name] = cls
+
+    def get(self, name):
+        cls = self._classes.get(name)
+        if cls is None:
+            module, _, cls_name = name.partition(':')
+            cls = self._classes[name] = getattr(importlib.import_module(module), cls_name)
+        return cls
+
+
+artifact_classes = ArtifactClassRegistry()
+
+
 class ArtifactReference(object):
 
     @classmethod
@@ -81,7 +131,7 @@ def from_artifact(cls, artifact):
             obj = cls(
                 _id=artifact.index_id(),
                 artifact_reference=dict(
-                    cls=bson.Binary(dumps(artifact.__class__)),
+                    cls_name=artifact_classes.name(artifact.__class__),
                     project_id=artifact.app_config.project_id,
                     app_config_id=artifact.app_config._id,
                     artifact_id=artifact._id))
@@ -91,12 +141,70 @@ def from_artifact(cls, artifact):
             session(obj).expunge(obj)
             return cls.query.get(_id=artifact.index_id())
 
+    @classmethod
+    def _collection(cls):
+        '''The raw pymongo collection, for bulk operations'''
+        return main_doc_session.db[ArtifactReferenceDoc.m.collection_name]
+
+    @classmethod
+    def from_artifacts(cls, artifacts):
+        '''Bulk version of :meth:`from_artifact`: insert the missing
+        ArtifactReferences for ``artifacts`` with one query and one insert'''
+        coll = cls._collection()
+        ids = [a.index_id() for a in artifacts]
+        existing = set(doc['_id'] for doc in coll.find(
+            {'_id': {'$in': ids}}, fields=['_id']))
+        docs = []
+        for a, ref_id in zip(artifacts, ids):
+            if ref_id in existing:
+                continue
+            existing.add(ref_id)
+            docs.append(ArtifactReferenceDoc.make(dict(
+                _id=ref_id,
+                artifact_reference=dict(
+                    cls_name=artifact_classes.name(a.__class__),
+                    project_id=a.app_config.project_id,
+                    app_config_id=a.app_config._id,
+                    artifact_id=a._id))))
+        if docs:
+            try:
+                coll.insert(docs, continue_on_error=True)
+            except pymongo.errors.DuplicateKeyError:  # pragma no cover
+                pass  # created concurrently
+
+    @classmethod
+    def load_many(cls, refs):
+        '''Set the :attr:`artifact` of each of ``refs``, with one query per
+        artifact class instead of one per reference'''
+        groups = defaultdict(list)
+        for ref in refs:
+            if 'artifact' not in ref.__dict__:
+                aref = ref.artifact_reference
+                groups[aref.cls_name or str(aref.cls)].append(ref)
+        for group in groups.itervalues():
+            try:
+                artifact_cls = group[0].artifact_class
+                artifacts = dict((a._id, a) for a in artifact_cls.query.find(dict(
+                    _id={'$in': [r.artifact_reference.artifact_id for r in group]})))
+            except:
+                log.exception('Error loading artifacts for %s', [r._id for r in group])
+                continue
+            for ref in group:
+                ref.__dict__['artifact'] = artifacts.get(ref.artifact_reference.artifact_id)
+
+    @property
+    def artifact_class(self):
+        aref = self.artifact_reference
+        if aref.cls_name:
+            return artifact_classes.get(aref.cls_name)
+        return loads(str(aref.cls))
+
     @LazyProperty
     def artifact(self):
         '''Look up the artifact referenced'''
         aref = self.artifact_reference
         try:
-            cls = loads(str(aref.cls))
+            cls = self.artifact_class
             with h.push_context(aref.project_id):
                 return cls.query.get(_id=aref.artifact_id)
         except:
@@ -141,20 +249,59 @@ def from_artifact(cls, a):
             except pymongo.errors.DuplicateKeyError:  # pragma no cover
                 session(result).expunge(result)
                 result = cls.query.get(ref_id=a.index_id())
+        old_link = result.link
         result.link = a.shorthand_id()
         result.url = a.url()
+        cls.invalidate_cache(result.project_id, old_link, result.link)
         if result.link is None:
             result.delete()
             return None
         return result
 
+    @classmethod
+    def _collection(cls):
+        '''The raw pymongo collection, for bulk operations'''
+        return main_doc_session.db[ShortlinkDoc.m.collection_name]
+
+    @classmethod
+    def from_artifacts(cls, artifacts):
+        '''Bulk version of :meth:`from_artifact`: insert the missing
+        Shortlinks for ``artifacts`` at once, and only update existing ones
+        whose link or url changed'''
+        coll = cls._collection()
+        ref_ids = [a.index_id() for a in artifacts]
+        existing = dict((doc['ref_id'], doc) for doc in coll.find(
+            {'ref_id': {'$in': ref_ids}}, fields=['ref_id', 'link', 'url']))
+        docs = []
+        for a, ref_id in zip(artifacts, ref_ids):
+            link, url = a.shorthand_id(), a.url()
+            doc = existing.get(ref_id)
+            cls.invalidate_cache(a.app_config.project_id, doc and doc.get('link'), link)
+            if doc is None:
+                if link is not None:
+                    docs.append(ShortlinkDoc.make(dict(
+                        _id=bson.ObjectId(),
+                        ref_id=ref_id,
+                        project_id=a.app_config.project_id,
+                        app_config_id=a.app_config._id,
+                        link=link,
+                        url=url)))
+            elif link is None:
+                coll.remove({'_id': doc['_id']})
+            elif (doc.get('link'), doc.get('url')) != (link, url):
+                coll.update({'_id': doc['_id']},
+                            {'$set': dict(link=link, url=url)})
+        if docs:
+            coll.insert(docs)
+
     @classmethod
     def from_links(cls, *links):
         '''Convert a sequence of shortlinks to the matching Shortlink objects'''
         if len(links):
             result = {}
             # Parse all the links
-            parsed_links = dict((link, cls._parse_link(link))
+            projects = cls._link_projects(links)
+            parsed_links = dict((link, cls._parse_link(link, projects))
                                 for link in links)
             links_by_artifact = defaultdict(list)
             project_ids = set()
@@ -164,21 +311,13 @@ def from_links(cls, *links):
                     links_by_artifact[unquote(d['artifact'])].append(d)
                 else:
                     result[link] = parsed_links.pop(link)
-            q = cls.query.find(dict(
-                link={'$in': links_by_artifact.keys()},
-                project_id={'$in': list(project_ids)}
-            ), validate=False)
-            matches_by_artifact = dict(
-                (link, list(matches))
-                for link, matches in groupby(q, key=lambda s: unquote(s.link)))
+            matches_by_artifact = cls._find_matches(project_ids, links_by_artifact.keys())
             for link, d in parsed_links.iteritems():
                 matches = matches_by_artifact.get(unquote(d['artifact']), [])
                 matches = (
                     m for m in matches
                     if m.project.shortname == d['project'] and
-                    m.project.neighborhood_id == d['nbhd'] and
-                    m.app_config is not None and
-                    m.project.app_instance(m.app_config.options.mount_point))
+                    m.project.neighborhood_id == d['nbhd'])
                 if d['app']:
                     matches = (
                         m for m in matches
@@ -188,6 +327,98 @@ def from_links(cls, *links):
         else:
             return {}
 
+    @classmethod
+    def _find_matches(cls, project_ids, artifacts):
+        '''Return the Shortlinks in any of ``project_ids`` for any of the
+        (unquoted) ``artifacts`` links, whose tool is still installed, as a
+        dict of unquoted link -> Shortlinks'''
+        q = cls.query.find(dict(
+            link={'$in': list(artifacts)},
+            project_id={'$in': list(project_ids)}
+        ), validate=False)
+        matches = q.all()
+        # load the matches' projects and tools at once, so that the checks
+        # below find them in the identity map
+        if matches:
+            Project.query.find(dict(
+                _id={'$in': list(set(m.project_id for m in matches))})).all()
+            AppConfig.query.find(dict(
+                _id={'$in': list(set(m.app_config_id for m in matches))})).all()
+        matches_by_artifact = defaultdict(list)
+        for m in matches:
+            if m.app_config is not None and m.project.app_instance(m.app_config):
+                matches_by_artifact[unquote(m.link)].append(m)
+        return matches_by_artifact
+
+    @classmethod
+    def resolve_links(cls, *links):
+        '''Like :meth:`from_links`, but returns :class:`ShortlinkTarget`
+        objects, which are enough to render links with, and are kept in the
+        process-wide :class:`ShortlinkCache` (``g.shortlink_cache``) if it is
+        enabled'''
+        cache = getattr(g, 'shortlink_cache', None)
+        projects = cls._link_projects(links)
+        parsed_links = dict((link, cls._parse_link(link, projects))
+                            for link in links)
+        keys = set((d['project_id'], unquote(d['artifact']))
+                   for d in parsed_links.itervalues() if d)
+        targets = {}
+        if cache is not None:
+            for key in keys:
+                cached = cache.get(*key)
+                if cached is not None:
+                    targets[key] = cached
+        missing = keys.difference(targets)
+        if missing:
+            found = cls._find_targets(missing)
+            for key in missing:
+                targets[key] = tuple(found.get(key, ()))
+                if cache is not None:
+                    cache.set(key[0], key[1], targets[key])
+        result = {}
+        for link, d in parsed_links.iteritems():
+            if not d:
+                result[link] = None
+                continue
+            matches = [
+                t for t in targets[(d['project_id'], unquote(d['artifact']))]
+                if t.project_shortname == d['project'] and
+                t.neighborhood_id == d['nbhd'] and
+                (not d['app'] or t.mount_point == d['app'])]
+            result[link] = cls._get_correct_match(link, matches)
+        return result
+
+    @classmethod
+    def _find_targets(cls, keys):
+        '''Return a dict of (project_id, unquoted link) -> ShortlinkTargets
+        for the Shortlinks matching ``keys``'''
+        matches_by_artifact = cls._find_matches(
+            set(p for p, _ in keys), set(link for _, link in keys))
+        matches = [m for ms in matches_by_artifact.itervalues() for m in ms]
+        if not matches:
+            return {}
+        refs = ArtifactReference.query.find(dict(
+            _id={'$in': list(set(m.ref_id for m in matches))})).all()
+        ArtifactReference.load_many(refs)
+        refs = dict((ref._id, ref) for ref in refs)
+        targets = defaultdict(list)
+        for link, ms in matches_by_artifact.iteritems():
+            for m in ms:
+                if (m.project_id, link) in keys:
+                    targets[(m.project_id, link)].append(
+                        ShortlinkTarget(m, refs.get(m.ref_id)))
+        return targets
+
+    @classmethod
+    def invalidate_cache(cls, project_id, *links):
+        '''Drop cached :meth:`resolve_links` results for ``links`` in the
+        project'''
+        cache = getattr(g, 'shortlink_cache', None)
+        if cache is not None:
+            for link in links:
+                if link is not None:
+                    cache.invalidate(project_id, link)
+
     @classmethod
     def _get_correct_match(cls, link, matches):
         result = None
@@ -214,14 +445,40 @@ def log_ambiguous_link(cls, msg, matches, *args):
             log.warn('... %r', m)
 
     @classmethod
-    def _parse_link(cls, s):
-        '''Parse a shortlink into its nbhd/project/app/artifact parts'''
+    def _split_link(cls, s):
         s = s.strip()
         if s.startswith('['):
             s = s[1:]
         if s.endswith(']'):
             s = s[:-1]
-        parts = s.split(':')
+        return s.split(':')
+
+    @classmethod
+    def _link_projects(cls, links):
+        '''Look up the projects named by any fully qualified ``links`` at once.
+        Returns a dict of shortname -> project _id.'''
+        shortnames = set()
+        for link in links:
+            parts = cls._split_link(link)
+            if len(parts) == 3:
+                shortnames.add(parts[0])
+        if not shortnames:
+            return {}
+        p_nbhd = None
+        if getattr(c, 'project', None):
+            p_nbhd = c.project.neighborhood_id
+        q = Project.query.find(dict(
+            shortname={'$in': list(shortnames)}, neighborhood_id=p_nbhd))
+        return dict((p.shortname, p._id) for p in q)
+
+    @classmethod
+    def _parse_link(cls, s, projects=None):
+        '''Parse a shortlink into its nbhd/project/app/artifact parts
+
+        :param projects: shortname -> project _id, as returned by
+          :meth:`_link_projects`, to avoid looking up the project here
+        '''
+        parts = cls._split_link(s)
         p_shortname = None
         p_id = None
         p_nbhd = None
@@ -230,9 +487,12 @@ def _parse_link(cls, s):
             p_id = getattr(c.project, '_id', None)
             p_nbhd = c.project.neighborhood_id
         if len(parts) == 3:
-            p = Project.query.get(shortname=parts[0], neighborhood_id=p_nbhd)
-            if p:
-                p_id = p._id
+            if projects is None:
+                p = Project.query.get(shortname=parts[0], neighborhood_id=p_nbhd)
+                if p:
+                    p_id = p._id
+            else:
+                p_id = projects.get(parts[0], p_id)
             return dict(
                 nbhd=p_nbhd,
                 project=parts[0],
@@ -256,6 +516,159 @@ def _parse_link(cls, s):
         else:
             return None
 
+
+class ShortlinkTarget(object):
+
+    '''What a :class:`Shortlink` resolves to, as returned by
+    :meth:`Shortlink.resolve_links`: enough to render a link to the artifact
+    without loading it.  Unlike Shortlinks these aren't tied to a session,
+    so they can be shared between requests.'''
+
+    def __init__(self, shortlink, ref):
+        self.ref_id = shortlink.ref_id
+        self.project_id = shortlink.project_id
+        self.app_config_id = shortlink.app_config_id
+        self.link = shortlink.link
+        self.url = shortlink.url
+        self.project_shortname = shortlink.project.shortname
+        self.neighborhood_id = shortlink.project.neighborhood_id
+        self.mount_point = shortlink.app_config.options.mount_point
+        artifact = ref.artifact if ref is not None else None
+        # missing artifacts (but not ones that fail to load) count as deleted
+        self.deleted = ref is None or bool(getattr(artifact, 'deleted', False))
+        self.is_closed = bool(getattr(artifact, 'is_closed', False))
+
+    def __repr__(self):
+        return '<ShortlinkTarget %s %s %s -> %s>' % (
+            self.project_id,
+            self.app_config_id,
+            self.link,
+            self.ref_id)
+
+    @property
+    def ref(self):
+        return ArtifactReference.query.get(_id=self.ref_id)
+
+
+class ShortlinkCache(object):
+
+    '''
+    Caches what shortlinks resolve to in this process (see
+    :meth:`Shortlink.resolve_links`), so that rendering the links that are
+    on many pages doesn't look them up every time.
+
+    Keyed by ``(project_id, link)``, each entry holds that link's
+    :class:`ShortlinkTarget` candidates in the project, or none if there is
+    no such artifact.  :meth:`Shortlink.from_artifact` and
+    :func:`~allura.tasks.index_tasks.del_artifacts` drop the entries they
+    change, but only in their own process; other processes see the change
+    once the entry expires after ``ttl`` seconds.
+    '''
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self._targets = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    @classmethod
+    def from_config(cls, config):
+        """Return a cache as configured by the ``shortlink_cache.*``
+        settings, or None if ``shortlink_cache.size`` isn't set."""
+        size = asint(config.get('shortlink_cache.size') or 0)
+        if size <= 0:
+            return None
+        return cls(size, float(config.get('shortlink_cache.ttl') or 60))
+
+    @property
+    def hits(self):
+        return self._targets.hits
+
+    @property
+    def misses(self):
+        return self._targets.misses
+
+    def get(self, project_id, link):
+        return self._targets.get((str(project_id), unquote(link)))
+
+    def set(self, project_id, link, targets):
+        self._targets.set((str(project_id), unquote(link)), tuple(targets))
+
+    def invalidate(self, project_id, link):
+        self._targets.pop((str(project_id), unquote(link)))
+
+    def clear(self):
+        self._targets.clear()
+
+    def __len__(self):
+        return len(self._targets)
+
+
+class IndexQueue(object):
+
+    '''ArtifactReference ids waiting to be added to solr in a batch by
+    :func:`allura.tasks.index_tasks.drain_index_queue`.  Keyed by the
+    reference id, so repeated edits of an artifact before it is indexed only
+    queue it once.'''
+
+    @classmethod
+    def add(cls, ref_ids):
+        '''Queue ``ref_ids`` (again), with one update and one insert'''
+        if not ref_ids:
+            return
+        now = datetime.utcnow()
+        coll = IndexQueueDoc.m.collection
+        coll.update({'_id': {'$in': ref_ids}}, {'$set': {'queued': now}}, multi=True)
+        existing = set(doc['_id'] for doc in coll.find(
+            {'_id': {'$in': ref_ids}}, fields=['_id']))
+        docs = [dict(_id=ref_id, queued=now)
+                for ref_id in sorted(set(ref_ids) - existing)]
+        if docs:
+            try:
+                coll.insert(docs, continue_on_error=True)
+            except pymongo.errors.DuplicateKeyError:  # pragma no cover
+                pass  # queued concurrently
+
+    @classmethod
+    def pending(cls, before, limit, exclude=None):
+        '''Ids of up to ``limit`` references queued before a certain datetime,
+        except those in ``exclude``'''
+        query = {'queued': {'$lt': before}}
+        if exclude:
+            query['_id'] = {'$nin': list(exclude)}
+        return [doc['_id'] for doc in IndexQueueDoc.m.find(query).sort('queued').limit(limit)]
+
+    @classmethod
+    def remove(cls, ref_ids, before):
+        '''Take indexed references off the queue, unless they were queued
+        again since ``before``'''
+        IndexQueueDoc.m.remove({'_id': {'$in': ref_ids}, 'queued': {'$lt': before}})
+
+    @classmethod
+    def count(cls):
+        return IndexQueueDoc.m.find().count()
+
+
+class ReindexCheckpoint(object):
+
+    '''Projects finished by a run of
+    :class:`allura.command.show_models.ReindexCommand`, so that an interrupted
+    run can be resumed.  ``run`` identifies the options of the run.'''
+
+    @classmethod
+    def done(cls, run):
+        '''Ids of the projects finished by ``run``'''
+        return set(doc['project_id']
+                   for doc in ReindexCheckpointDoc.m.find({'run': run}))
+
+    @classmethod
+    def add(cls, run, project_id):
+        ReindexCheckpointDoc.m.update_partial(
+            {'run': run, 'project_id': project_id},
+            {'$set': {'finished': datetime.utcnow()}}, upsert=True)
+
+    @classmethod
+    def clear(cls, run):
+        ReindexCheckpointDoc.m.remove({'run': run})
+
+
 # Mapper definitions
 mapper(ArtifactReference, ArtifactReferenceDoc, main_orm_session)
 mapper(Shortlink, ShortlinkDoc, main_orm_session, properties=dict(
@@ -265,3 +678,5 @@ def _parse_link(cls, s):
     project=RelationProperty('Project'),
     app_config=RelationProperty('AppConfig'),
     ref=RelationProperty(ArtifactReference)))
+mapper(IndexQueue, IndexQueueDoc, main_orm_session)
+mapper(ReindexCheckpoint, ReindexCheckpointDoc, main_orm_session)
@@ -0,0 +1,188 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import logging
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+import pymongo
+from pylons import tmpl_context as c
+from paste.deploy.converters import asint
+
+from ming import collection, Field
+
+from allura.lib import helpers as h
+from allura.lib.utils import LRUCache
+
+from .session import main_doc_session
+
+log = logging.getLogger(__name__)
+
+RenderedMarkdownDoc = collection(
+    'rendered_markdown', main_doc_session,
+    Field('_id', str),  # MarkdownRenderCache.key()
+    Field('flavor', str),
+    Field('html', str),
+    Field('fallback', bool, if_missing=False),
+    Field('created', datetime, index=True),
+)
+
+
+class PlainTextFallback(h.html.literal):
+
+    '''Markdown source shown as plain text because its rendering timed out.
+    It may be cached for a while like a rendering, but is never stored as an
+    artifact's ``*_cache``, see
+    :meth:`allura.lib.app_globals.ForgeMarkdown.cached_convert`.'''
+
+
+class RenderedMarkdown(object):
+
+    '''Markdown renderings shared by all processes, see
+    :class:`MarkdownRenderCache`.'''
+
+    @classmethod
+    def get(cls, key, max_age=None):
+        '''The html stored for ``key``, or None if there is none or it was
+        stored more than ``max_age`` seconds ago'''
+        query = {'_id': key}
+        if max_age:
+            query['created'] = {
+                '$gt': datetime.utcnow() - timedelta(seconds=max_age)}
+        doc = RenderedMarkdownDoc.m.find(query).first()
+        if doc is None:
+            return None
+        return PlainTextFallback(doc['html']) if doc.get('fallback') else doc['html']
+
+    @classmethod
+    def set(cls, key, flavor, html):
+        RenderedMarkdownDoc.m.update_partial(
+            {'_id': key},
+            {'$set': {'flavor': flavor, 'html': html,
+                      'fallback': isinstance(html, PlainTextFallback),
+                      'created': datetime.utcnow()}},
+            upsert=True)
+
+    @classmethod
+    def trim(cls, maxsize):
+        '''Remove the oldest renderings, keeping at most ``maxsize``'''
+        oldest = RenderedMarkdownDoc.m.find().sort(
+            'created', pymongo.DESCENDING).skip(maxsize).limit(1).first()
+        if oldest:
+            RenderedMarkdownDoc.m.remove({'created': {'$lte': oldest['created']}})
+
+    @classmethod
+    def count(cls):
+        return RenderedMarkdownDoc.m.find().count()
+
+
+class MarkdownRenderCache(object):
+
+    '''
+    Caches the html :meth:`allura.lib.app_globals.ForgeMarkdown.convert`
+    renders, keyed by the md5 of the source, so that the same text (the
+    same ticket description on a list page, the same commit message in
+    several repos' logs, ...) is only rendered once.
+
+    The key also has the converter's ``flavor`` (the options it was made
+    with), its ``cache_bugfix_rev``, and the current project and tool, which
+    relative links are rendered against.  Sources with macros aren't cached
+    at all, as macros render content that changes independently of the
+    source.
+
+    Renderings are kept for ``ttl`` seconds, since the links in them (e.g. to
+    a since deleted artifact) may render differently later.  Up to
+    ``maxsize`` of them are kept in this process and, if ``shared_size`` is
+    given, up to that many in the ``rendered_markdown`` collection for all
+    processes.
+    '''
+
+    # trim the shared collection every this many sets
+    trim_interval = 100
+
+    def __init__(self, maxsize=5000, ttl=300, shared_size=0):
+        self.ttl = ttl
+        self.shared_size = shared_size
+        self._html = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._stats = defaultdict(lambda: dict(hits=0, misses=0))
+        self._lock = threading.Lock()
+        self._sets = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Return a cache as configured by the ``markdown_render_cache.*``
+        settings, or None if ``markdown_render_cache.size`` isn't set."""
+        size = asint(config.get('markdown_render_cache.size') or 0)
+        if size <= 0:
+            return None
+        return cls(size,
+                   ttl=float(config.get('markdown_render_cache.ttl') or 300),
+                   shared_size=asint(config.get('markdown_render_cache.shared_size') or 0))
+
+    @staticmethod
+    def cacheable(source):
+        return '[[' not in source
+
+    def key(self, source, flavor, bugfix_rev):
+        project = getattr(c, 'project', None)
+        app = getattr(c, 'app', None)
+        context = '%s/%s' % (getattr(project, '_id', None),
+                             getattr(getattr(app, 'config', None), '_id', None))
+        md5 = hashlib.md5(h.really_unicode(source).encode('utf-8')).hexdigest()
+        return ':'.join([md5, flavor, str(bugfix_rev), context])
+
+    def get(self, key, flavor):
+        html = self._html.get(key)
+        if html is None and self.shared_size:
+            try:
+                html = RenderedMarkdown.get(key, max_age=self.ttl)
+            except Exception:
+                log.warn('Could not read shared markdown rendering', exc_info=True)
+            if html is not None:
+                self._html.set(key, html)
+        with self._lock:
+            self._stats[flavor]['hits' if html is not None else 'misses'] += 1
+        return html
+
+    def set(self, key, flavor, html):
+        self._html.set(key, html)
+        if not self.shared_size:
+            return
+        try:
+            RenderedMarkdown.set(key, flavor, html)
+            with self._lock:
+                self._sets += 1
+                trim = self._sets % self.trim_interval == 0
+            if trim:
+                RenderedMarkdown.trim(self.shared_size)
+        except Exception:
+            log.warn('Could not store shared markdown rendering', exc_info=True)
+
+    @property
+    def stats(self):
+        '''Hits and misses per flavor'''
+        with self._lock:
+            return dict((flavor, dict(counts))
+                        for flavor, counts in self._stats.iteritems())
+
+    def clear(self):
+        self._html.clear()
+
+    def __len__(self):
+        return len(self._html)
@@ -17,25 +17,35 @@
 
 import sys
 import time
+import json
+import fnmatch
+import hashlib
+import threading
 import traceback
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
 
+import bson
 import pymongo
+from gridfs import GridFS
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint, aslist
 
 import ming
 from ming.utils import LazyProperty
 from ming import schema as S
-from ming.orm import session, FieldProperty
+from ming.orm import session, mapper, FieldProperty
+# ``state`` is also a task field, and the name of arguments below
+from ming.orm import state as orm_state
 from ming.orm.declarative import MappedClass
 
-from allura.lib.helpers import log_output, null_contextmanager
-from .session import task_orm_session
+from allura.lib.helpers import log_output, null_contextmanager, log_action
+from .session import task_orm_session, task_doc_session
 
 log = logging.getLogger(__name__)
+stats_log = log_action(log, 'task')
 
 
 class MonQTask(MappedClass):
@@ -58,8 +68,16 @@ class MonQTask(MappedClass):
         - args - ``*args`` to be sent to the task function
         - kwargs - ``**kwargs`` to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - dedup_key - if set, posting another task with the same key while this
+          one is still ready reuses this task instead
+        - lane - name of the :class:`MonQLanes` lane the task belongs to
+        - args_file - if set, args and kwargs were too big to keep in the task
+          document, and are stored in this GridFS file instead
+        - retries - how many times the task has failed and been queued again,
+          under the ``max_retries`` policy of its ``@task`` decorator
     '''
     states = ('ready', 'busy', 'error', 'complete', 'skipped')
+    finished_states = ('complete', 'skipped', 'error')
     result_types = ('keep', 'forget')
 
     class __mongometa__:
@@ -77,6 +95,25 @@ class __mongometa__:
                 # used by repo tarball status check, etc
                 'state', 'task_name', 'time_queue'
             ],
+            [
+                # used in MonQTask.get() by taskd workers limited to some lanes
+                ('state', ming.ASCENDING),
+                ('lane', ming.ASCENDING),
+                ('priority', ming.DESCENDING),
+                ('time_queue', ming.ASCENDING)
+            ],
+            [
+                # used by MonQTask.archive() and MonQMetrics.collect()
+                'state', 'time_stop'
+            ],
+        ]
+        custom_indexes = [
+            # used by MonQTask.post() to find a pending task to reuse, and
+            # unique so that concurrent posts can't both create one.  Only
+            # ready tasks with a key are indexed, so the index stays small
+            dict(fields=('dedup_key',), unique=True,
+                 partialFilterExpression={'state': 'ready',
+                                          'dedup_key': {'$type': 'string'}}),
         ]
 
     _id = FieldProperty(S.ObjectId)
@@ -97,6 +134,10 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None: None})
     result = FieldProperty(None, if_missing=None)
+    dedup_key = FieldProperty(str, if_missing=None)
+    lane = FieldProperty(str, if_missing=None)
+    args_file = FieldProperty(S.ObjectId, if_missing=None)
+    retries = FieldProperty(int, if_missing=0)
 
     def __repr__(self):
         from allura import model as M
@@ -121,6 +162,10 @@ def __repr__(self):
             app_mount,
             username)
 
+    # taskd threads in one process claim batches under the same process name,
+    # so they must not do it concurrently (see get_many)
+    _claim_lock = threading.Lock()
+
     @LazyProperty
     def function(self):
         '''The function that is called by this task'''
@@ -129,21 +174,53 @@ def function(self):
         return getattr(cur, sfunc)
 
     @classmethod
-    def post(cls,
-             function,
-             args=None,
-             kwargs=None,
-             result_type='forget',
-             priority=10,
-             delay=0):
-        '''Create a new task object based on the current context.'''
-        if args is None:
-            args = ()
-        if kwargs is None:
-            kwargs = {}
-        task_name = '%s.%s' % (
-            function.__module__,
-            function.__name__)
+    def _collection(cls):
+        '''The raw pymongo collection, for bulk operations'''
+        return task_doc_session.db[mapper(cls).collection.m.collection_name]
+
+    @classmethod
+    def _args_fs(cls):
+        '''GridFS store for args and kwargs too big to keep in the task document'''
+        return GridFS(task_doc_session.db, mapper(cls).collection.m.collection_name + '_args')
+
+    @classmethod
+    def _spill_args(cls, task_name, args, kwargs):
+        '''Store ``args`` and ``kwargs`` in GridFS if they would take more than
+        ``monq.args_spill_size`` bytes of the task document, so the queue stays
+        small and huge argument lists don't hit the BSON document size limit.
+        Returns the args, kwargs and ``args_file`` to put on the task.'''
+        limit = asint(config.get('monq.args_spill_size', 256 * 1024))
+        if not limit:
+            return args, kwargs, None
+        try:
+            data = bson.BSON.encode(dict(args=list(args), kwargs=kwargs))
+        except (bson.errors.InvalidDocument, TypeError):
+            # leave it to the task insert to report
+            return args, kwargs, None
+        if len(data) <= limit:
+            return args, kwargs, None
+        file_id = cls._args_fs().put(data, filename=task_name)
+        return (), {}, file_id
+
+    def _load_args(self):
+        '''The task's args and kwargs, from GridFS if they were spilled there'''
+        if self.args_file is None:
+            return self.args, self.kwargs
+        doc = bson.BSON(self._args_fs().get(self.args_file).read()).decode()
+        return doc['args'], doc['kwargs']
+
+    @classmethod
+    def _remove_args_files(cls, docs):
+        '''Delete the spilled args of tasks that are being removed'''
+        fs = None
+        for doc in docs:
+            if doc.get('args_file'):
+                fs = fs or cls._args_fs()
+                fs.delete(doc['args_file'])
+
+    @classmethod
+    def _context(cls):
+        '''The task context to record for the current c.project/app/user'''
         context = dict(
             project_id=None,
             app_config_id=None,
@@ -157,6 +234,73 @@ def post(cls,
             context['app_config_id'] = c.app.config._id
         if getattr(c, 'user', None):
             context['user_id'] = c.user._id
+        return context
+
+    @classmethod
+    def dedup_key_for(cls, task_name, args, kwargs, context):
+        '''A key identifying a call of ``task_name`` with these arguments in this
+        context, for coalescing identical pending tasks'''
+        call = json.dumps([task_name, args, kwargs, context],
+                          sort_keys=True, default=unicode)
+        return '%s:%s' % (task_name, hashlib.md5(call).hexdigest())
+
+    @classmethod
+    def post(cls,
+             function,
+             args=None,
+             kwargs=None,
+             result_type='forget',
+             priority=10,
+             delay=0,
+             dedup_key=None,
+             coalesce=False):
+        '''Create a new task object based on the current context.
+
+        If ``dedup_key`` is given and a ready task with the same key exists,
+        that task is returned instead of creating a new one (and moved up to
+        run no later than this one would have).  ``coalesce=True`` does the
+        same with a key made from the task name, arguments and context.
+        '''
+        if args is None:
+            args = ()
+        if kwargs is None:
+            kwargs = {}
+        task_name = '%s.%s' % (
+            function.__module__,
+            function.__name__)
+        context = cls._context()
+        time_queue = datetime.utcnow() + timedelta(seconds=delay)
+        if coalesce and dedup_key is None:
+            dedup_key = cls.dedup_key_for(task_name, args, kwargs, context)
+        if dedup_key:
+            # an upsert, so that concurrent posts can't both create a task.  It
+            # only sets dedup_key (mim has no $setOnInsert): a doc without a
+            # task_name is one just created here, or left unfinished by a post
+            # that died, and is filled in below.  Until then it has no
+            # time_queue, so no worker can claim it.
+            while True:
+                try:
+                    doc = cls._collection().find_and_modify(
+                        {'dedup_key': dedup_key, 'state': 'ready'},
+                        {'$set': {'dedup_key': dedup_key}},
+                        upsert=True, new=True)
+                    break
+                except pymongo.errors.DuplicateKeyError:
+                    # another post inserted it first (see the unique index),
+                    # so looking again finds it
+                    log.debug('Concurrent post for %s, looking again', dedup_key)
+            if doc.get('task_name'):
+                existing = cls.query.get(_id=doc['_id'])
+                # a task waiting for a retry keeps its backoff
+                if not existing.retries and existing.time_queue > time_queue:
+                    # targeted update, since a worker may claim it meanwhile
+                    cls.query.update(
+                        {'_id': existing._id, 'state': 'ready',
+                         'retries': existing.retries},
+                        {'$set': dict(time_queue=time_queue)})
+                log.debug('Reusing pending task %s for %s', existing._id, dedup_key)
+                return existing
+        args, kwargs, args_file = cls._spill_args(task_name, args, kwargs)
         obj = cls(
             state='ready',
             priority=priority,
@@ -167,33 +311,107 @@ def post(cls,
             process=None,
             result=None,
             context=context,
-            time_queue=datetime.utcnow() + timedelta(seconds=delay))
-        session(obj).flush(obj)
+            dedup_key=dedup_key,
+            lane=MonQLanes.from_config().lane_for(task_name),
+            args_file=args_file,
+            time_queue=time_queue)
+        if dedup_key:
+            obj._id = doc['_id']
+            st = orm_state(obj)
+            fields = dict(st.document)
+            del fields['_id']
+            cls._collection().update({'_id': obj._id}, {'$set': fields})
+            st.status = st.clean
+        else:
+            session(obj).flush(obj)
+        if not delay:
+            MonQSignal.notify(obj)
         return obj
 
     @classmethod
-    def get(cls, process='worker', state='ready', waitfunc=None, only=None):
+    def post_many(cls,
+                  function,
+                  calls,
+                  result_type='forget',
+                  priority=10,
+                  delay=0):
+        '''Create several tasks for the same function, based on the current
+        context, with a single multi-document insert.
+
+        ``calls`` is an iterable of ``(args, kwargs)`` pairs, one per task.
+        '''
+        task_name = '%s.%s' % (
+            function.__module__,
+            function.__name__)
+        context = cls._context()
+        lane = MonQLanes.from_config().lane_for(task_name)
+        time_queue = datetime.utcnow() + timedelta(seconds=delay)
+        objs = []
+        for args, kwargs in calls:
+            args, kwargs, args_file = cls._spill_args(task_name, args or (), kwargs or {})
+            objs.append(cls(
+                state='ready',
+                priority=priority,
+                result_type=result_type,
+                task_name=task_name,
+                args=args,
+                kwargs=kwargs,
+                process=None,
+                result=None,
+                context=context,
+                lane=lane,
+                args_file=args_file,
+                time_queue=time_queue))
+        if not objs:
+            return objs
+        cls._collection().insert([orm_state(obj).document for obj in objs])
+        for obj in objs:
+            st = orm_state(obj)
+            st.status = st.clean
+        if not delay:
+            MonQSignal.notify(objs[0])
+        return objs
+
+    @classmethod
+    def _ready_query(cls, state, only=None, lanes=None):
+        query = dict(state=state)
+        query['time_queue'] = {'$lte': datetime.utcnow()}
+        if only:
+            query['task_name'] = {'$in': only}
+        if lanes is not None:
+            lanes = list(lanes)
+            if MonQLanes.default in lanes:
+                # tasks queued before lanes were configured have none
+                lanes.append(None)
+            query['lane'] = {'$in': lanes}
+        return query
+
+    @classmethod
+    def get(cls, process='worker', state='ready', waitfunc=None, only=None, lanes=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
         current process.  If no task is available and waitfunc is supplied, call
         the waitfunc before trying to get the task again.  If waitfunc is None
         and no tasks are available, return None.  If waitfunc raises a
-        StopIteration, stop waiting for a task
+        StopIteration, stop waiting for a task.  If lanes is a list of lane
+        names (or a callable returning one, checked before each try), only
+        tasks in those lanes are considered.
         '''
         sort = [
             ('priority', ming.DESCENDING),
             ('time_queue', ming.ASCENDING)]
         while True:
             try:
-                query = dict(state=state)
-                query['time_queue'] = {'$lte': datetime.utcnow()}
-                if only:
-                    query['task_name'] = {'$in': only}
+                if callable(lanes):
+                    query = cls._ready_query(state, only, lanes())
+                else:
+                    query = cls._ready_query(state, only, lanes)
                 obj = cls.query.find_and_modify(
                     query=query,
                     update={
                         '$set': dict(
                             state='busy',
-                            process=process)
+                            process=process,
+                            time_start=None)
                     },
                     new=True,
                     sort=sort)
@@ -209,6 +427,60 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             except StopIteration:
                 return None
 
+    @classmethod
+    def get_many(cls, limit, process='worker', state='ready', waitfunc=None, only=None, lanes=None):
+        '''Like :meth:`get`, but claim up to ``limit`` of the highest-priority,
+        oldest ready tasks at once and return them as a list, in the order they
+        should be run.  All the claimed tasks have the same priority.
+
+        This takes three queries however many tasks are claimed, instead of
+        one ``find_and_modify`` per task.
+        '''
+        sort = [
+            ('priority', ming.DESCENDING),
+            ('time_queue', ming.ASCENDING)]
+        while True:
+            if callable(lanes):
+                query = cls._ready_query(state, only, lanes())
+            else:
+                query = cls._ready_query(state, only, lanes)
+            with cls._claim_lock:
+                candidates = list(cls._collection().find(
+                    query, {'priority': 1}).sort(sort).limit(limit))
+                ids = [doc['_id'] for doc in candidates
+                       if doc['priority'] == candidates[0]['priority']]
+                if ids:
+                    # another process may claim some of these first; the state
+                    # condition makes sure we only get the ones still ready
+                    cls.query.update(
+                        {'_id': {'$in': ids}, 'state': state},
+                        {'$set': dict(state='busy', process=process, time_start=None)},
+                        multi=True)
+                    claimed = cls.query.find(
+                        {'_id': {'$in': ids}, 'state': 'busy', 'process': process},
+                        refresh=True).sort(sort).all()
+                    if claimed:
+                        return claimed
+                    # all taken by others, but more may be ready: look again
+                    continue
+            if waitfunc is None:
+                return []
+            try:
+                waitfunc()
+            except StopIteration:
+                return []
+
+    @classmethod
+    def release(cls, tasks, process='worker'):
+        '''Put claimed tasks that were never started back in the ready state'''
+        cls.query.update(
+            {'_id': {'$in': [t._id for t in tasks]},
+             'state': 'busy',
+             'process': process,
+             'time_start': None},
+            {'$set': dict(state='ready', process=None)},
+            multi=True)
+
     @classmethod
     def timeout_tasks(cls, older_than):
         '''Mark all busy tasks older than a certain datetime as 'ready' again.
@@ -217,10 +489,48 @@ def timeout_tasks(cls, older_than):
         spec['time_start'] = {'$lt': older_than}
         cls.query.update(spec, {'$set': dict(state='ready')}, multi=True)
 
+    @classmethod
+    def _archive_collection(cls):
+        '''The raw pymongo collection finished tasks are moved to by :meth:`archive`'''
+        return task_doc_session.db[mapper(cls).collection.m.collection_name + '_archive']
+
+    @classmethod
+    def archive(cls, older_than, batch_size=1000):
+        '''Move complete, skipped and error tasks that finished before a certain
+        datetime out of the task collection and into the archive collection, so
+        that the task collection only holds ready and busy work.  Returns the
+        number of tasks moved.'''
+        tasks = cls._collection()
+        archive = cls._archive_collection()
+        moved = 0
+        while True:
+            spec = {'state': {'$in': list(cls.finished_states)},
+                    '$or': [{'time_stop': {'$lt': older_than}},
+                            # marked as error by taskd_cleanup, never stopped
+                            {'time_stop': None, 'time_queue': {'$lt': older_than}}]}
+            docs = list(tasks.find(spec).limit(batch_size))
+            if not docs:
+                break
+            for doc in docs:
+                # save (not insert) so a run interrupted between here and the
+                # remove below can be repeated safely
+                archive.save(doc)
+            # archived tasks keep their args_file id, but not its contents
+            cls._remove_args_files(docs)
+            tasks.remove({'_id': {'$in': [doc['_id'] for doc in docs]}})
+            moved += len(docs)
+        return moved
+
     @classmethod
     def clear_complete(cls):
         '''Delete the task objects for complete tasks'''
-        spec = dict(state='complete')
+        cls.purge(dict(state='complete'))
+
+    @classmethod
+    def purge(cls, spec):
+        '''Delete the tasks matching ``spec``, and any args spilled to GridFS'''
+        cls._remove_args_files(cls._collection().find(
+            dict(spec, args_file={'$ne': None}), ['args_file']))
         cls.query.remove(spec)
 
     @classmethod
@@ -244,6 +554,7 @@ def __call__(self, restore_context=True, nocapture=False):
         old_cproject = getattr(c, 'project', None)
         old_capp = getattr(c, 'app', None)
         old_cuser = getattr(c, 'user', None)
+        func = None
         try:
             func = self.function
             c.project = M.Project.query.get(_id=self.context.project_id)
@@ -257,12 +568,22 @@ def __call__(self, restore_context=True, nocapture=False):
                     c.app = c.project.app_instance(app_config)
             c.user = M.User.query.get(_id=self.context.user_id)
             with null_contextmanager() if nocapture else log_output(log):
-                self.result = func(*self.args, **self.kwargs)
+                args, kwargs = self._load_args()
+                self.result = func(*args, **kwargs)
             self.state = 'complete'
             return self.result
         except Exception, exc:
             if asbool(config.get('monq.raise_errors')):
                 raise
+            retry_in = self.retry_delay(func, exc)
+            if retry_in is not None:
+                log.warning('Error "%s" on job %s, retrying in %ss', exc, self, retry_in, exc_info=True)
+                # get() won't pick it up again until time_queue has passed
+                self.retries += 1
+                self.state = 'ready'
+                self.process = None
+                self.time_queue = datetime.utcnow() + timedelta(seconds=retry_in)
+                self.result = traceback.format_exc()
             else:
                 log.exception('Error "%s" on job %s', exc, self)
                 self.state = 'error'
@@ -273,12 +594,41 @@ def __call__(self, restore_context=True, nocapture=False):
                     self.result = traceback.format_exc()
         finally:
             self.time_stop = datetime.utcnow()
-            session(self).flush(self)
+            try:
+                session(self).flush(self)
+            except pymongo.errors.DuplicateKeyError:
+                # queued for a retry, but a task with the same dedup_key was
+                # posted meanwhile, and will do the work
+                log.info('Skipping the retry of %s, %s is already queued', self._id, self.dedup_key)
+                self.state = 'skipped'
+                session(self).flush(self)
+            self.log_stats()
             if restore_context:
                 c.project = old_cproject
                 c.app = old_capp
                 c.user = old_cuser
 
+    def retry_delay(self, func, exc):
+        '''Seconds to wait before running this task again after it raised
+        ``exc``, or None if the task's retry policy doesn't cover it'''
+        policy = getattr(func, 'retry_policy', None)
+        if not policy or self.retries >= policy['max_retries']:
+            return None
+        if not isinstance(exc, policy['retry_on']):
+            return None
+        return policy['backoff'] * 2 ** self.retries
+
+    def log_stats(self):
+        '''Record the queue wait and run time of this task in the rtstats log'''
+        wait = max((self.time_start - self.time_queue).total_seconds(), 0)
+        run = (self.time_stop - self.time_start).total_seconds()
+        stats_log.info('%s %s in %.3fs after waiting %.3fs', self.task_name, self.state, run, wait,
+                       meta=dict(task_name=self.task_name,
+                                 lane=self.lane or MonQLanes.default,
+                                 state=self.state,
+                                 wait_ms=int(wait * 1000),
+                                 run_ms=int(run * 1000)))
+
     def join(self, poll_interval=0.1):
         '''Wait until this task is either complete or errors out, then return the result.'''
         while self.state not in ('complete', 'error'):
@@ -291,3 +641,276 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+class MonQMetrics(object):
+
+    '''Task counts, queue wait and run time histograms per task name and lane.
+
+    :meth:`collect` builds them from the task collection: pending tasks as they
+    are now, and finished tasks that stopped since a given time.  :meth:`render`
+    formats them as plain text in the Prometheus exposition format, for
+    ``paster task <ini> metrics`` and the site admin task manager.
+    '''
+
+    # histogram bucket upper bounds, in seconds
+    buckets = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+    fields = ('state', 'lane', 'task_name', 'time_queue', 'time_start', 'time_stop')
+
+    def __init__(self, now=None):
+        self.now = now or datetime.utcnow()
+        self.pending = defaultdict(int)  # (state, lane, task_name): count
+        self.oldest = {}  # (lane, task_name): seconds the oldest ready task has waited
+        self.finished = defaultdict(int)  # (state, lane, task_name): count
+        self.wait = {}  # (lane, task_name): [bucket counts, sum, count]
+        self.run = {}
+
+    @classmethod
+    def collect(cls, since):
+        metrics = cls()
+        tasks = MonQTask._collection()
+        # pending tasks are counted by mongo, per state, task name and lane,
+        # since a backed up queue can hold very many of them
+        for state in ('ready', 'busy'):
+            names = tasks.find({'state': state, 'task_name': {'$exists': True}}).distinct('task_name')
+            for task_name in names:
+                query = {'state': state, 'task_name': task_name}
+                lanes = tasks.find(dict(query, lane={'$exists': True})).distinct('lane')
+                lanes = [lane for lane in lanes if lane and lane != MonQLanes.default]
+                for lane in lanes:
+                    metrics.add_pending(tasks, dict(query, lane=lane), lane)
+                # tasks without a lane are in the default one too
+                metrics.add_pending(tasks, dict(query, lane={'$nin': lanes}), MonQLanes.default)
+        finished = {'state': {'$in': list(MonQTask.finished_states)}, 'time_stop': {'$gte': since}}
+        for doc in tasks.find(finished, list(cls.fields)):
+            metrics.add_finished(doc)
+        return metrics
+
+    def add_pending(self, tasks, query, lane):
+        '''Count the pending tasks ``query`` finds, all of the same state and
+        task name, and how long the oldest of them that is due has waited'''
+        count = tasks.find(query).count()
+        if not count:
+            return
+        key = lane, query['task_name']
+        self.pending[(query['state'],) + key] = count
+        if query['state'] == 'ready':
+            due = dict(query, time_queue={'$lte': self.now})
+            for doc in tasks.find(due, ['time_queue']).sort('time_queue', pymongo.ASCENDING).limit(1):
+                self.oldest[key] = (self.now - doc['time_queue']).total_seconds()
+
+    def add_finished(self, doc):
+        lane = doc.get('lane') or MonQLanes.default
+        self.finished[doc['state'], lane, doc['task_name']] += 1
+        if doc.get('time_start') is None:
+            # skipped, or marked as error without being run
+            return
+        key = lane, doc['task_name']
+        self._observe(self.wait, key, max((doc['time_start'] - doc['time_queue']).total_seconds(), 0))
+        self._observe(self.run, key, (doc['time_stop'] - doc['time_start']).total_seconds())
+
+    def _observe(self, histograms, key, value):
+        hist = histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                hist[0][i] += 1
+        hist[1] += value
+        hist[2] += 1
+
+    @staticmethod
+    def _labels(**labels):
+        return '{%s}' % ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in sorted(labels.iteritems()))
+
+    def render(self):
+        lines = []
+        lines.append('# HELP monq_tasks Number of tasks waiting in the queue or running')
+        lines.append('# TYPE monq_tasks gauge')
+        for (state, lane, task_name), count in sorted(self.pending.iteritems()):
+            lines.append('monq_tasks%s %d' % (self._labels(state=state, lane=lane, task_name=task_name), count))
+        lines.append('# HELP monq_oldest_ready_seconds How long the oldest ready task has been waiting')
+        lines.append('# TYPE monq_oldest_ready_seconds gauge')
+        for (lane, task_name), wait in sorted(self.oldest.iteritems()):
+            lines.append('monq_oldest_ready_seconds%s %.3f' % (self._labels(lane=lane, task_name=task_name), wait))
+        lines.append('# HELP monq_tasks_finished Number of tasks that finished in the collection window')
+        lines.append('# TYPE monq_tasks_finished gauge')
+        for (state, lane, task_name), count in sorted(self.finished.iteritems()):
+            lines.append('monq_tasks_finished%s %d' % (
+                self._labels(state=state, lane=lane, task_name=task_name), count))
+        for name, histograms, help in (
+                ('monq_task_wait_seconds', self.wait, 'Time tasks waited in the queue before starting'),
+                ('monq_task_run_seconds', self.run, 'Time tasks took to run')):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s histogram' % name)
+            for (lane, task_name), (counts, total, count) in sorted(histograms.iteritems()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = self._labels(lane=lane, task_name=task_name, le=bound)
+                    lines.append('%s_bucket%s %d' % (name, labels, bucket_count))
+                labels = self._labels(lane=lane, task_name=task_name, le='+Inf')
+                lines.append('%s_bucket%s %d' % (name, labels, count))
+                labels = self._labels(lane=lane, task_name=task_name)
+                lines.append('%s_sum%s %.3f' % (name, labels, total))
+                lines.append('%s_count%s %d' % (name, labels, count))
+        return '\n'.join(lines) + '\n'
+
+
+class MonQLanes(object):
+
+    '''Named lanes that split up the task queue, so that one slow kind of task
+    can't take over every taskd worker.
+
+    Each task is put in the first lane with a pattern matching its name when
+    posted, or in the "default" lane.  Within a taskd pool, a lane can be
+    guaranteed some workers that only run its tasks (``min_workers``) and be
+    limited to a number of tasks running at once (``max_workers``).
+    Configured like::
+
+        monq.lanes = bulk, mail
+        monq.lane.bulk.tasks = allura.tasks.repo_tasks.clone allura.tasks.export_tasks.*
+        monq.lane.bulk.max_workers = 2
+        monq.lane.mail.tasks = allura.tasks.mail_tasks.* allura.tasks.notification_tasks.*
+        monq.lane.mail.min_workers = 1
+    '''
+    default = 'default'
+    _cache = {}
+
+    def __init__(self, conf):
+        self.names = []
+        self.patterns = []
+        self.min_workers = {}
+        self.max_workers = {}
+        for name in aslist(conf.get('monq.lanes'), ','):
+            prefix = 'monq.lane.%s.' % name
+            self.names.append(name)
+            self.patterns.extend(
+                (pattern, name) for pattern in aslist(conf.get(prefix + 'tasks')))
+            self.min_workers[name] = asint(conf.get(prefix + 'min_workers', 0))
+            max_workers = conf.get(prefix + 'max_workers')
+            self.max_workers[name] = asint(max_workers) if max_workers else None
+        if self.default not in self.names:
+            self.names.append(self.default)
+            self.min_workers[self.default] = 0
+            self.max_workers[self.default] = None
+
+    @classmethod
+    def from_config(cls):
+        key = frozenset((k, v) for k, v in config.iteritems()
+                        if k.startswith('monq.lane'))
+        lanes = cls._cache.get(key)
+        if lanes is None:
+            lanes = cls._cache[key] = cls(config)
+        return lanes
+
+    def lane_for(self, task_name):
+        for pattern, name in self.patterns:
+            if fnmatch.fnmatchcase(task_name, pattern):
+                return name
+        return self.default
+
+    def assign(self, num_workers):
+        '''Decide which lane each of a pool's workers is dedicated to.
+
+        Returns a list with a lane name for each worker that should only run
+        that lane's tasks, or None for workers that can run any lane's tasks.
+        At least one worker is always left for any lane's tasks, so that
+        lanes without dedicated workers still get run.
+        '''
+        assigned = []
+        for name in self.names:
+            assigned.extend([name] * self.min_workers[name])
+        if assigned and len(assigned) >= num_workers:
+            log.warn('monq lanes want %s dedicated workers but there are only %s, '
+                     'dedicating %s', len(assigned), num_workers, num_workers - 1)
+            assigned = assigned[:num_workers - 1]
+        return assigned + [None] * (num_workers - len(assigned))
+
+
+class MonQSignal(object):
+
+    '''Wakes up idle taskd workers as soon as a task is posted.
+
+    Posting a task also inserts a tiny document into the capped
+    ``monq_signal`` collection.  Idle workers hold a tailable cursor on that
+    collection and return from :meth:`wait` when something arrives there,
+    instead of sleeping for the whole ``monq.poll_interval``.  Any failure
+    just falls back to polling.
+
+    Enabled with ``monq.signal_wakeup = true`` (not supported by mim).
+    '''
+    collection_name = 'monq_signal'
+
+    def __init__(self):
+        self._cursor = None
+        self._last_id = None
+
+    @classmethod
+    def enabled(cls):
+        return asbool(config.get('monq.signal_wakeup', False))
+
+    @classmethod
+    def collection(cls):
+        db = task_doc_session.db
+        if cls.collection_name not in db.collection_names():
+            size = asint(config.get('monq.signal_size', 1024 * 1024))
+            try:
+                db.create_collection(cls.collection_name, capped=True, size=size)
+                # a tailable cursor on an empty collection dies right away
+                db[cls.collection_name].insert(dict(task_name=None))
+            except pymongo.errors.CollectionInvalid:
+                pass  # another process created it first
+        return db[cls.collection_name]
+
+    @classmethod
+    def notify(cls, task):
+        '''Tell waiting workers that ``task`` is ready'''
+        if not cls.enabled():
+            return
+        try:
+            cls.collection().insert(dict(
+                task_id=task._id,
+                task_name=task.task_name,
+                time_queue=task.time_queue))
+        except pymongo.errors.PyMongoError:
+            log.warn('Could not signal taskd about new tasks', exc_info=True)
+
+    def wait(self, timeout, only=None):
+        '''Block until a task (with a name in ``only``, if given) is posted or
+        ``timeout`` seconds have passed.  Returns True if woken by a post.
+
+        Signals for tasks queued more than a second before the wait began are
+        skipped, since the caller's last :meth:`MonQTask.get` already had a
+        chance at those tasks.'''
+        deadline = time.time() + timeout
+        since = datetime.utcnow() - timedelta(seconds=1)
+        while time.time() < deadline:
+            try:
+                if self._cursor is None or not self._cursor.alive:
+                    self._cursor = self._tail()
+                # with await_data the server holds each getmore open for a
+                # while before returning an empty batch
+                for doc in self._cursor:
+                    self._last_id = doc['_id']
+                    if doc.get('time_queue') and doc['time_queue'] < since:
+                        continue
+                    if not only or doc.get('task_name') in only:
+                        return True
+                if not self._cursor.alive:
+                    time.sleep(min(1, max(0, deadline - time.time())))
+            except pymongo.errors.PyMongoError:
+                log.warn('Error waiting for taskd signal, falling back to polling',
+                         exc_info=True)
+                self._cursor = None
+                time.sleep(max(0, deadline - time.time()))
+        return False
+
+    def _tail(self):
+        coll = self.collection()
+        if self._last_id is None:
+            last = coll.find().sort('$natural', -1).limit(1)
+            for doc in last:
+                self._last_id = doc['_id']
+        spec = {}
+        if self._last_id is not None:
+            spec['_id'] = {'$gt': self._last_id}
+        return coll.find(spec, tailable=True, await_data=True)
@@ -17,7 +17,6 @@
 
 import logging
 from itertools import chain
-from cPickle import dumps
 from collections import OrderedDict
 
 import bson
@@ -34,7 +33,7 @@
 from allura.model.repository import CommitDoc, TreeDoc, TreesDoc
 from allura.model.repository import CommitRunDoc
 from allura.model.repository import Commit, Tree, LastCommit, ModelCache
-from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
+from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc, artifact_classes
 from allura.model.auth import User
 from allura.model.timeline import TransientActor
 
@@ -198,7 +197,7 @@ def refresh_commit_repos(all_commit_ids, repo):
             ref = ArtifactReferenceDoc(dict(
                 _id=index_id,
                 artifact_reference=dict(
-                    cls=bson.Binary(dumps(Commit)),
+                    cls_name=artifact_classes.name(Commit),
                     project_id=repo.app.config.project_id,
                     app_config_id=repo.app.config._id,
                     artifact_id=oid),
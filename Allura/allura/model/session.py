@@ -16,9 +16,10 @@
 #       under the License.
 
 import logging
-import pymongo
 from collections import defaultdict
 
+from tg import config
+from paste.deploy.converters import asbool
 from ming import Session
 from ming.orm.base import state
 from ming.orm.ormsession import ThreadLocalORMSession, SessionExtension
@@ -141,7 +142,11 @@ def update_index(self, objects_deleted, arefs):
             index_tasks.del_artifacts.post(
                 [obj.index_id() for obj in objects_deleted])
         if arefs:
-            index_tasks.add_artifacts.post([aref._id for aref in arefs])
+            ref_ids = [aref._id for aref in arefs]
+            if asbool(config.get('solr.index_queue', False)):
+                index_tasks.queue_artifacts(ref_ids)
+            else:
+                index_tasks.add_artifacts.post(ref_ids)
 
 
 class BatchIndexer(ArtifactSessionExtension):
@@ -185,40 +190,19 @@ def flush(cls):
         .. warning:: This method is NOT called automatically when the parent
            session is flushed. It MUST be called explicitly.
         """
-        # Post in chunks to avoid overflowing the max BSON document
-        # size when the Monq task is created:
-        # cls.to_delete - contains solr index ids which can easily be over
-        #                 100 bytes. Here we allow for 160 bytes avg, plus
-        #                 room for other document overhead.
-        # cls.to_add - contains BSON ObjectIds, which are 12 bytes each, so
-        #              we can easily put 1m in a doc with room left over.
+        # Post in chunks to keep each task to a manageable amount of work.
+        # Big argument lists are stored outside the Monq task document (see
+        # MonQTask._spill_args), so they don't need to fit in a BSON document.
         if cls.to_delete:
             for chunk in chunked_list(list(cls.to_delete), 100 * 1000):
-                cls._post(index_tasks.del_artifacts, chunk)
+                index_tasks.del_artifacts.post(chunk)
 
         if cls.to_add:
             for chunk in chunked_list(list(cls.to_add), 1000 * 1000):
-                cls._post(index_tasks.add_artifacts, chunk)
+                index_tasks.add_artifacts.post(chunk)
         cls.to_delete = set()
         cls.to_add = set()
 
-    @classmethod
-    def _post(cls, task_func, chunk):
-        """
-        Post task, recursively splitting and re-posting if the resulting
-        mongo document is too large.
-        """
-        try:
-            task_func.post(chunk)
-        except pymongo.errors.InvalidDocument as e:
-            # there are many types of InvalidDocument, only recurse if its
-            # expected to help
-            if e.args[0].startswith('BSON document too large'):
-                cls._post(task_func, chunk[:len(chunk) // 2])
-                cls._post(task_func, chunk[len(chunk) // 2:])
-            else:
-                raise
-
 
 @contextmanager
 def substitute_extensions(session, extensions=None):
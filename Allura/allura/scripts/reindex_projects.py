@@ -18,7 +18,6 @@
 import argparse
 import logging
 
-from pymongo.errors import InvalidDocument
 from pylons import tmpl_context as c, app_globals as g
 
 from allura.scripts import ScriptTask
@@ -58,7 +57,7 @@ def execute(cls, options):
             try:
                 for chunk in chunked_list(project_ids, options.max_chunk):
                     if options.tasks:
-                        cls._post_add_projects(chunk)
+                        add_projects.post(chunk)
                     else:
                         add_projects(chunk)
             except CompoundError, err:
@@ -68,23 +67,6 @@ def execute(cls, options):
             M.main_orm_session.clear()
         log.info('Reindex %s', 'queued' if options.tasks else 'done')
 
-    @classmethod
-    def _post_add_projects(cls, chunk):
-        """
-        Post task, recursively splitting and re-posting if the resulting
-        mongo document is too large.
-        """
-        try:
-            add_projects.post(chunk)
-        except InvalidDocument as e:
-            # there are many types of InvalidDocument, only recurse if its
-            # expected to help
-            if e.args[0].startswith('BSON document too large'):
-                cls._post_add_projects(chunk[:len(chunk) // 2])
-                cls._post_add_projects(chunk[len(chunk) // 2:])
-            else:
-                raise
-
     @classmethod
     def parser(cls):
         parser = argparse.ArgumentParser(description='Reindex all project records into Solr (for searching)')
@@ -18,8 +18,6 @@
 import argparse
 import logging
 
-from pymongo.errors import InvalidDocument
-
 from allura.scripts import ScriptTask
 from allura import model as M
 from allura.tasks.index_tasks import add_users
@@ -44,7 +42,7 @@ def execute(cls, options):
             try:
                 for chunk in chunked_list(user_ids, options.max_chunk):
                     if options.tasks:
-                        cls._post_add_users(chunk)
+                        add_users.post(chunk)
                     else:
                         add_users(chunk)
             except CompoundError, err:
@@ -54,23 +52,6 @@ def execute(cls, options):
             M.main_orm_session.clear()
         log.info('Reindex %s', 'queued' if options.tasks else 'done')
 
-    @classmethod
-    def _post_add_users(cls, chunk):
-        """
-        Post task, recursively splitting and re-posting if the resulting
-        mongo document is too large.
-        """
-        try:
-            add_users.post(chunk)
-        except InvalidDocument as e:
-            # there are many types of InvalidDocument, only recurse if its
-            # expected to help
-            if e.args[0].startswith('BSON document too large'):
-                cls._post_add_users(chunk[:len(chunk) // 2])
-                cls._post_add_users(chunk[len(chunk) // 2:])
-            else:
-                raise
-
     @classmethod
     def parser(cls):
         parser = argparse.ArgumentParser(description='Reindex all users into Solr (for searching)')
@@ -20,6 +20,6 @@
 from allura.lib.decorators import task
 
 
-@task
+@task(coalesce=True)
 def create_timelines(node_id):
     g.director.create_timelines(node_id)
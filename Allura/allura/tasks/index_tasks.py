@@ -16,10 +16,15 @@
 #       under the License.
 
 import sys
+import socket
 import logging
 from contextlib import contextmanager
+from datetime import datetime
 
 from pylons import app_globals as g
+from pysolr import SolrError
+from tg import config
+from paste.deploy.converters import asint
 
 from allura.lib.decorators import task
 from allura.lib.exceptions import CompoundError
@@ -28,6 +33,9 @@
 
 log = logging.getLogger(__name__)
 
+# indexing tasks are safe to repeat, so retry them while solr is unavailable
+solr_retry = dict(max_retries=5, retry_backoff=30, retry_on=(SolrError, socket.error))
+
 
 def __get_solr(solr_hosts=None):
     return make_solr_from_config(solr_hosts) if solr_hosts else g.solr
@@ -40,99 +48,241 @@ def __add_objects(objects, solr_hosts=None):
 
 def __del_objects(object_solr_ids):
     solr_instance = __get_solr()
-    solr_query = 'id:({0})'.format(' || '.join(object_solr_ids))
-    solr_instance.delete(q=solr_query)
+    chunk_size = asint(config.get('solr.delete_chunk_size', 1000))
+    solr_instance.delete_ids(object_solr_ids, chunk_size=chunk_size)
 
 
-@task
+def __del_refs(query, solr_query):
+    '''
+    Delete the artifacts whose references match ``query`` from solr, by id,
+    and then any left that match ``solr_query`` (e.g. whose references are
+    already gone).  Delete-by-query is slow in solr, as it can't run
+    alongside other updates, but is cheap once there is little left to match.
+    '''
+    from allura import model as M
+    if query is not None:
+        refs = M.ArtifactReference._collection().find(query, fields=['_id'])
+        ref_ids = [ref['_id'] for ref in refs]
+        if ref_ids:
+            __del_objects(ref_ids)
+    g.solr.delete(q=solr_query)
+
+
+@task(**solr_retry)
 def add_projects(project_ids):
     from allura.model.project import Project
     projects = Project.query.find(dict(_id={'$in': project_ids})).all()
     __add_objects(projects)
 
 
-@task
+@task(**solr_retry)
 def del_projects(project_solr_ids):
     __del_objects(project_solr_ids)
 
 
-@task
+@task(**solr_retry)
 def add_users(user_ids):
     from allura.model import User
     users = User.query.find(dict(_id={'$in': user_ids})).all()
     __add_objects(users)
 
 
-@task
+@task(**solr_retry)
 def del_users(user_solr_ids):
     __del_objects(user_solr_ids)
 
 
-@task
-def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
+@task(**solr_retry)
+def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None, commit_within=None,
+                  force=False):
     '''
     Add the referenced artifacts to SOLR and shortlinks.
 
+    Artifacts whose :meth:`index` hasn't changed since they were last sent to
+    the default solr (according to ``ArtifactReference.index_fingerprint``)
+    aren't sent to solr again, and if only their ``index_hot_fields``
+    changed, just those are updated.  Their references are updated anyway.
+
     :param solr_hosts: a list of solr hosts to use instead of the defaults
     :type solr_hosts: [str]
+    :param commit_within: if given, don't commit, but have solr commit the
+      changes within this many milliseconds
+    :param force: index all the artifacts, even unchanged ones
+    '''
+    errors = _add_artifacts(ref_ids, update_solr, update_refs, solr_hosts, commit_within, force)
+    exceptions = [exc_info for ref_id, exc_info in errors]
+    if len(exceptions) == 1:
+        raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
+    if exceptions:
+        raise CompoundError(*exceptions)
+
+
+def _add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None, commit_within=None,
+                   force=False):
+    '''
+    Does the work of :func:`add_artifacts`.  Errors sending to solr are
+    raised, but errors indexing single artifacts are returned, as a list of
+    ``(ref_id, exc_info)``, after the rest were sent.
     '''
     from allura import model as M
-    from allura.lib.search import find_shortlinks
+    from allura.lib.search import (find_shortlinks, index_fingerprint, only_hot_fields_changed,
+                                   invalidate_search_cache)
 
-    exceptions = []
+    # fingerprints only describe what the default solr has
+    use_fingerprints = update_solr and not solr_hosts
+    errors = []
     solr_updates = []
+    field_updates = []
+    fingerprints = {}
+    tools = set()
     with _indexing_disabled(M.session.artifact_orm_session._get()):
-        for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
+        refs = M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})).all()
+        M.ArtifactReference.load_many(refs)
+        for ref in refs:
             try:
                 artifact = ref.artifact
                 if artifact is None:
                     continue
-                s = artifact.solarize()
-                if s is None:
+                doc = artifact.index()
+                if doc is None:
                     continue
-                if update_solr:
-                    solr_updates.append(s)
+                push = update_solr
+                if use_fingerprints:
+                    hot_fields = artifact.index_hot_fields
+                    fingerprint = index_fingerprint(doc, hot_fields)
+                    if force:
+                        pass
+                    elif fingerprint == ref.index_fingerprint:
+                        push = False
+                    elif only_hot_fields_changed(fingerprint, ref.index_fingerprint):
+                        field_updates.append(dict(
+                            ((name, doc.get(name)) for name in hot_fields), id=doc['id']))
+                        fingerprints[ref] = fingerprint
+                        tools.add((doc.get('project_id_s'), doc.get('mount_point_s')))
+                        push = False
+                # the references are updated even if solr isn't, as the
+                # artifacts linked to may have been created since
+                if push:
+                    solr_updates.append(artifact.solarize(doc))
+                    tools.add((doc.get('project_id_s'), doc.get('mount_point_s')))
+                    if use_fingerprints:
+                        fingerprints[ref] = fingerprint
                 if update_refs:
                     if isinstance(artifact, M.Snapshot):
                         continue
                     # Find shortlinks in the raw text, not the escaped html
                     # created by the `solarize()`.
-                    link_text = artifact.index().get('text') or ''
+                    link_text = doc.get('text') or ''
                     shortlinks = find_shortlinks(link_text)
                     ref.references = [link.ref_id for link in shortlinks]
             except Exception:
                 log.error('Error indexing artifact %s', ref._id)
-                exceptions.append(sys.exc_info())
-        __get_solr(solr_hosts).add(solr_updates)
-
-    if len(exceptions) == 1:
-        raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
-    if exceptions:
-        raise CompoundError(*exceptions)
+                errors.append((ref._id, sys.exc_info()))
+        solr_kw = dict(commit=False, commitWithin=commit_within) if commit_within else {}
+        if solr_updates:
+            __get_solr(solr_hosts).add(solr_updates, **solr_kw)
+        if field_updates:
+            __get_solr(solr_hosts).update_fields(field_updates, **solr_kw)
+        for ref, fingerprint in fingerprints.iteritems():
+            ref.index_fingerprint = fingerprint
+        if not solr_hosts:
+            for project_id, mount_point in tools:
+                invalidate_search_cache(project_id, mount_point)
+    return errors
+
+
+def queue_artifacts(ref_ids):
+    '''
+    Queue the referenced artifacts to be added to SOLR and shortlinks by
+    :func:`drain_index_queue`, which is posted to run after
+    ``solr.index_queue.delay`` seconds unless it is already waiting to.
+    '''
+    from allura import model as M
+    M.IndexQueue.add(ref_ids)
+    # one pending drain task for the whole site, whatever the context
+    M.MonQTask.post(drain_index_queue,
+                    dedup_key='allura.tasks.index_tasks.drain_index_queue',
+                    delay=asint(config.get('solr.index_queue.delay', 5)))
 
 
-@task
+@task(**solr_retry)
+def drain_index_queue():
+    '''
+    Index everything queued by :func:`queue_artifacts`, in batches of
+    ``solr.index_queue.batch_size`` sent with commitWithin rather than
+    committing each one.
+    '''
+    from allura import model as M
+    started = datetime.utcnow()
+    batch_size = asint(config.get('solr.index_queue.batch_size', 1000))
+    commit_within = asint(config.get('solr.commitWithin') or 10000)
+    failed = set()
+    while True:
+        ref_ids = M.IndexQueue.pending(started, batch_size, exclude=failed)
+        if not ref_ids:
+            break
+        # if sending the batch fails, it stays queued: this task is retried
+        # for solr errors, and posted again by the next queue_artifacts()
+        errors = _add_artifacts(ref_ids, commit_within=commit_within)
+        for ref_id, exc_info in errors:
+            log.error('Error indexing queued artifact %s', ref_id, exc_info=exc_info)
+            failed.add(ref_id)
+        # artifacts that failed stay queued for the next run
+        M.IndexQueue.remove([ref_id for ref_id in ref_ids if ref_id not in failed], started)
+
+
+@task(**solr_retry)
 def del_artifacts(ref_ids):
     from allura import model as M
     if ref_ids:
         __del_objects(ref_ids)
+        if g.search_cache is not None:
+            _invalidate_search_cache(ref_ids)
+        if g.shortlink_cache is not None:
+            for shortlink in M.Shortlink.query.find(dict(ref_id={'$in': ref_ids})):
+                M.Shortlink.invalidate_cache(shortlink.project_id, shortlink.link)
         M.ArtifactReference.query.remove(dict(_id={'$in': ref_ids}))
         M.Shortlink.query.remove(dict(ref_id={'$in': ref_ids}))
 
 
-@task
+def _invalidate_search_cache(ref_ids):
+    """Invalidate cached searches of the tools the referenced artifacts are in"""
+    from allura import model as M
+    from allura.lib.search import invalidate_search_cache
+    tools = set()
+    for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
+        aref = ref.artifact_reference
+        tools.add((aref.project_id, aref.app_config_id))
+    app_configs = M.AppConfig.query.find(dict(
+        _id={'$in': list(set(app_config_id for _, app_config_id in tools))}))
+    mount_points = dict((ac._id, ac.options.mount_point) for ac in app_configs)
+    for project_id, app_config_id in tools:
+        invalidate_search_cache(project_id, mount_points.get(app_config_id))
+
+
+@task(**solr_retry)
 def solr_del_project_artifacts(project_id):
-    g.solr.delete(q='project_id_s:%s' % project_id)
+    from allura.lib.search import invalidate_search_cache
+    __del_refs({'artifact_reference.project_id': project_id},
+               'project_id_s:%s' % project_id)
+    invalidate_search_cache(project_id)
 
 
-@task
+@task(**solr_retry)
 def commit():
     g.solr.commit()
 
 
-@task
-def solr_del_tool(project_id, mount_point_s):
-    g.solr.delete(q='project_id_s:"%s" AND mount_point_s:"%s"' % (project_id, mount_point_s))
+@task(**solr_retry)
+def solr_del_tool(project_id, mount_point_s, app_config_id=None):
+    from allura.lib.search import invalidate_search_cache
+    query = None
+    if app_config_id is not None:
+        query = {'artifact_reference.project_id': project_id,
+                 'artifact_reference.app_config_id': app_config_id}
+    __del_refs(query, 'project_id_s:"%s" AND mount_point_s:"%s"' % (project_id, mount_point_s))
+    invalidate_search_cache(project_id, mount_point_s)
+
 
 @contextmanager
 def _indexing_disabled(session):
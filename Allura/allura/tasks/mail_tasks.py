@@ -16,6 +16,8 @@
 #       under the License.
 
 import logging
+import socket
+import smtplib
 import HTMLParser
 
 from pylons import tmpl_context as c, app_globals as g
@@ -154,7 +156,7 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
         in_reply_to, html_msg, sender=sender, references=references)
 
 
-@task
+@task(max_retries=3, retry_backoff=60, retry_on=(smtplib.SMTPException, socket.error))
 def sendsimplemail(
         fromaddr,
         toaddr,
@@ -0,0 +1,53 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import logging
+
+import markdown
+from pylons import app_globals as g
+
+from allura import model as M
+from allura.lib.decorators import task
+from allura.lib.exceptions import MarkdownRenderTimeout
+
+log = logging.getLogger(__name__)
+
+
+@task(coalesce=True)
+def render_markdown(flavor, options, source):
+    '''Render markdown which timed out in a request (see
+    :meth:`allura.lib.app_globals.ForgeMarkdown.convert`) into the shared
+    render cache, allowing it the longer
+    ``markdown_render_watchdog.background_timeout``.  If that times out too,
+    the plain text is cached, so that requests don't keep trying.'''
+    md = g.markdown_flavor(flavor, options)
+    cache, watchdog = md.render_cache, md.render_watchdog
+    if cache is None:
+        return
+    key = cache.key(source, flavor, md.cache_bugfix_rev)
+    if cache.get(key, flavor) is not None:
+        return
+    if watchdog is None:
+        html = markdown.Markdown.convert(md, source)
+    else:
+        try:
+            html = watchdog.convert(flavor, options, source,
+                                    timeout=watchdog.background_timeout)
+        except MarkdownRenderTimeout:
+            log.warn('Markdown rendering timed out again, caching it as plain text')
+            html = M.PlainTextFallback(md.plain_text(source))
+    cache.set(key, flavor, html)
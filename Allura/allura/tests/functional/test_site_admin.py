@@ -138,6 +138,15 @@ def test_task_view(self):
         r = self.app.get(url)
         assert 'math.ceil' in r, r
 
+    def test_task_metrics(self):
+        import math
+        M.MonQTask.post(math.ceil, (12.5,))
+        r = self.app.get('/nf/admin/task_manager/metrics',
+                         extra_environ=dict(username='*anonymous'), status=302)
+        r = self.app.get('/nf/admin/task_manager/metrics')
+        assert_equal(r.content_type, 'text/plain')
+        assert 'monq_tasks{lane="default",state="ready",task_name="math.ceil"} 1' in r, r
+
     def test_task_new(self):
         r = self.app.get('/nf/admin/task_manager/new')
         assert 'New Task' in r, r
@@ -22,6 +22,7 @@
 """
 import re
 from datetime import datetime
+from cPickle import dumps
 
 from pylons import tmpl_context as c
 from nose.tools import assert_raises, assert_equal
@@ -29,13 +30,14 @@
 from mock import patch
 from ming.orm.ormsession import ThreadLocalORMSession
 from ming.orm import Mapper
-from bson import ObjectId
+from bson import ObjectId, Binary
 from webob import Request
 
 import allura
 from allura import model as M
 from allura.lib import helpers as h
 from allura.lib import security
+from allura.model.index import ShortlinkCache, ArtifactClassRegistry
 from allura.tests import decorators as td
 from allura.websetup.schema import REGISTRY
 from alluratest.controller import setup_basic_test, setup_unit_test
@@ -141,6 +143,133 @@ def test_artifactlink():
     assert q_shortlink.count() == 0
 
 
+@with_setup(setUp, tearDown)
+def test_shortlinks_from_links():
+    pages = [WM.Page(title='LinkPage%d' % i) for i in range(3)]
+    ThreadLocalORMSession.flush_all()
+    M.MonQTask.run_ready()
+    ThreadLocalORMSession.flush_all()
+    M.main_orm_session.clear()
+    links = ['[LinkPage0]', 'wiki:LinkPage1', 'test:wiki:LinkPage2',
+             'test:wiki:LinkPage2:foo', 'nosuchproject:wiki:LinkPage2',
+             'LinkPage_no_such_page']
+    result = M.Shortlink.from_links(*links)
+    assert_equal(dict((link, s and s.ref_id) for link, s in result.iteritems()), {
+        '[LinkPage0]': pages[0].index_id(),
+        'wiki:LinkPage1': pages[1].index_id(),
+        'test:wiki:LinkPage2': pages[2].index_id(),
+        'test:wiki:LinkPage2:foo': None,
+        'nosuchproject:wiki:LinkPage2': None,
+        'LinkPage_no_such_page': None,
+    })
+
+
+@with_setup(setUp, tearDown)
+def test_shortlinks_resolve_links():
+    pages = [WM.Page(title='ResolvePage%d' % i) for i in range(2)]
+    ThreadLocalORMSession.flush_all()
+    cache = ShortlinkCache()
+    links = ['ResolvePage0', 'wiki:ResolvePage1', 'ResolvePage2']
+    with patch('allura.model.index.g', shortlink_cache=cache):
+        targets = M.Shortlink.resolve_links(*links)
+        assert_equal((targets['ResolvePage0'].url, targets['ResolvePage0'].deleted),
+                     (pages[0].url(), False))
+        assert_equal(targets['wiki:ResolvePage1'].ref_id, pages[1].index_id())
+        assert_equal(targets['ResolvePage2'], None)
+        assert_equal((cache.hits, cache.misses), (0, 3))
+
+        with patch.object(M.Shortlink, '_find_targets') as find_targets:
+            targets = M.Shortlink.resolve_links(*links)
+            assert not find_targets.called
+        assert_equal(targets['ResolvePage0'].url, pages[0].url())
+        assert_equal(targets['ResolvePage2'], None)
+        assert_equal((cache.hits, cache.misses), (3, 3))
+
+        # creating the missing page drops the cached miss
+        page = WM.Page(title='ResolvePage2')
+        ThreadLocalORMSession.flush_all()
+        target = M.Shortlink.resolve_links('ResolvePage2')['ResolvePage2']
+        assert_equal(target.ref_id, page.index_id())
+
+        # as does deleting a page
+        pages[0].deleted = True
+        ThreadLocalORMSession.flush_all()
+        assert M.Shortlink.resolve_links('ResolvePage0')['ResolvePage0'].deleted
+
+
+@with_setup(setUp, tearDown)
+def test_artifact_reference_load_many():
+    pages = [WM.Page(title='LoadPage%d' % i) for i in range(3)]
+    ThreadLocalORMSession.flush_all()
+    M.ArtifactReference.from_artifacts(pages)
+    M.main_orm_session.clear()
+    M.artifact_orm_session.clear()
+    refs = M.ArtifactReference.query.find(dict(
+        _id={'$in': [p.index_id() for p in pages]})).all()
+    M.ArtifactReference.load_many(refs)
+    assert all('artifact' in r.__dict__ for r in refs)
+    assert_equal(sorted(r.artifact._id for r in refs),
+                 sorted(p._id for p in pages))
+
+
+@with_setup(setUp, tearDown)
+def test_artifact_reference_class():
+    page = WM.Page(title='ClassPage')
+    ThreadLocalORMSession.flush_all()
+    M.main_orm_session.clear()
+    ref = M.ArtifactReference.query.get(_id=page.index_id())
+    assert_equal(ref.artifact_reference.cls_name, 'forgewiki.model.wiki:Page')
+    assert_equal(ref.artifact_class, WM.Page)
+
+    # references made before class names
+    M.ArtifactReference._collection().update(
+        {'_id': page.index_id()},
+        {'$set': {'artifact_reference.cls': Binary(dumps(WM.Page))},
+         '$unset': {'artifact_reference.cls_name': 1}})
+    M.main_orm_session.clear()
+    ref = M.ArtifactReference.query.get(_id=page.index_id())
+    assert_equal(ref.artifact._id, page._id)
+
+
+def test_artifact_class_registry():
+    registry = ArtifactClassRegistry()
+    assert_equal(registry.name(WM.Page), 'forgewiki.model.wiki:Page')
+    assert_equal(registry.get('forgewiki.model.wiki:Page'), WM.Page)
+    registry.register(WM.Page, 'forgewiki.model.old_wiki:WikiPage')
+    assert_equal(registry.get('forgewiki.model.old_wiki:WikiPage'), WM.Page)
+    assert_raises(ImportError, registry.get, 'forgewiki.model.old_wiki:Other')
+
+
+@with_setup(setUp, tearDown)
+def test_references_from_artifacts():
+    pages = [WM.Page(title='BulkPage%d' % i) for i in range(3)]
+    ThreadLocalORMSession.flush_all()
+    M.ArtifactReference.query.remove({})
+    M.Shortlink.query.remove({})
+    M.ArtifactReference.from_artifact(pages[0])
+    M.Shortlink.from_artifact(pages[0])
+    ThreadLocalORMSession.flush_all()
+    M.main_orm_session.clear()
+
+    M.ArtifactReference.from_artifacts(pages)
+    M.Shortlink.from_artifacts(pages)
+    refs = M.ArtifactReference.query.find().all()
+    assert_equal(sorted(r._id for r in refs),
+                 sorted(p.index_id() for p in pages))
+    ref = M.ArtifactReference.query.get(_id=pages[1].index_id())
+    assert_equal(ref.artifact._id, pages[1]._id)
+    assert_equal(sorted((s.ref_id, s.link, s.url) for s in M.Shortlink.query.find()),
+                 sorted((p.index_id(), p.shorthand_id(), p.url()) for p in pages))
+
+    # existing shortlinks are updated
+    M.main_orm_session.clear()
+    pages[0].title = 'BulkPageRenamed'
+    M.Shortlink.from_artifacts(pages)
+    assert_equal(M.Shortlink.query.find().count(), 3)
+    slink = M.Shortlink.query.get(ref_id=pages[0].index_id())
+    assert_equal((slink.link, slink.url), ('BulkPageRenamed', pages[0].url()))
+
+
 @with_setup(setUp, tearDown)
 def test_gen_messageid():
     assert re.match(r'[0-9a-zA-Z]*.wiki@test.p.localhost',
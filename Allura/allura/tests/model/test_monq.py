@@ -16,7 +16,11 @@
 #       under the License.
 
 import pprint
+import socket
+from datetime import datetime, timedelta
 from nose.tools import with_setup
+import mock
+import pymongo
 
 from ming.orm import ThreadLocalORMSession
 
@@ -40,3 +44,322 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+@mock.patch.object(M.MonQSignal, 'notify')
+def test_post_signals_workers(notify):
+    task = M.MonQTask.post(pprint.pformat, ([5, 6],))
+    notify.assert_called_once_with(task)
+    notify.reset_mock()
+    M.MonQTask.post(pprint.pformat, ([5, 6],), delay=60)
+    assert not notify.called
+
+
+@with_setup(setUp)
+@mock.patch.object(M.MonQSignal, 'collection')
+def test_signal_disabled(collection):
+    M.MonQSignal.notify(M.MonQTask.post(pprint.pformat, ([5, 6],)))
+    assert not collection.called
+
+
+@with_setup(setUp)
+def test_post_many():
+    tasks = M.MonQTask.post_many(pprint.pformat, [(([5, 6],), {}), (([7],), {})])
+    assert len(tasks) == 2
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert M.MonQTask.query.find(dict(state='ready')).count() == 2
+    assert M.MonQTask.post_many(pprint.pformat, []) == []
+
+
+@with_setup(setUp)
+def test_get_many():
+    M.MonQTask.post(pprint.pformat, ([1],), delay=-4)
+    M.MonQTask.post(pprint.pformat, ([2],), priority=5, delay=-3)
+    M.MonQTask.post(pprint.pformat, ([3],), delay=-2)
+    M.MonQTask.post(pprint.pformat, ([4],), delay=-1)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_many(2, process='test')
+    assert [t.args for t in tasks] == [[[1]], [[3]]], [t.args for t in tasks]
+    assert all(t.state == 'busy' and t.process == 'test' for t in tasks)
+    # only tasks of the highest priority available are taken together
+    tasks = M.MonQTask.get_many(2, process='test')
+    assert [t.args for t in tasks] == [[[4]]], [t.args for t in tasks]
+    tasks = M.MonQTask.get_many(2, process='test')
+    assert [t.args for t in tasks] == [[[2]]], [t.args for t in tasks]
+    assert M.MonQTask.get_many(2, process='test') == []
+
+
+@with_setup(setUp)
+def test_get_many_taken():
+    taken = M.MonQTask.post(pprint.pformat, ([1],), delay=-1)
+    M.MonQTask.post(pprint.pformat, ([2],))
+    ThreadLocalORMSession.flush_all()
+    assert M.MonQTask.get(process='other') == taken
+    ThreadLocalORMSession.close_all()
+    collection = M.MonQTask._collection()
+    # the first look finds the task another worker has just claimed
+    stale = [mock.Mock(**{'sort.return_value.limit.return_value': [
+        dict(_id=taken._id, priority=taken.priority)]})]
+
+    def find(*args, **kwargs):
+        return stale.pop() if stale else collection.find(*args, **kwargs)
+    waitfunc = mock.Mock()
+    with mock.patch.object(M.MonQTask, '_collection') as _collection:
+        _collection.return_value.find.side_effect = find
+        tasks = M.MonQTask.get_many(2, process='test', waitfunc=waitfunc)
+    # the next ready one is claimed right away, without waiting
+    assert [t.args for t in tasks] == [[[2]]], [t.args for t in tasks]
+    assert not waitfunc.called
+
+
+@with_setup(setUp)
+def test_get_resets_time_start():
+    # e.g. a retried task, started before
+    for i in range(2):
+        M.MonQTask.post(pprint.pformat, ([i],), delay=-1).time_start = datetime.utcnow()
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.get(process='test')
+    tasks = M.MonQTask.get_many(2, process='test')
+    assert [t.time_start for t in [task] + tasks] == [None, None]
+
+
+@with_setup(setUp)
+def test_release():
+    M.MonQTask.post(pprint.pformat, ([1],))
+    M.MonQTask.post(pprint.pformat, ([2],))
+    ThreadLocalORMSession.flush_all()
+    tasks = M.MonQTask.get_many(2, process='test')
+    M.MonQTask.release(tasks[1:], process='test')
+    ThreadLocalORMSession.close_all()
+    assert M.MonQTask.query.find(dict(state='ready')).count() == 1
+    assert M.MonQTask.query.find(dict(state='busy')).count() == 1
+
+
+@with_setup(setUp)
+def test_post_coalesce():
+    task1 = M.MonQTask.post(pprint.pformat, ([5, 6],), coalesce=True)
+    task2 = M.MonQTask.post(pprint.pformat, ([5, 6],), coalesce=True)
+    assert task1._id == task2._id
+    assert task1.dedup_key.startswith('pprint.pformat:'), task1.dedup_key
+    task3 = M.MonQTask.post(pprint.pformat, ([7],), coalesce=True, delay=60)
+    assert task3._id != task1._id
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    # once it's been picked up, an identical post is queued again
+    M.MonQTask.get(process='test')
+    task4 = M.MonQTask.post(pprint.pformat, ([5, 6],), coalesce=True)
+    assert task4._id != task1._id
+    assert M.MonQTask.query.find().count() == 3
+
+
+@with_setup(setUp)
+def test_post_dedup_key_moves_up_delayed():
+    task1 = M.MonQTask.post(pprint.pformat, ([5, 6],), dedup_key='k', delay=60)
+    task2 = M.MonQTask.post(pprint.pformat, ([7],), dedup_key='k')
+    assert task1._id == task2._id
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.query.get(_id=task1._id)
+    assert task.time_queue <= datetime.utcnow(), task.time_queue
+    assert M.MonQTask.query.find().count() == 1
+
+
+@with_setup(setUp)
+def test_post_dedup_key_concurrent():
+    task1 = M.MonQTask.post(pprint.pformat, ([5, 6],), dedup_key='k')
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    collection = M.MonQTask._collection()
+    # another post's upsert won the unique index
+    errors = [pymongo.errors.DuplicateKeyError('dup')]
+
+    def find_and_modify(*args, **kwargs):
+        if errors:
+            raise errors.pop()
+        return collection.find_and_modify(*args, **kwargs)
+    with mock.patch.object(M.MonQTask, '_collection') as _collection:
+        _collection.return_value.find_and_modify.side_effect = find_and_modify
+        task2 = M.MonQTask.post(pprint.pformat, ([5, 6],), dedup_key='k')
+    assert task2._id == task1._id
+    assert _collection.return_value.find_and_modify.call_count == 2
+    assert M.MonQTask.query.find().count() == 1
+
+
+@with_setup(setUp)
+def test_post_dedup_key_keeps_retry_backoff():
+    task1 = M.MonQTask.post(pprint.pformat, ([5, 6],), dedup_key='k', delay=60)
+    M.MonQTask.query.update({'_id': task1._id}, {'$set': {'retries': 1}})
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task2 = M.MonQTask.post(pprint.pformat, ([7],), dedup_key='k')
+    assert task2._id == task1._id
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.query.get(_id=task1._id)
+    assert task.time_queue > datetime.utcnow(), task.time_queue
+
+
+@with_setup(setUp)
+def test_post_dedup_key_fills_unfinished():
+    # a post that died between the upsert and filling the task in
+    M.MonQTask._collection().insert({'dedup_key': 'k', 'state': 'ready'})
+    task = M.MonQTask.post(pprint.pformat, ([5, 6],), dedup_key='k')
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert M.MonQTask.query.find().count() == 1
+    task = M.MonQTask.get(process='test')
+    assert task.task_name == 'pprint.pformat', task.task_name
+    assert task.args == [[5, 6]], task.args
+
+
+def test_lanes():
+    lanes = M.MonQLanes({
+        'monq.lanes': 'bulk, mail',
+        'monq.lane.bulk.tasks': 'allura.tasks.repo_tasks.clone allura.tasks.export_tasks.*',
+        'monq.lane.bulk.max_workers': '2',
+        'monq.lane.mail.tasks': 'allura.tasks.mail_tasks.*',
+        'monq.lane.mail.min_workers': '1',
+    })
+    assert lanes.names == ['bulk', 'mail', 'default'], lanes.names
+    assert lanes.lane_for('allura.tasks.repo_tasks.clone') == 'bulk'
+    assert lanes.lane_for('allura.tasks.export_tasks.bulk_export') == 'bulk'
+    assert lanes.lane_for('allura.tasks.mail_tasks.sendmail') == 'mail'
+    assert lanes.lane_for('allura.tasks.repo_tasks.refresh') == 'default'
+    assert lanes.max_workers == {'bulk': 2, 'mail': None, 'default': None}
+    assert lanes.assign(3) == ['mail', None, None]
+    # always leaves a worker for the other lanes
+    assert lanes.assign(1) == [None]
+    assert lanes.assign(2) == ['mail', None]
+    assert M.MonQLanes({}).names == ['default']
+
+
+@with_setup(setUp)
+def test_get_lanes():
+    task = M.MonQTask.post(pprint.pformat, ([5, 6],))
+    assert task.lane == 'default', task.lane
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert M.MonQTask.get(process='test', lanes=['bulk']) is None
+    assert M.MonQTask.get(process='test', lanes=lambda: ['default']) is not None
+
+
+@with_setup(setUp)
+def test_archive():
+    M.MonQTask._archive_collection().remove({})
+    old = datetime.utcnow() - timedelta(days=10)
+    done = M.MonQTask.post(pprint.pformat, ([1],))
+    done.state, done.time_stop = 'complete', old
+    failed = M.MonQTask.post(pprint.pformat, ([2],))
+    failed.state, failed.time_queue = 'error', old
+    recent = M.MonQTask.post(pprint.pformat, ([3],))
+    recent.state, recent.time_stop = 'complete', datetime.utcnow()
+    ready = M.MonQTask.post(pprint.pformat, ([4],), delay=-10 * 24 * 3600)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    moved = M.MonQTask.archive(datetime.utcnow() - timedelta(days=7), batch_size=1)
+    assert moved == 2, moved
+    assert sorted(t._id for t in M.MonQTask.query.find()) == sorted([recent._id, ready._id])
+    archived = M.MonQTask._archive_collection().find()
+    assert sorted(d['_id'] for d in archived) == sorted([done._id, failed._id])
+
+
+@with_setup(setUp)
+def test_metrics():
+    M.MonQTask.post(pprint.pformat, ([1],), delay=-5)
+    M.MonQTask.post(pprint.pformat, ([2],), delay=60)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    with mock.patch('allura.model.monq_model.stats_log') as stats_log:
+        M.MonQTask.get(process='test')()
+    meta = stats_log.info.call_args[1]['meta']
+    assert meta['task_name'] == 'pprint.pformat', meta
+    assert meta['state'] == 'complete', meta
+    assert meta['lane'] == 'default', meta
+    assert meta['wait_ms'] >= 5000, meta
+
+    now = datetime.utcnow()
+    tasks = M.MonQTask._collection()
+    # from before tasks had lanes
+    tasks.insert({'state': 'ready', 'task_name': 'pprint.pformat',
+                  'time_queue': now - timedelta(seconds=30)})
+    tasks.insert({'state': 'busy', 'task_name': 'pprint.pformat', 'lane': 'bulk',
+                  'time_queue': now - timedelta(seconds=60)})
+    metrics = M.MonQMetrics.collect(now - timedelta(minutes=1))
+    assert dict(metrics.pending) == {
+        ('ready', 'default', 'pprint.pformat'): 2,
+        ('busy', 'bulk', 'pprint.pformat'): 1}, metrics.pending
+    # the delayed task isn't waiting yet
+    assert metrics.oldest.keys() == [('default', 'pprint.pformat')], metrics.oldest
+    assert 30 <= metrics.oldest['default', 'pprint.pformat'] < 40, metrics.oldest
+    assert dict(metrics.finished) == {('complete', 'default', 'pprint.pformat'): 1}, metrics.finished
+    counts, total, count = metrics.wait['default', 'pprint.pformat']
+    assert count == 1 and total >= 5, (total, count)
+    text = metrics.render()
+    assert 'monq_tasks{lane="default",state="ready",task_name="pprint.pformat"} 2\n' in text, text
+    assert 'monq_task_wait_seconds_bucket{lane="default",le="+Inf",task_name="pprint.pformat"} 1\n' in text, text
+    assert 'monq_task_run_seconds_count{lane="default",task_name="pprint.pformat"} 1\n' in text, text
+
+
+@with_setup(setUp)
+def test_post_spills_large_args():
+    with mock.patch.dict('allura.model.monq_model.config', {'monq.args_spill_size': '1000'}):
+        small = M.MonQTask.post(pprint.pformat, ([5, 6],))
+        big = M.MonQTask.post(pprint.pformat, (range(1000),), dict(width=10))
+    assert small.args_file is None
+    assert small.args == [[5, 6]], small.args
+    assert big.args_file is not None
+    assert big.args == [] and big.kwargs == {}, (big.args, big.kwargs)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.query.get(_id=big._id)
+    task()
+    assert task.result == pprint.pformat(range(1000), width=10), task.result
+    M.MonQTask.clear_complete()
+    assert not M.MonQTask._args_fs().exists(big.args_file)
+
+
+@with_setup(setUp)
+def test_retry():
+    def flaky(*args):
+        raise socket.error('down')
+    flaky.retry_policy = dict(max_retries=2, backoff=30, retry_on=socket.error)
+    task = M.MonQTask.post(pprint.pformat, ([1],))
+    with mock.patch.object(M.MonQTask, 'function', new_callable=mock.PropertyMock, return_value=flaky), \
+            mock.patch.dict('allura.model.monq_model.config', {'monq.raise_errors': 'false'}):
+        task()
+        assert task.state == 'ready', task.state
+        assert task.retries == 1, task.retries
+        assert task.time_queue > datetime.utcnow() + timedelta(seconds=25), task.time_queue
+        task()
+        assert task.state == 'ready', task.state
+        assert task.time_queue > datetime.utcnow() + timedelta(seconds=55), task.time_queue
+        task()
+        assert task.state == 'error', task.state
+        assert task.retries == 2, task.retries
+    # exceptions the policy doesn't cover aren't retried
+    task = M.MonQTask.post(pprint.pformat, ([1],))
+    assert task.retry_delay(flaky, ValueError()) is None
+    assert task.retry_delay(pprint.pformat, socket.error()) is None
+    assert task.retry_delay(flaky, socket.error()) == 30
+
+
+@with_setup(setUp)
+def test_retry_dedup_key_queued_again():
+    def flaky(*args):
+        raise socket.error('down')
+    flaky.retry_policy = dict(max_retries=2, backoff=30, retry_on=socket.error)
+    task = M.MonQTask.post(pprint.pformat, ([1],), dedup_key='k')
+    # starting it, then queueing it for a retry
+    orm_session = mock.Mock()
+    orm_session.flush.side_effect = [None, pymongo.errors.DuplicateKeyError('dup'), None]
+    with mock.patch.object(M.MonQTask, 'function', new_callable=mock.PropertyMock, return_value=flaky), \
+            mock.patch.dict('allura.model.monq_model.config', {'monq.raise_errors': 'false'}), \
+            mock.patch('allura.model.monq_model.session', return_value=orm_session):
+        task()
+    # a task with the same key was posted while it ran, no need to retry it
+    assert task.state == 'skipped', task.state
+    assert orm_session.flush.call_count == 3
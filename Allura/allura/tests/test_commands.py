@@ -15,18 +15,26 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
+import threading
+import multiprocessing
+from collections import defaultdict
+from datetime import datetime, timedelta
+
 from nose.tools import assert_raises, assert_in
 from datadiff.tools import assert_equal
 
+from bson import ObjectId
+from ming import mim, Index
 from ming.base import Object
 from ming.orm import ThreadLocalORMSession
 from mock import Mock, call, patch
-import pymongo
+from pymongo.errors import DuplicateKeyError
 import pkg_resources
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.command import base, script, set_neighborhood_features, \
-    create_neighborhood, show_models, taskd_cleanup
+    create_neighborhood, show_models, taskd_cleanup, taskd
 from allura import model as M
 from allura.lib.exceptions import InvalidNBFeatureValueError
 from allura.tests import decorators as td
@@ -262,6 +270,36 @@ def test_update_indexes_unique_changes(self):
         ])
 
 
+    def test_update_indexes_partial_unique(self):
+        partial = {'state': 'ready', 'dedup_key': {'$type': 'string'}}
+        options = {'unique': True, 'sparse': False, 'partialFilterExpression': partial}
+        indexes = [Mock(index_spec=[('foo', 1)], unique=True, index_options=options)]
+        collection = Mock(name='collection')
+        collection.index_information.return_value = {
+            '_id_': {'key': '_id'},
+            '_foo': {'key': [('foo', 1)]},
+        }
+        collection.ensure_index.side_effect = ['_foo_temporary_extra_field_for_indexing', '_foo',
+                                               DuplicateKeyError('dup'), '_foo']
+        cmd = show_models.EnsureIndexCommand('ensure_index')
+        with patch.object(cmd, '_remove_dupes') as remove_dupes:
+            cmd._update_indexes(collection, indexes)
+        # the filter is kept, also when removing dupes
+        assert_in(call.ensure_index([('foo', 1)], unique=True, partialFilterExpression=partial),
+                  collection.mock_calls)
+        remove_dupes.assert_called_once_with(collection, [('foo', 1)], partial)
+        assert_equal(collection.ensure_index.call_args, call([('foo', 1)], **options))
+
+        # mim ignores the filter, and would make it unique among all documents
+        collection = Mock(spec=mim.Collection)
+        collection.index_information.return_value = {'_foo': {'key': [('foo', 1)]}}
+        cmd._update_indexes(collection, [Index(fields=('foo',), **options)])
+        collection.ensure_index.assert_called_once_with(
+            [('foo', 1)], background=True, unique=False, sparse=False,
+            partialFilterExpression=partial)
+        assert not collection.drop_index.called
+
+
 class TestTaskdCleanupCommand(object):
 
     def setUp(self):
@@ -357,6 +395,21 @@ def test_suspicious_tasks(self):
         assert cmd.error_tasks == [], cmd.error_tasks
         assert task1.state == 'complete'
 
+    @patch.object(M.MonQTask, 'archive')
+    def test_archive_tasks(self, archive):
+        archive.return_value = 3
+        cmd = self.cmd_class('taskd_command')
+        cmd.run([test_config, 'fake.log'])
+        assert cmd.archived == 3, cmd.archived
+        older_than = archive.call_args[0][0]
+        assert older_than < datetime.utcnow() - timedelta(days=6), older_than
+
+        archive.reset_mock()
+        cmd = self.cmd_class('taskd_command')
+        cmd.run([test_config, '-a', '0', 'fake.log'])
+        assert not archive.called
+        assert cmd.archived == 0, cmd.archived
+
 
 # taskd_cleanup unit tests
 def test_status_log_retries():
@@ -376,6 +429,65 @@ def test_status_log_retries():
     assert cmd._taskd_status.mock_calls == expected_calls
 
 
+@patch('allura.command.base.log')
+def test_taskd_check_recycle(log):
+    cmd = taskd.TaskdCommand('taskd')
+    cmd.options = Mock(max_tasks=2, max_rss_mb=0)
+    cmd.keep_running, cmd.restart_when_done, cmd.supervised = True, False, False
+    cmd.tasks_run, cmd.tasks_run_lock = 0, threading.Lock()
+    cmd.check_recycle()
+    assert cmd.keep_running
+    cmd.check_recycle()
+    assert not cmd.keep_running
+    assert cmd.restart_when_done
+
+    # a worker forked by the master just stops, and the master replaces it
+    cmd.options = Mock(max_tasks=0, max_rss_mb=100)
+    cmd.keep_running, cmd.restart_when_done, cmd.supervised = True, False, True
+    with patch.object(taskd, 'rss_mb', return_value=50):
+        cmd.check_recycle()
+    assert cmd.keep_running
+    with patch.object(taskd, 'rss_mb', return_value=150):
+        cmd.check_recycle()
+    assert not cmd.keep_running
+    assert not cmd.restart_when_done
+
+
+def test_taskd_reset_lane_counts():
+    setup_basic_test()
+    M.MonQTask.query.remove({})
+    cmd = taskd.TaskdCommand('taskd')
+    cmd.workers = {1111: None}
+    cmd.lanes = M.MonQLanes({'monq.lanes': 'bulk'})
+    cmd.lane_busy = multiprocessing.Array('i', [5, 5])
+    process = '%s pid 1111' % os.uname()[1]
+    for time_start in [datetime.utcnow(), None]:
+        M.MonQTask(task_name='allura.tasks.repo_tasks.refresh', state='busy',
+                   process=process, time_start=time_start)
+    ThreadLocalORMSession.flush_all()
+    cmd.reset_lane_counts()
+    # the task that was claimed but not started doesn't count
+    assert list(cmd.lane_busy) == [0, 1], list(cmd.lane_busy)
+
+
+@patch('allura.command.base.log')
+@patch.object(taskd, 'status_log')
+def test_taskd_log_current_task(status_log, log):
+    cmd = taskd.TaskdCommand('taskd')
+    cmd.tasks = {'worker-0': 'task1', 'worker-1': None}
+    # the rest of worker-0's batch is busy under this process too
+    cmd.claimed = {'worker-0': ['task2']}
+    cmd.log_current_task(None, None)
+    entry = status_log.info.call_args[0][0]
+    assert 'is currently handling task task1' in entry, entry
+    assert 'is currently handling task task2' in entry, entry
+
+    cmd.tasks, cmd.claimed = {}, {}
+    cmd.log_current_task(None, None)
+    entry = status_log.info.call_args[0][0]
+    assert entry.endswith('is currently handling task None'), entry
+
+
 class TestBackgroundCommand(object):
 
     cmd = 'allura.command.show_models.ReindexCommand'
@@ -417,20 +529,36 @@ def test_skip_solr_delete(self, g):
         cmd.run([test_config, '-p', 'test', '--solr', '--skip-solr-delete'])
         assert not g.solr.delete.called, 'solr.delete() must not be called'
 
+    def _ref_ids(self):
+        # artifacts already indexed unchanged aren't sent to solr again
+        ref_ids = [ref._id for ref in M.ArtifactReference.query.find().limit(10)]
+        M.ArtifactReference.query.update(
+            {'_id': {'$in': ref_ids}}, {'$set': {'index_fingerprint': None}}, multi=True)
+        return ref_ids
+
     @patch('pysolr.Solr')
     def test_solr_hosts_1(self, Solr):
         cmd = show_models.ReindexCommand('reindex')
         cmd.options, args = cmd.parser.parse_args([
             '-p', 'test', '--solr', '--solr-hosts=http://blah.com/solr/forge'])
-        cmd._chunked_add_artifacts(list(range(10)))
+        cmd._chunked_add_artifacts(self._ref_ids())
         assert_equal(Solr.call_args[0][0], 'http://blah.com/solr/forge')
 
+    @patch('pysolr.Solr')
+    def test_solr_hosts_nothing_to_add(self, Solr):
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.options, args = cmd.parser.parse_args([
+            '-p', 'test', '--solr', '--solr-hosts=http://blah.com/solr/forge'])
+        # no such artifacts
+        cmd._chunked_add_artifacts(list(range(10)))
+        assert not Solr.called
+
     @patch('pysolr.Solr')
     def test_solr_hosts_list(self, Solr):
         cmd = show_models.ReindexCommand('reindex')
         cmd.options, args = cmd.parser.parse_args([
             '-p', 'test', '--solr', '--solr-hosts=http://blah.com/solr/forge,https://other.net/solr/forge'])
-        cmd._chunked_add_artifacts(list(range(10)))
+        cmd._chunked_add_artifacts(self._ref_ids())
         # check constructors of first and second Solr() instantiations
         assert_equal(
             set([Solr.call_args_list[0][0][0], Solr.call_args_list[1][0][0]]),
@@ -445,6 +573,42 @@ def test_project_regex(self, utils):
         utils.chunked_find.assert_called_once_with(
             M.Project, {'shortname': {'$regex': '^test'}})
 
+    @patch('allura.command.show_models.g')
+    @patch.object(show_models.ReindexCommand, '_reindex_project')
+    def test_resume(self, reindex_project, g):
+        reindex_project.return_value = {'Page': (3, 1.0)}
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.run([test_config, '-p', 'test', '--solr'])
+        assert_equal(reindex_project.call_count, 1)
+        assert_equal(dict(cmd.stats), {'Page': [3, 1.0]})
+        cmd.run([test_config, '-p', 'test', '--solr', '--resume'])
+        assert_equal(reindex_project.call_count, 1)
+        # different options are a different run
+        cmd.run([test_config, '-p', 'test', '--refs', '--resume'])
+        assert_equal(reindex_project.call_count, 2)
+        cmd.run([test_config, '-p', 'test', '--solr'])
+        assert_equal(reindex_project.call_count, 3)
+
+    @patch('allura.command.show_models.multiprocessing')
+    def test_workers(self, multiprocessing):
+        p1, p2 = ObjectId(), ObjectId()
+        pool = multiprocessing.Pool.return_value
+        pool.imap_unordered.return_value = [
+            (p1, {'Page': (3, 1.0), 'Ticket': (1, 1.0)}),
+            (p2, None),  # failed
+        ]
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.options, args = cmd.parser.parse_args(['--workers', '2'])
+        cmd.stats = defaultdict(lambda: [0, 0.0])
+        M.ReindexCheckpoint.clear(cmd.run_name)
+        cmd._reindex_in_workers([p1, p2])
+        multiprocessing.Pool.assert_called_once_with(
+            2, initializer=show_models._init_reindex_worker)
+        pool.imap_unordered.assert_called_once_with(
+            show_models._reindex_project_in_worker, [p1, p2])
+        assert_equal(M.ReindexCheckpoint.done(cmd.run_name), set([p1]))
+        assert_equal(dict(cmd.stats), {'Page': [3, 1.0], 'Ticket': [1, 1.0]})
+
     @patch('allura.command.show_models.add_artifacts')
     def test_chunked_add_artifacts(self, add_artifacts):
         cmd = show_models.ReindexCommand('reindex')
@@ -457,40 +621,3 @@ def test_chunked_add_artifacts(self, add_artifacts):
         assert_equal(
             len(add_artifacts.post.call_args_list[1][0][0]), 10 * 1000)
         assert_equal(len(add_artifacts.post.call_args_list[2][0][0]), 20)
-
-    @patch('allura.command.show_models.add_artifacts')
-    def test_post_add_artifacts_too_large(self, add_artifacts):
-        def on_post(chunk, **kw):
-            if len(chunk) > 1:
-                e = pymongo.errors.InvalidDocument(
-                    "BSON document too large (16906035 bytes) - the connected server supports BSON document sizes up to 16777216 bytes.")
-                # ming injects a 2nd arg with the document, so we do too
-                e.args = e.args + ("doc:  {'task_name': 'allura.tasks.index_tasks.add_artifacts', ........",)
-                raise e
-        add_artifacts.post.side_effect = on_post
-        cmd = show_models.ReindexCommand('reindex')
-        cmd.options, args = cmd.parser.parse_args([])
-        cmd._post_add_artifacts(range(5))
-        kw = {'update_solr': cmd.options.solr, 'update_refs': cmd.options.refs}
-        expected = [
-            call([0, 1, 2, 3, 4], **kw),
-            call([0, 1], **kw),
-            call([0], **kw),
-            call([1], **kw),
-            call([2, 3, 4], **kw),
-            call([2], **kw),
-            call([3, 4], **kw),
-            call([3], **kw),
-            call([4], **kw)
-        ]
-        assert_equal(expected, add_artifacts.post.call_args_list)
-
-    @patch('allura.command.show_models.add_artifacts')
-    def test_post_add_artifacts_other_error(self, add_artifacts):
-        def on_post(chunk, **kw):
-            raise pymongo.errors.InvalidDocument("Cannot encode object...")
-        add_artifacts.post.side_effect = on_post
-        cmd = show_models.ReindexCommand('reindex')
-        cmd.options = Mock(ming_config=None)
-        with td.raises(pymongo.errors.InvalidDocument):
-            cmd._post_add_artifacts(range(5))
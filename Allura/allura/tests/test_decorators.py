@@ -36,6 +36,18 @@ def func():
             pass
         self.assertTrue(hasattr(func, 'post'))
 
+    def test_retry_policy(self):
+        @task(max_retries=3, retry_backoff=10, retry_on=(IOError,))
+        def func():
+            pass
+        self.assertEqual(func.retry_policy,
+                         dict(max_retries=3, backoff=10, retry_on=(IOError,)))
+
+        @task
+        def func2():
+            pass
+        self.assertFalse(hasattr(func2, 'retry_policy'))
+
     @patch('allura.lib.decorators.c')
     @patch('allura.model.MonQTask')
     def test_post(self, c, MonQTask):
@@ -43,7 +55,7 @@ def test_post(self, c, MonQTask):
         def func(s, foo=None, **kw):
             pass
 
-        def mock_post(f, args, kw, delay=None):
+        def mock_post(f, args, kw, delay=None, coalesce=False):
             self.assertTrue(c.project.notifications_disabled)
             self.assertFalse('delay' in kw)
             self.assertEqual(delay, 1)
@@ -54,3 +66,14 @@ def mock_post(f, args, kw, delay=None):
         c.project.notifications_disabled = False
         MonQTask.post.side_effect = mock_post
         func.post('test', foo=2, delay=1)
+
+    @patch('allura.lib.decorators.c')
+    @patch('allura.model.MonQTask')
+    def test_post_many(self, MonQTask, c):
+        @task
+        def func(s, foo=None):
+            pass
+
+        calls = [(('a',), {}), (('b',), dict(foo=2))]
+        func.post_many(calls, delay=1)
+        MonQTask.post_many.assert_called_once_with(func, calls, delay=1)
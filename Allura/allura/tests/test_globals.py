@@ -751,6 +751,152 @@ def test_all_expected_keys_exist_in_cache(self):
         self.assertEqual(required_keys, keys)
 
 
+class TestMarkdownRenderCache(unittest.TestCase):
+
+    def setUp(self):
+        setup_global_objects()
+        self.cache = M.MarkdownRenderCache(maxsize=10, ttl=60, shared_size=10)
+        self.md = ForgeMarkdown(flavor='forge', render_cache=self.cache)
+
+    def tearDown(self):
+        M.markdown_cache.RenderedMarkdownDoc.m.remove({})
+
+    def test_convert_cached(self):
+        html = self.md.convert(u'**bold**')
+        self.assertEqual(html, u'<p><strong>bold</strong></p>')
+        with patch('markdown.Markdown.convert') as convert:
+            self.assertEqual(self.md.convert(u'**bold**'), html)
+            self.assertFalse(convert.called)
+        self.assertEqual(self.cache.stats, {'forge': dict(hits=1, misses=1)})
+
+    def test_key(self):
+        key = self.cache.key(u'**bold**', 'forge', 3)
+        self.assertEqual(key, self.cache.key(u'**bold**', 'forge', 3))
+        self.assertNotEqual(key, self.cache.key(u'**bold**', 'commit', 3))
+        self.assertNotEqual(key, self.cache.key(u'**bold**', 'forge', 4))
+        self.assertNotEqual(key, self.cache.key(u'*bold*', 'forge', 3))
+        with h.push_context('test', 'src', neighborhood='Projects'):
+            self.assertNotEqual(key, self.cache.key(u'**bold**', 'forge', 3))
+
+    def test_macros_not_cached(self):
+        self.md.convert(u'[[project_admins]]')
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.stats, {})
+
+    def test_shared(self):
+        html = self.md.convert(u'**bold**')
+        other = M.MarkdownRenderCache(maxsize=10, ttl=60, shared_size=10)
+        md = ForgeMarkdown(flavor='forge', render_cache=other)
+        with patch('markdown.Markdown.convert') as convert:
+            self.assertEqual(md.convert(u'**bold**'), html)
+            self.assertFalse(convert.called)
+
+    def test_trim(self):
+        for i in range(5):
+            M.markdown_cache.RenderedMarkdownDoc.make(dict(
+                _id=str(i), flavor='forge', html=u'html',
+                created=dt.datetime(2014, 1, 1, 0, 0, i))).m.save()
+        M.RenderedMarkdown.trim(2)
+        self.assertEqual(M.RenderedMarkdown.count(), 2)
+        self.assertEqual(M.RenderedMarkdown.get('4'), u'html')
+        self.assertIsNone(M.RenderedMarkdown.get('0'))
+
+    def test_from_config(self):
+        self.assertIsNone(M.MarkdownRenderCache.from_config({}))
+        cache = M.MarkdownRenderCache.from_config({
+            'markdown_render_cache.size': '100',
+            'markdown_render_cache.shared_size': '1000'})
+        self.assertEqual(cache.shared_size, 1000)
+        self.assertEqual(cache.ttl, 300)
+
+
+class TestMarkdownRenderWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        setup_global_objects()
+        self.cache = M.MarkdownRenderCache(maxsize=10, ttl=60, shared_size=10)
+        self.watchdog = Mock(**{'watches.return_value': True})
+        self.md = ForgeMarkdown(flavor='forge', forge_options={},
+                                render_cache=self.cache,
+                                render_watchdog=self.watchdog)
+
+    def tearDown(self):
+        M.markdown_cache.RenderedMarkdownDoc.m.remove({})
+
+    def test_convert(self):
+        self.watchdog.convert.return_value = u'<p><strong>bold</strong></p>'
+        self.assertEqual(self.md.convert(u'**bold**'),
+                         u'<p><strong>bold</strong></p>')
+        self.watchdog.convert.assert_called_once_with('forge', {}, u'**bold**')
+        self.assertEqual(len(self.cache), 1)
+
+    @patch('allura.tasks.markdown_tasks.render_markdown.post')
+    def test_timeout(self, post):
+        from allura.lib.exceptions import MarkdownRenderTimeout
+        self.watchdog.convert.side_effect = MarkdownRenderTimeout
+        self.assertEqual(self.md.convert(u'<b>bold</b>'),
+                         u'<pre>&lt;b&gt;bold&lt;/b&gt;</pre>')
+        post.assert_called_once_with('forge', {}, u'<b>bold</b>')
+        self.assertEqual(len(self.cache), 0)
+
+    @patch('allura.tasks.markdown_tasks.render_markdown.post')
+    @patch.dict('allura.lib.app_globals.config', markdown_cache_threshold='0')
+    def test_timeout_not_saved(self, post):
+        from allura.lib.exceptions import MarkdownRenderTimeout
+        self.watchdog.convert.side_effect = MarkdownRenderTimeout
+        artifact = M.Post()
+        artifact.text = u'**bold**'
+        html = self.md.cached_convert(artifact, 'text')
+        self.assertEqual(html, u'<pre>**bold**</pre>')
+        self.assertIsInstance(html, M.PlainTextFallback)
+        self.assertIsNone(artifact.text_cache.md5)
+        self.assertIsNone(artifact.text_cache.html)
+
+    @patch.dict('allura.lib.app_globals.config', markdown_cache_threshold='0')
+    def test_shared_fallback_not_saved(self):
+        # as cached by the render_markdown task when it timed out too
+        key = self.cache.key(u'**bold**', 'forge', self.md.cache_bugfix_rev)
+        self.cache.set(key, 'forge', M.PlainTextFallback(u'<pre>**bold**</pre>'))
+        self.cache.clear()
+        artifact = M.Post()
+        artifact.text = u'**bold**'
+        html = self.md.cached_convert(artifact, 'text')
+        self.assertIsInstance(html, M.PlainTextFallback)
+        self.assertIsNone(artifact.text_cache.md5)
+        self.assertFalse(self.watchdog.convert.called)
+
+    def test_start(self):
+        from allura.lib.markdown_watchdog import MarkdownWatchdog, _init_worker
+        watchdog = MarkdownWatchdog(processes=1)
+        app_globals = Mock()
+        with patch('multiprocessing.Pool') as Pool:
+            watchdog.start(app_globals)
+            Pool.assert_called_once_with(1, initializer=_init_worker,
+                                         initargs=(app_globals,))
+            # forked up front, not on first use
+            self.assertIs(watchdog._get_pool(), Pool.return_value)
+            self.assertEqual(Pool.call_count, 1)
+
+    def test_limit_cpu(self):
+        from allura.lib.markdown_watchdog import _limit_cpu
+        import resource
+        with patch('resource.setrlimit') as setrlimit:
+            _limit_cpu(5)
+        limit, hard = setrlimit.call_args[0][1]
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.assertTrue(usage.ru_utime + usage.ru_stime + 5 <= limit)
+
+    def test_from_config(self):
+        from allura.lib.markdown_watchdog import MarkdownWatchdog
+        self.assertIsNone(MarkdownWatchdog.from_config({}))
+        watchdog = MarkdownWatchdog.from_config({
+            'markdown_render_watchdog.timeout': '2.5',
+            'markdown_render_watchdog.min_length': '1000'})
+        self.assertEqual(watchdog.timeout, 2.5)
+        self.assertFalse(watchdog.watches(u'short'))
+        self.assertTrue(watchdog.watches(u'x' * 1000))
+
+
 class TestHandlePaging(unittest.TestCase):
 
     def setUp(self):
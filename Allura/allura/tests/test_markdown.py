@@ -113,10 +113,12 @@ def test_run(self, lookup):
 class TestCommitMessageExtension(unittest.TestCase):
 
     @mock.patch('allura.lib.markdown_extensions.TracRef2.get_comment_slug')
+    @mock.patch('allura.lib.markdown_extensions.M.Shortlink.resolve_links')
     @mock.patch('allura.lib.markdown_extensions.M.Shortlink.lookup')
-    def test_convert(self, lookup, get_comment_slug):
+    def test_convert(self, lookup, resolve_links, get_comment_slug):
         from allura.lib.app_globals import ForgeMarkdown
 
+        resolve_links.return_value = {}
         shortlink = mock.Mock(url='/p/project/tool/artifact/')
         shortlink.ref.artifact.deleted = False
         lookup.return_value = shortlink
@@ -146,3 +148,42 @@ def test_convert(self, lookup, get_comment_slug):
             extensions=[mde.CommitMessageExtension(app), 'nl2br'],
             output_format='html4')
         self.assertEqual(md.convert(text), expected_html)
+
+
+class TestForgeLinkPreprocessor(unittest.TestCase):
+
+    def setUp(self):
+        self.ext = mde.ForgeExtension()
+        self.pre = mde.ForgeLinkPreprocessor(mock.Mock(), ext=self.ext)
+
+    def test_find_links(self):
+        links = self.pre.find_links(
+            'See [#1], [wiki:Home] and [the docs](docs:Page/attachment/a.png)\n'
+            '[x](http://example.com/ "title") [[include ref=Foo]] [TOC]')
+        self.assertEqual(sorted(links), [
+            '#1', '[include ref=Foo', 'docs:Page', 'docs:Page/attachment/a.png',
+            'http://example.com/', 'the docs', 'wiki:Home', 'x'])
+        self.assertEqual(self.pre.find_links('no links'), [])
+
+    @mock.patch('allura.lib.markdown_extensions.M')
+    def test_run(self, M):
+        target = mock.Mock(url='/p/test/wiki/Home/', deleted=False, is_closed=True)
+        M.Shortlink.resolve_links.return_value = {'#1': target, 'nope': None}
+        lines = ['[#1] and [nope]']
+        self.assertEqual(self.pre.run(lines), lines)
+        self.assertEqual(sorted(M.Shortlink.resolve_links.call_args[0]), ['#1', 'nope'])
+        self.assertEqual(self.ext.shortlinks, {'#1': target, 'nope': None})
+
+        # the link pattern uses them, rather than looking them up again
+        self.ext.forge_link_tree_processor = mde.ForgeLinkTreeProcessor(None)
+        pattern = mde.ForgeLinkPattern(mde.markdown.inlinepatterns.SHORT_REF_RE,
+                                       mock.Mock(), ext=self.ext)
+        M.Shortlink.resolve_links.reset_mock()
+        self.assertEqual(pattern._expand_alink('#1', True),
+                         ('/p/test/wiki/Home/', 'alink strikethrough'))
+        self.assertEqual(pattern._expand_alink('nope', True), ('nope', 'alink notfound'))
+        self.assertFalse(M.Shortlink.resolve_links.called)
+        self.assertEqual(self.ext.forge_link_tree_processor.alinks, [target])
+        M.Shortlink.resolve_links.return_value = {}
+        self.assertEqual(pattern._expand_alink('other', False), ('other', ''))
+        M.Shortlink.resolve_links.assert_called_once_with('other')
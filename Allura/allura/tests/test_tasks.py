@@ -22,6 +22,7 @@
 import sys
 import unittest
 from base64 import b64encode
+from datetime import datetime
 import logging
 
 import tg
@@ -38,7 +39,8 @@
 from allura import model as M
 from allura.lib import helpers as h
 from allura.lib import search
-from allura.lib.exceptions import CompoundError
+from allura.lib.exceptions import CompoundError, MarkdownRenderTimeout
+from allura.model.index import ShortlinkCache
 from allura.tasks import event_tasks
 from allura.tasks import index_tasks
 from allura.tasks import mail_tasks
@@ -46,6 +48,7 @@
 from allura.tasks import repo_tasks
 from allura.tasks import export_tasks
 from allura.tasks import admin_tasks
+from allura.tasks import markdown_tasks
 from allura.tests import decorators as td
 from allura.lib.decorators import event_handler, task
 
@@ -137,9 +140,8 @@ def test_del_projects(self):
 
         with mock.patch('allura.tasks.index_tasks.g.solr') as solr:
             index_tasks.del_projects([p.index_id() for p in projects])
-            assert solr.delete.call_count, 1
-            for project in projects:
-                assert project.index_id() in solr.delete.call_args[1]['q']
+            solr.delete_ids.assert_called_once_with(
+                [p.index_id() for p in projects], chunk_size=1000)
 
     @td.with_wiki
     def test_add_artifacts(self):
@@ -196,8 +198,196 @@ def test_del_artifacts(self, solr):
         M.main_orm_session.clear()
         new_shortlinks = M.Shortlink.query.find().count()
         assert old_shortlinks == new_shortlinks, 'Shortlinks not deleted'
-        solr_query = 'id:({0})'.format(' || '.join(ref_ids))
-        solr.delete.assert_called_once_with(q=solr_query)
+        solr.delete_ids.assert_called_once_with(ref_ids, chunk_size=1000)
+        assert not solr.delete.called
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_solr_del_tool(self, solr):
+        artifacts = [_TestArtifact(_shorthand_id='td_%s' % x)
+                     for x in range(3)]
+        M.artifact_orm_session.flush()
+        ref_ids = [M.ArtifactReference.from_artifact(a)._id for a in artifacts]
+        M.artifact_orm_session.flush()
+        project_id, app_config = c.project._id, c.app.config
+        # the wiki's own pages etc. are in the tool too
+        tool_ref_ids = [ref._id for ref in M.ArtifactReference.query.find({
+            'artifact_reference.project_id': project_id,
+            'artifact_reference.app_config_id': app_config._id})]
+        assert set(ref_ids) <= set(tool_ref_ids)
+        index_tasks.solr_del_tool(project_id, app_config.options.mount_point, app_config._id)
+        assert_equal(sorted(solr.delete_ids.call_args[0][0]), sorted(tool_ref_ids))
+        # and then whatever is left, e.g. without references
+        solr.delete.assert_called_once_with(
+            q='project_id_s:"%s" AND mount_point_s:"%s"' % (project_id, app_config.options.mount_point))
+
+        solr.reset_mock()
+        index_tasks.solr_del_project_artifacts(project_id)
+        assert set(ref_ids) <= set(solr.delete_ids.call_args[0][0])
+        solr.delete.assert_called_once_with(q='project_id_s:%s' % project_id)
+
+        # nothing indexed in the tool, as far as we know
+        solr.reset_mock()
+        index_tasks.solr_del_tool(project_id, 'nothing', None)
+        solr.delete.assert_called_once_with(
+            q='project_id_s:"%s" AND mount_point_s:"nothing"' % project_id)
+        assert not solr.delete_ids.called
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_del_artifacts_invalidates_shortlink_cache(self, solr):
+        artifacts = [_TestArtifact(_shorthand_id='ts_%s' % x)
+                     for x in range(2)]
+        M.artifact_orm_session.flush()
+        arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
+        ref_ids = [r._id for r in arefs]
+        M.artifact_orm_session.flush()
+        cache = ShortlinkCache()
+        for link in ('ts_0', 'ts_1', 'other'):
+            cache.set(c.project._id, link, [])
+        with mock.patch.object(g, 'shortlink_cache', cache):
+            index_tasks.del_artifacts(ref_ids[:1])
+        assert_equal(cache.get(c.project._id, 'ts_0'), None)
+        assert_equal(cache.get(c.project._id, 'ts_1'), ())
+        assert_equal(cache.get(c.project._id, 'other'), ())
+
+    @td.with_wiki
+    @mock.patch('allura.lib.search.invalidate_search_cache')
+    @mock.patch('allura.tasks.index_tasks.g')
+    def test_artifacts_invalidate_search_cache(self, g, invalidate):
+        artifacts = [_TestArtifact(_shorthand_id='tc_%s' % x)
+                     for x in range(2)]
+        M.artifact_orm_session.flush()
+        arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
+        ref_ids = [r._id for r in arefs]
+        M.artifact_orm_session.flush()
+        project_id, mount_point = c.project._id, c.app.config.options.mount_point
+        index_tasks.add_artifacts(ref_ids)
+        invalidate.assert_called_once_with(str(project_id), mount_point)
+        invalidate.reset_mock()
+        index_tasks.del_artifacts(ref_ids)
+        invalidate.assert_called_once_with(project_id, mount_point)
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_add_artifacts_skips_unchanged(self, solr):
+        artifacts = [_TestArtifact(_shorthand_id='tf_%s' % x)
+                     for x in range(3)]
+        M.artifact_orm_session.flush()
+        arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
+        ref_ids = [r._id for r in arefs]
+        M.artifact_orm_session.flush()
+        index_tasks.add_artifacts(ref_ids)
+        M.main_orm_session.flush()
+        M.main_orm_session.clear()
+        assert_equal(len(solr.add.call_args[0][0]), 3)
+        assert all(r.index_fingerprint for r in M.ArtifactReference.query.find(
+            dict(_id={'$in': ref_ids})))
+
+        # not sent again, but links to artifacts created since are recorded
+        link = mock.Mock(ref_id='new-ref')
+        with mock.patch('allura.lib.search.find_shortlinks', return_value=[link]):
+            index_tasks.add_artifacts(ref_ids)
+        assert_equal(solr.add.call_count, 1)
+        M.main_orm_session.flush()
+        M.main_orm_session.clear()
+        assert all(r.references == ['new-ref'] for r in M.ArtifactReference.query.find(
+            dict(_id={'$in': ref_ids})))
+
+        a = _TestArtifact.query.get(_shorthand_id='tf_1')
+        a.text = 'changed'
+        M.artifact_orm_session.flush()
+        index_tasks.add_artifacts(ref_ids)
+        assert_equal([d['id'] for d in solr.add.call_args[0][0]], [ref_ids[1]])
+
+        M.main_orm_session.flush()
+        index_tasks.add_artifacts(ref_ids, force=True)
+        assert_equal(len(solr.add.call_args[0][0]), 3)
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_add_artifacts_updates_hot_fields(self, solr):
+        artifacts = [_TestArtifact(_shorthand_id='th_%s' % x)
+                     for x in range(2)]
+        M.artifact_orm_session.flush()
+        arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
+        ref_ids = [r._id for r in arefs]
+        M.artifact_orm_session.flush()
+        M.main_orm_session.flush()
+        M.artifact_orm_session.clear()
+        M.main_orm_session.clear()
+        index_tasks.add_artifacts(ref_ids)
+        M.main_orm_session.flush()
+        solr.reset_mock()
+
+        # a direct update, since a flush would set mod_date to now.  The refs
+        # must load the changed artifact again
+        _TestArtifact.query.update({'_shorthand_id': 'th_0'},
+                                   {'$set': {'mod_date': datetime(2015, 1, 1)}})
+        M.artifact_orm_session.clear()
+        M.main_orm_session.clear()
+        index_tasks.add_artifacts(ref_ids)
+        assert not solr.add.called
+        solr.update_fields.assert_called_once_with(
+            [dict(id=ref_ids[0], mod_date_dt=datetime(2015, 1, 1))])
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_drain_index_queue(self, solr):
+        M.IndexQueue.query.remove()
+        artifacts = [_TestArtifact(_shorthand_id='tq_%s' % x)
+                     for x in range(3)]
+        M.artifact_orm_session.flush()
+        arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
+        ref_ids = [r._id for r in arefs]
+        M.artifact_orm_session.flush()
+        M.MonQTask.query.remove()
+        index_tasks.queue_artifacts(ref_ids[:2])
+        # edited again before being indexed
+        index_tasks.queue_artifacts(ref_ids)
+        assert_equal(M.IndexQueue.count(), 3)
+        tasks = M.MonQTask.query.find().all()
+        assert_equal(len(tasks), 1)
+        assert_equal(tasks[0].task_name, 'allura.tasks.index_tasks.drain_index_queue')
+
+        index_tasks.drain_index_queue()
+        assert_equal(solr.add.call_count, 1)
+        assert_equal(sorted(doc['id'] for doc in solr.add.call_args[0][0]),
+                     sorted(ref_ids))
+        assert_equal(solr.add.call_args[1],
+                     dict(commit=False, commitWithin=10000))
+        assert_equal(M.IndexQueue.count(), 0)
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_drain_index_queue_errors(self, solr):
+        M.IndexQueue.query.remove()
+        artifacts = [_TestArtifact(_shorthand_id='tq_%s' % x)
+                     for x in range(3)]
+        M.artifact_orm_session.flush()
+        arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
+        ref_ids = [r._id for r in arefs]
+        M.artifact_orm_session.flush()
+        index_tasks.queue_artifacts(ref_ids)
+
+        # an artifact that can't be indexed stays queued, the rest don't
+        index = _TestArtifact.index
+
+        def broken_index(self):
+            if self._shorthand_id == 'tq_1':
+                raise ValueError('broken')
+            return index(self)
+        with mock.patch.object(_TestArtifact, 'index', broken_index):
+            index_tasks.drain_index_queue()
+        assert_equal(solr.add.call_count, 1)
+        assert_equal(len(solr.add.call_args[0][0]), 2)
+        assert_equal(M.IndexQueue.pending(datetime.utcnow(), 10), [ref_ids[1]])
+
+        # if the batch can't be sent, it all stays queued
+        solr.add.side_effect = TypeError
+        with self.assertRaises(TypeError):
+            index_tasks.drain_index_queue()
+        assert_equal(M.IndexQueue.count(), 1)
 
 
 class TestMailTasks(unittest.TestCase):
@@ -486,6 +676,43 @@ def test_delivers_messages(self):
                 assert fire_ready.called_with()
 
 
+class TestMarkdownTasks(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+        setup_global_objects()
+        self.md = mock.Mock(
+            render_cache=M.MarkdownRenderCache(maxsize=10, shared_size=10),
+            cache_bugfix_rev=3)
+        self.md.plain_text.return_value = u'<pre>*hi*</pre>'
+        self.watchdog = self.md.render_watchdog
+        self.watchdog.background_timeout = 120
+
+    def tearDown(self):
+        M.markdown_cache.RenderedMarkdownDoc.m.remove({})
+
+    def test_render_markdown(self):
+        self.watchdog.convert.return_value = u'<p><em>hi</em></p>'
+        with mock.patch.object(g, 'markdown_flavor', return_value=self.md):
+            markdown_tasks.render_markdown('forge', {}, u'*hi*')
+            self.watchdog.convert.assert_called_once_with(
+                'forge', {}, u'*hi*', timeout=120)
+            key = self.md.render_cache.key(u'*hi*', 'forge', 3)
+            assert_equal(M.RenderedMarkdown.get(key), u'<p><em>hi</em></p>')
+            # already rendered
+            markdown_tasks.render_markdown('forge', {}, u'*hi*')
+            assert_equal(self.watchdog.convert.call_count, 1)
+
+    def test_render_markdown_timeout(self):
+        self.watchdog.convert.side_effect = MarkdownRenderTimeout
+        with mock.patch.object(g, 'markdown_flavor', return_value=self.md):
+            markdown_tasks.render_markdown('forge', {}, u'*hi*')
+        key = self.md.render_cache.key(u'*hi*', 'forge', 3)
+        html = M.RenderedMarkdown.get(key)
+        assert_equal(html, u'<pre>*hi*</pre>')
+        assert isinstance(html, M.PlainTextFallback), type(html)
+
+
 @event_handler('my_event')
 def _my_event(event_type, testcase, *args, **kwargs):
     testcase.called_with.append((args, kwargs))
@@ -196,6 +196,66 @@ def test_everything(self):
         assert d == utils.CaseInsensitiveDict(Foo=1, bar=2)
 
 
+class TestLRUCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = utils.LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert_equal(cache.get('a'), 1)
+        cache.set('c', 3)  # evicts b, the least recently used
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('c'), 3)
+        assert_equal(len(cache), 2)
+        assert_equal((cache.hits, cache.misses), (2, 1))
+        assert_equal(cache.pop('a'), 1)
+        assert_equal(cache.get('a', 'missing'), 'missing')
+        cache.set(('x', 1), 1)
+        cache.discard_where(lambda key: key[0] == 'x')
+        assert_equal(len(cache), 1)
+        cache.clear()
+        assert_equal(len(cache), 0)
+
+    @patch('allura.lib.utils.time')
+    def test_ttl(self, time):
+        cache = utils.LRUCache(ttl=5)
+        time.time.return_value = 100
+        cache.set('a', 1)
+        time.time.return_value = 104
+        assert_equal(cache.get('a'), 1)
+        time.time.return_value = 106
+        assert_equal(cache.get('a'), None)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    @patch('allura.lib.utils.time')
+    def test_breaker(self, time):
+        time.time.return_value = 100
+        breaker = utils.CircuitBreaker('test', max_failures=2, window=10, slow=1,
+                                       reset_timeout=30)
+        breaker.record(0.1, failed=True)
+        time.time.return_value = 111
+        breaker.record(0.1)
+        breaker.record(2)  # too slow, but the first failure was too long ago
+        assert breaker.allow()
+        breaker.record(0.1, failed=True)
+        assert breaker.is_open
+        assert not breaker.allow()
+
+        # one trial call after reset_timeout
+        time.time.return_value = 142
+        assert breaker.allow()
+        assert not breaker.allow()
+        breaker.record(0.1, failed=True)
+        assert not breaker.allow()
+        time.time.return_value = 173
+        assert breaker.allow()
+        breaker.record(0.1)
+        assert not breaker.is_open
+        assert breaker.allow()
+
+
 class TestLineAnchorCodeHtmlFormatter(unittest.TestCase):
 
     def test_render(self):
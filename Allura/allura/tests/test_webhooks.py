@@ -517,9 +517,8 @@ def test_send(self, send_webhook):
         sender.get_payload = Mock()
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        send_webhook.post.assert_called_once_with(
-            self.wh._id,
-            sender.get_payload.return_value)
+        send_webhook.post_many.assert_called_once_with(
+            [((self.wh._id, sender.get_payload.return_value), {})])
 
     @patch('allura.webhooks.send_webhook', autospec=True)
     def test_send_with_list(self, send_webhook):
@@ -528,9 +527,8 @@ def test_send_with_list(self, send_webhook):
         self.wh.enforce_limit = Mock(return_value=True)
         with h.push_config(c, app=self.git):
             sender.send([dict(arg1=1, arg2=2), dict(arg1=3, arg2=4)])
-        assert_equal(send_webhook.post.call_count, 2)
-        assert_equal(send_webhook.post.call_args_list,
-                     [call(self.wh._id, 1), call(self.wh._id, 2)])
+        send_webhook.post_many.assert_called_once_with(
+            [((self.wh._id, 1), {}), ((self.wh._id, 2), {})])
         assert_equal(self.wh.enforce_limit.call_count, 1)
 
     @patch('allura.webhooks.log', autospec=True)
@@ -541,7 +539,7 @@ def test_send_limit_reached(self, send_webhook, log):
         self.wh.enforce_limit = Mock(return_value=False)
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        assert_equal(send_webhook.post.call_count, 0)
+        assert_equal(send_webhook.post_many.call_count, 0)
         log.warn.assert_called_once_with(
             'Webhook fires too often: %s. Skipping', self.wh)
 
@@ -15,7 +15,6 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
-import pymongo
 import mock
 
 from unittest import TestCase
@@ -140,6 +139,17 @@ def test_flush_skips_update(self, index_tasks, ref_fa, shortlink_fa):
         self.extension.after_flush()
         index_tasks.add_artifacts.post.assert_called_once_with([0, 2, 3])
 
+    @mock.patch.object(allura.model.index.Shortlink, 'from_artifact')
+    @mock.patch.object(allura.model.index.ArtifactReference, 'from_artifact')
+    @mock.patch('allura.model.session.index_tasks')
+    def test_flush_queues_artifacts(self, index_tasks, ref_fa, shortlink_fa):
+        ref_fa.side_effect = lambda obj: mock.Mock(_id=obj._id)
+        self.extension.objects_modified = [self._mock_indexable(_id=i) for i in range(3)]
+        with mock.patch.dict('allura.model.session.config', {'solr.index_queue': 'true'}):
+            self.extension.after_flush()
+        index_tasks.queue_artifacts.assert_called_once_with([0, 1, 2])
+        assert index_tasks.add_artifacts.post.call_count == 0
+
     @mock.patch('allura.model.session.index_tasks')
     def test_flush_skips_task_if_all_objects_filtered_out(self, index_tasks):
         modified = [self._mock_indexable(_id=i) for i in range(5)]
@@ -219,36 +229,3 @@ def test_flush_noop(self, index_tasks):
         self.assertEqual(0, index_tasks.add_artifacts.post.call_count)
         self.assertEqual(self.ext.to_delete, set())
         self.assertEqual(self.ext.to_add, set())
-
-    @mock.patch('allura.tasks.index_tasks')
-    def test__post_too_large(self, index_tasks):
-        def on_post(chunk):
-            if len(chunk) > 1:
-                e = pymongo.errors.InvalidDocument(
-                    "BSON document too large (16906035 bytes) - the connected server supports BSON document sizes up to 16777216 bytes.")
-                # ming injects a 2nd arg with the document, so we do too
-                e.args = e.args + ("doc:  {'task_name': 'allura.tasks.index_tasks.add_artifacts', ........",)
-                raise e
-        index_tasks.add_artifacts.post.side_effect = on_post
-        self.ext._post(index_tasks.add_artifacts, range(5))
-        expected = [
-            mock.call([0, 1, 2, 3, 4]),
-            mock.call([0, 1]),
-            mock.call([0]),
-            mock.call([1]),
-            mock.call([2, 3, 4]),
-            mock.call([2]),
-            mock.call([3, 4]),
-            mock.call([3]),
-            mock.call([4])
-        ]
-        self.assertEqual(
-            expected, index_tasks.add_artifacts.post.call_args_list)
-
-    @mock.patch('allura.tasks.index_tasks')
-    def test__post_other_error(self, index_tasks):
-        def on_post(chunk):
-            raise pymongo.errors.InvalidDocument("Cannot encode object...")
-        index_tasks.add_artifacts.post.side_effect = on_post
-        with td.raises(pymongo.errors.InvalidDocument):
-            self.ext._post(index_tasks.add_artifacts, range(5))
@@ -16,16 +16,24 @@
 #       under the License.
 
 import unittest
+import hashlib
+from datetime import datetime
 
 import mock
 from nose.tools import assert_equal
 from markupsafe import Markup
+from pysolr import SolrError
 
 from allura.lib import helpers as h
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test
-from allura.lib.solr import Solr, escape_solr_arg
-from allura.lib.search import search_app, SearchIndexable
+from allura.lib.solr import Solr, SolrPushError, escape_solr_arg
+from allura.lib.search import (search, search_app, SearchIndexable, index_fingerprint,
+                                only_hot_fields_changed,
+                                index_fields, invalidate_index_fields,
+                                SearchResultCache, MemcachedSearchResultCache,
+                                SearchError, SearchUnavailable)
+from allura.lib.utils import CircuitBreaker
 
 
 class TestSolr(unittest.TestCase):
@@ -58,6 +66,15 @@ def test_add(self, pysolr):
                            commitWithin='10000', somekw='value')] * 2
         pysolr.Solr().add.assert_has_calls(calls)
 
+    @mock.patch('allura.lib.solr.pysolr.Solr._update')
+    def test_add_commit_within(self, _update):
+        # through pysolr's own message building, which needs a string
+        solr = Solr(['server1'], commit=False)
+        solr.add([dict(id='a')], commitWithin=10000)
+        _update.assert_called_once_with(
+            '<add commitWithin="10000"><doc><field name="id">a</field></doc></add>',
+            commit=False, waitFlush=None, waitSearcher=None)
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_delete(self, pysolr):
         servers = ['server1', 'server2']
@@ -70,6 +87,40 @@ def test_delete(self, pysolr):
         calls = [mock.call('bar', commit=False, somekw='value')] * 2
         pysolr.Solr().delete.assert_has_calls(calls)
 
+    @mock.patch('allura.lib.solr.pysolr.Solr')
+    def test_update_fields(self, pysolr_Solr):
+        server = pysolr_Solr.return_value
+        server._from_python.side_effect = unicode
+        solr = Solr(['server1'], commit=False, commitWithin='10000')
+        solr.update_fields([dict(id='a&b', status_s='closed', labels_s=['x', 'y'],
+                                 milestone_s=None)])
+        server._update.assert_called_once_with(
+            '<add commitWithin="10000"><doc><field name="id">a&amp;b</field>'
+            '<field name="labels_s" update="set">x</field>'
+            '<field name="labels_s" update="set">y</field>'
+            '<field name="milestone_s" null="true" update="set" />'
+            '<field name="status_s" update="set">closed</field></doc></add>',
+            commit=False)
+
+    @mock.patch('allura.lib.solr.pysolr.Solr')
+    def test_delete_ids(self, pysolr_Solr):
+        servers = [mock.Mock(url='server1'), mock.Mock(url='server2')]
+        pysolr_Solr.side_effect = servers
+        solr = Solr(['server1', 'server2'], commit=True)
+        solr.delete_ids(['a', 'b<', 'c'], chunk_size=2)
+        for server in servers:
+            assert_equal(sorted(server._update.call_args_list), [
+                mock.call('<delete><id>a</id><id>b&lt;</id></delete>', commit=False),
+                mock.call('<delete><id>c</id></delete>', commit=False)])
+            server.commit.assert_called_once_with()
+
+        servers[0]._update.side_effect = ValueError('bad')
+        servers[1].reset_mock()
+        with td.raises(SolrPushError) as e:
+            solr.delete_ids(['a'])
+        assert_equal(e.exc.errors.keys(), ['server1'])
+        servers[1].commit.assert_called_once_with()
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_commit(self, pysolr):
         servers = ['server1', 'server2']
@@ -81,6 +132,23 @@ def test_commit(self, pysolr):
         calls = [mock.call('arg', kw='kw')] * 2
         pysolr.Solr().commit.assert_has_calls(calls)
 
+    @mock.patch('allura.lib.solr.pysolr.Solr')
+    def test_push_errors(self, pysolr_Solr):
+        servers = [mock.Mock(url='server1'), mock.Mock(url='server2')]
+        servers[0].add.side_effect = IOError('down')
+        servers[1].add.return_value = 'ok'
+        pysolr_Solr.side_effect = servers
+        solr = Solr(['server1', 'server2'])
+        with td.raises(SolrPushError) as e:
+            solr.add('foo')
+        # the other server was still updated
+        servers[1].add.assert_called_once_with('foo', commit=True)
+        assert_equal(e.exc.errors.keys(), ['server1'])
+
+        servers[0].add.side_effect = None
+        servers[0].add.return_value = 'ok'
+        assert_equal(solr.add('foo'), ['ok', 'ok'])
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_search(self, pysolr):
         servers = ['server1', 'server2']
@@ -116,6 +184,171 @@ def test_site_admin_search(self, search):
         search.assert_called_once_with(
             'username_s:admin1 || username_s:root', fq=fq, ignore_errors=False)
 
+    def test_index_fields(self):
+        atype = mock.Mock()
+        atype.index_fields_key.return_value = None
+        sample = atype.query.find.return_value.first
+        sample.return_value.index.return_value = dict(type_s='Thing', title='t')
+        assert_equal(index_fields(atype, 'app1'), dict(type_s='Thing', title=None))
+        atype.query.find.assert_called_once_with(dict(app_config_id='app1'))
+        # cached
+        assert_equal(index_fields(atype, 'app1'), dict(type_s='Thing', title=None))
+        assert_equal(atype.query.find.call_count, 1)
+        # per app
+        index_fields(atype, 'app2')
+        assert_equal(atype.query.find.call_count, 2)
+        # invalidated by the class's key
+        atype.index_fields_key.return_value = 'changed'
+        index_fields(atype, 'app1')
+        assert_equal(atype.query.find.call_count, 3)
+        atype.index_fields_key.assert_called_with('app1')
+        # and explicitly
+        invalidate_index_fields(atype, 'app1')
+        index_fields(atype, 'app1')
+        assert_equal(atype.query.find.call_count, 4)
+        index_fields(atype, 'app1')
+        assert_equal(atype.query.find.call_count, 4)
+        # nothing to sample isn't cached
+        sample.return_value = None
+        assert_equal(index_fields(atype, 'app3'), None)
+        assert_equal(index_fields(atype, 'app3'), None)
+        assert_equal(atype.query.find.call_count, 6)
+
+
+class FakeMemcache(dict):
+
+    def get_multi(self, keys):
+        return dict((k, self[k]) for k in keys if k in self)
+
+    def set(self, key, value, time=0):
+        self[key] = value
+
+    def add(self, key, value):
+        if key in self:
+            return False
+        self[key] = value
+        return True
+
+    def incr(self, key):
+        self[key] += 1
+
+
+class TestSearchResultCache(unittest.TestCase):
+
+    def test_key(self):
+        key = SearchResultCache.key
+        assert_equal(key('foo', False, dict(fq=['b', 'a'], rows=10)),
+                     key('foo', False, dict(rows=10, fq=['a', 'b'])))
+        assert key('foo', False, {}) != key('foo', True, {})
+        assert key('foo', False, dict(rows=10)) != key('foo', False, dict(rows=20))
+        fq = ['project_id_s:123abc', 'mount_point_s:bugs', 'type_s:Ticket']
+        assert_equal(key('foo', False, dict(fq=fq))[:2], ('123abc', 'bugs'))
+        assert_equal(key('project_id_s:"123abc"', False, {})[:2], ('123abc', None))
+        assert_equal(key('foo', False, dict(fq=['project_id_s:(1 OR 2)']))[:2],
+                     (None, None))
+
+    @mock.patch('allura.lib.search.c')
+    @mock.patch('allura.lib.search.g')
+    def test_search(self, g, c):
+        g.search_cache = SearchResultCache(ttl=60)
+        g.solr.search.return_value = [dict(id='1')]
+        fq = ['project_id_s:123abc', 'mount_point_s:bugs']
+        assert_equal(search('foo', fq=fq), [dict(id='1')])
+        # returns a copy
+        search('foo', fq=fq)[0]['id'] = '2'
+        assert_equal(search('foo', fq=fq), [dict(id='1')])
+        assert_equal(g.solr.search.call_count, 1)
+        search('foo', fq=fq, rows=5)
+        assert_equal(g.solr.search.call_count, 2)
+
+        g.search_cache.invalidate('123abc', 'wiki')
+        search('foo', fq=fq)
+        assert_equal(g.solr.search.call_count, 2)
+        g.search_cache.invalidate('123abc', 'bugs')
+        search('foo', fq=fq)
+        assert_equal(g.solr.search.call_count, 3)
+        g.search_cache.invalidate('123abc')
+        search('foo', fq=fq)
+        assert_equal(g.solr.search.call_count, 4)
+
+    def test_memcached_not_installed(self):
+        config = {'solr.result_cache.ttl': '5',
+                  'solr.result_cache.memcached_host': 'localhost:11211'}
+        with mock.patch.dict('sys.modules', pylibmc=None):
+            with td.raises(Exception) as e:
+                SearchResultCache.from_config(config)
+        assert 'pip install pylibmc' in str(e.exc)
+
+    def test_memcached(self):
+        client = FakeMemcache()
+        cache = MemcachedSearchResultCache(5, client)
+        tool_key = SearchResultCache.key('foo', False, dict(
+            fq=['project_id_s:123abc', 'mount_point_s:bugs']))
+        project_key = SearchResultCache.key('project_id_s:123abc', False, {})
+        site_key = SearchResultCache.key('foo', False, {})
+        for key in (tool_key, project_key, site_key):
+            assert_equal(cache.get(key), None)
+            cache.set(key, ['result'])
+            assert_equal(cache.get(key), ['result'])
+
+        # from another process
+        cache = MemcachedSearchResultCache(5, client)
+        cache.invalidate('123abc', 'wiki')
+        assert_equal(cache.get(tool_key), ['result'])
+        assert_equal(cache.get(project_key), None)
+        assert_equal(cache.get(site_key), ['result'])
+        cache.set(project_key, ['result'])
+        cache.invalidate('123abc')
+        assert_equal(cache.get(tool_key), None)
+        assert_equal(cache.get(project_key), None)
+        assert_equal(cache.get(site_key), ['result'])
+
+
+class TestSearchCircuitBreaker(unittest.TestCase):
+
+    @mock.patch('allura.lib.search.c')
+    @mock.patch('allura.lib.search.g')
+    def test_search(self, g, c):
+        g.search_cache = None
+        g.search_breaker = CircuitBreaker('solr', max_failures=2)
+        g.solr.search.side_effect = SolrError('[Reason: org.apache.solr.search.SyntaxError: bad]')
+        with td.raises(SearchError) as e:
+            search('foo:', ignore_errors=False)
+        assert not isinstance(e.exc, SearchUnavailable)
+        search('foo:')
+        assert not g.search_breaker.is_open
+
+        g.solr.search.side_effect = SolrError('Failed to connect to server')
+        with td.raises(SearchUnavailable):
+            search('foo', ignore_errors=False)
+        assert_equal(search('foo'), None)
+        assert g.search_breaker.is_open
+        # fails fast now
+        g.solr.search.reset_mock()
+        with td.raises(SearchUnavailable):
+            search('foo', ignore_errors=False)
+        assert_equal(search('foo'), None)
+        assert not g.solr.search.called
+
+    @mock.patch('allura.lib.search.c')
+    @mock.patch('allura.lib.search.g')
+    def test_trial_unexpected_error(self, g, c):
+        g.search_cache = None
+        g.search_breaker = breaker = CircuitBreaker('solr', max_failures=1, reset_timeout=0)
+        g.solr.search.side_effect = SolrError('Failed to connect to server')
+        search('foo')
+        assert breaker.is_open
+        # the trial call fails in some other way: the breaker opens again,
+        # rather than waiting for the trial's outcome forever
+        g.solr.search.side_effect = ValueError('Unable to find the server')
+        with td.raises(ValueError):
+            search('foo')
+        assert breaker.is_open
+        g.solr.search.side_effect = None
+        g.solr.search.return_value = ['result']
+        assert_equal(search('foo'), ['result'])
+        assert not breaker.is_open
+
 
 class TestSearchIndexable(unittest.TestCase):
 
@@ -140,6 +373,45 @@ def test_solarize_html_in_text(self):
         self.obj.index = lambda: dict(text='&lt;script&gt;a(1)&lt;/script&gt;')
         assert_equal(self.obj.solarize(), dict(text='<script>a(1)</script>'))
 
+    def test_solarize_uses_markdown_cache(self):
+        self.obj.index = lambda: dict(text='# Header')
+        self.obj.text_cache = mock.Mock(
+            md5=hashlib.md5('# Header').hexdigest(), fix7528=3,
+            html='<h1>Cached header</h1>')
+        assert_equal(self.obj.solarize(), dict(text='Cached header'))
+        self.obj.text_cache.md5 = 'stale'
+        assert_equal(self.obj.solarize(), dict(text='Header'))
+
+    def test_solarize_precomputed_doc(self):
+        self.obj.index = mock.Mock()
+        doc = dict(text='# Header')
+        assert_equal(self.obj.solarize(doc), dict(text='Header'))
+        assert_equal(doc, dict(text='# Header'))
+        assert not self.obj.index.called
+
+    def test_index_fingerprint(self):
+        doc = dict(id='a', text=u'caf\xe9', mod_date_dt=datetime(2015, 1, 1))
+        assert_equal(index_fingerprint(doc), index_fingerprint(dict(doc)))
+        assert_equal(len(index_fingerprint(doc)), 32)
+        assert index_fingerprint(doc) != index_fingerprint(dict(doc, text='cafe'))
+        assert_equal(index_fingerprint(None), None)
+
+    def test_index_fingerprint_hot_fields(self):
+        doc = dict(id='a', text='text', status_s='open')
+        hot = ['status_s', 'votes_i']
+        fp = index_fingerprint(doc, hot)
+        assert_equal(len(fp), 65)
+        assert not only_hot_fields_changed(fp, fp)
+        assert only_hot_fields_changed(
+            index_fingerprint(dict(doc, status_s='closed'), hot), fp)
+        assert only_hot_fields_changed(
+            index_fingerprint(dict(doc, votes_i=1), hot), fp)
+        assert not only_hot_fields_changed(
+            index_fingerprint(dict(doc, text='new', status_s='closed'), hot), fp)
+        # old-style fingerprints
+        assert not only_hot_fields_changed(fp, index_fingerprint(doc))
+        assert not only_hot_fields_changed(fp, None)
+
 
 class TestSearch_app(unittest.TestCase):
 
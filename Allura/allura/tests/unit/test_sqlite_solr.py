@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from nose.tools import assert_equal, assert_raises
+from pysolr import SolrError
+
+from allura.lib.solr import make_solr_from_config
+from allura.lib.sqlite_solr import SQLiteSolr, QueryParser, MUST, SHOULD, MUST_NOT
+
+
+class TestQueryParser(unittest.TestCase):
+
+    def test_parse(self):
+        parse = QueryParser().parse
+        assert_equal(parse('*:*'), ('all',))
+        assert_equal(parse('foo'), ('term', 'text', 'foo', 'term'))
+        assert_equal(parse('status_s:open'), ('term', 'status_s', 'open', 'term'))
+        assert_equal(parse('title:"a b"^2'), ('term', 'title', 'a b', 'phrase'))
+        assert_equal(parse(r'summary_t:a\:b*'), ('term', 'summary_t', 'a:b', 'prefix'))
+        assert_equal(parse('num_i:{1 TO *]'), ('range', 'num_i', '1', None, False, True))
+        assert_equal(parse('a AND b OR c'), ('bool', [
+            (MUST, ('term', 'text', 'a', 'term')),
+            (MUST, ('term', 'text', 'b', 'term')),
+            (SHOULD, ('term', 'text', 'c', 'term'))]))
+        assert_equal(parse('!a && -b NOT c'), ('bool', [
+            (MUST_NOT, ('term', 'text', 'a', 'term')),
+            (MUST_NOT, ('term', 'text', 'b', 'term')),
+            (MUST_NOT, ('term', 'text', 'c', 'term'))]))
+        assert_equal(parse('type_s:("A" OR "B")'), ('bool', [
+            (SHOULD, ('term', 'type_s', 'A', 'phrase')),
+            (SHOULD, ('term', 'type_s', 'B', 'phrase'))]))
+        with assert_raises(SolrError):
+            parse('foo:(bar')
+
+    def test_parse_dismax(self):
+        parse = QueryParser(['title', 'text'], required=True).parse
+        assert_equal(parse('a'), ('bool', [
+            (SHOULD, ('term', 'title', 'a', 'term')),
+            (SHOULD, ('term', 'text', 'a', 'term'))]))
+        assert_equal(parse('a b')[1][1][0], MUST)
+
+
+class TestSQLiteSolr(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.solr = make_solr_from_config(['sqlite://' + os.path.join(self.tmpdir, 'index.db')])
+        self.solr.add([
+            dict(id='t1', type_s='Ticket', title='Ticket 1', text=u'The quick brown fox',
+                 status_s='open', labels_t='ui bug', ticket_num_i=1,
+                 mod_date_dt=datetime(2015, 1, 1), is_history_b=False),
+            dict(id='t2', type_s='Ticket', title='Ticket 2', text=u'A lazy dog in a café',
+                 status_s='closed', ticket_num_i=2,
+                 mod_date_dt=datetime(2015, 2, 1), is_history_b=False),
+            dict(id='w1', type_s='WikiPage', title='Fox', text=u'All about foxes',
+                 mod_date_dt=datetime(2015, 3, 1), is_history_b=True, deleted_b=True),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def ids(self, *args, **kw):
+        return [doc['id'] for doc in self.solr.search(*args, **kw)]
+
+    def test_make_solr_from_config(self):
+        assert isinstance(self.solr, SQLiteSolr)
+
+    def test_search(self):
+        assert_equal(self.ids('fox'), ['t1'])
+        assert_equal(self.ids('cafe'), ['t2'])
+        assert_equal(self.ids('fox*'), ['w1', 't1'])
+        assert_equal(self.ids('status_s:open'), ['t1'])
+        assert_equal(self.ids('!status_s:closed && type_s:Ticket'), ['t1'])
+        assert_equal(self.ids('labels_ws:bug'), ['t1'])
+        assert_equal(self.ids('ticket_num_i:[2 TO *]'), ['t2'])
+        assert_equal(self.ids('(-labels_t:[* TO *] AND *:*)'), ['t2', 'w1'])
+        assert_equal(self.ids('mod_date_dt:[* TO 2015-01-15T00:00:00Z]'), ['t1'])
+        assert_equal(self.ids('mod_date_dt:[NOW-1000DAYS TO NOW]'), [])
+        assert_equal(self.ids('*:*', fq=['type_s:("Ticket" OR "Post")', 'is_history_b:False']),
+                     ['t1', 't2'])
+        with assert_raises(SolrError):
+            self.solr.search('ticket_num_i:abc')
+
+    def test_paging_and_sort(self):
+        r = self.solr.search('*:*', sort='mod_date_dt desc', rows=2, start=1)
+        assert_equal(r.hits, 3)
+        assert_equal([d['id'] for d in r], ['t2', 't1'])
+        assert_equal(r.docs[0]['mod_date_dt'], datetime(2015, 2, 1))
+        assert_equal(self.ids('*:*', sort='ticket_num_i asc'), ['t1', 't2', 'w1'])
+        r = self.solr.search('status_s:open', fl='id,score')
+        assert_equal(r.docs, [dict(id='t1', score=0)])
+
+    def test_dismax_and_highlighting(self):
+        r = self.solr.search('fox', qt='dismax', qf='title^2 text', hl='true', **{
+            'hl.simple.pre': '[', 'hl.simple.post': ']'})
+        assert_equal([d['id'] for d in r], ['w1', 't1'])
+        assert_equal(r.highlighting, {
+            'w1': {'title': ['[Fox]']},
+            't1': {'text': ['The quick brown [fox]']}})
+        assert_equal(self.ids('fox', qt='dismax', qf='text'), ['t1'])
+
+    def test_facets(self):
+        r = self.solr.search(None, fq=['type_s:Ticket'], rows=0, facet='true', **{
+            'facet.field': ['status_s', 'ticket_num_i'], 'facet.sort': 'index'})
+        assert_equal(r.hits, 2)
+        assert_equal(r.docs, [])
+        assert_equal(r.facets['facet_fields'], {
+            'status_s': ['closed', 1, 'open', 1],
+            'ticket_num_i': [1, 1, 2, 1]})
+
+    def test_update_fields(self):
+        self.solr.update_fields([dict(id='t1', status_s='closed', labels_t=None),
+                                 dict(id='missing', status_s='closed')])
+        assert_equal(self.ids('status_s:closed'), ['t1', 't2'])
+        assert_equal(self.ids('labels_ws:bug'), [])
+        assert_equal(self.ids('fox'), ['t1'])
+        assert_equal(self.ids('*:*'), ['t1', 't2', 'w1'])
+
+    def test_add_replaces_and_delete(self):
+        self.solr.add([dict(id='t1', type_s='Ticket', text='replaced')])
+        assert_equal(self.ids('fox'), [])
+        assert_equal(self.ids('replaced'), ['t1'])
+        self.solr.delete(q='type_s:WikiPage')
+        assert_equal(self.ids('*:*'), ['t1', 't2'])
+        self.solr.delete(id='t1')
+        assert_equal(self.ids('*:*'), ['t2'])
@@ -423,13 +423,16 @@ def send(self, params_or_list):
         if webhooks:
             payloads = [self.get_payload(**params)
                         for params in params_or_list]
+            calls = []
             for webhook in webhooks:
                 if webhook.enforce_limit():
                     webhook.update_limit()
-                    for payload in payloads:
-                        send_webhook.post(webhook._id, payload)
+                    calls.extend(((webhook._id, payload), {})
+                                 for payload in payloads)
                 else:
                     log.warn('Webhook fires too often: %s. Skipping', webhook)
+            if calls:
+                send_webhook.post_many(calls)
 
     def enforce_limit(self, app):
         '''
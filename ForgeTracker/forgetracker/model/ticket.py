@@ -29,6 +29,7 @@
 from pprint import pformat
 from paste.deploy.converters import aslist, asbool
 import jinja2
+from pysolr import SolrError
 
 from ming import schema
 from ming.utils import LazyProperty
@@ -66,7 +67,8 @@
 from allura.model.types import MarkdownCache, EVERYONE
 
 from allura.lib import security
-from allura.lib.search import search_artifact, SearchError
+from allura.lib.search import (search_artifact, index_fields, inject_user,
+                               SearchError, SearchUnavailable)
 from allura.lib import utils
 from allura.lib import helpers as h
 from allura.lib.plugin import ImportIdConverter
@@ -80,6 +82,17 @@
 SOLR_TYPE_DEFAULTS = dict(_b=False, _i=0)
 
 
+# solr sort fields that Ticket.paged_query can sort by, see search_in_mongo
+SOLR_SORT_TO_MONGO = dict(
+    ticket_num_i='ticket_num',
+    snippet_s='summary',
+    status_s='status',
+    mod_date_dt='mod_date',
+    created_date_dt='created_date',
+    votes_up_i='votes_up',
+    votes_down_i='votes_down')
+
+
 def get_default_for_solr_type(solr_type):
     return SOLR_TYPE_DEFAULTS.get(solr_type, u'')
 
@@ -187,16 +200,25 @@ def get_custom_field_solr_type(self, field_name):
 
     def update_bin_counts(self):
         # Refresh bin counts
-        self._bin_counts_data = []
+        bin_counts_data = []
         for b in Bin.query.find(dict(
                 app_config_id=self.app_config_id)):
             if b.terms and '$USER' in b.terms:
                 # skip queries with $USER variable, hits will be inconsistent
                 # for them
                 continue
-            r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False)
+            try:
+                r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False)
+            except SearchUnavailable as e:
+                # keep the old counts, and try again in a minute
+                log.warning('Not updating bin counts: %s', e)
+                self._bin_counts_expire = \
+                    datetime.utcnow() + timedelta(minutes=1)
+                self._bin_counts_invalidated = None
+                return
             hits = r is not None and r.hits or 0
-            self._bin_counts_data.append(dict(summary=b.summary, hits=hits))
+            bin_counts_data.append(dict(summary=b.summary, hits=hits))
+        self._bin_counts_data = bin_counts_data
         self._bin_counts_expire = \
             datetime.utcnow() + timedelta(minutes=60)
         self._bin_counts_invalidated = None
@@ -710,7 +732,8 @@ def index(self):
 
         # Tracker uses search with default solr parser. It would match only on
         # `text`, so we're appending all other field values into `text`, to
-        # match on it too.
+        # match on it too.  (So any change of a field changes `text`, and
+        # tickets are always sent to solr whole, see add_artifacts.)
         result['text'] += pformat(result.values())
         return result
 
@@ -718,6 +741,14 @@ def index(self):
     def attachment_class(cls):
         return TicketAttachment
 
+    @classmethod
+    def index_fields_key(cls, app_config_id=None):
+        # custom fields are indexed too, so they change with the tracker config
+        globals = Globals.query.get(app_config_id=app_config_id) if app_config_id else None
+        if globals is None:
+            return None
+        return tuple((f.name, f.type) for f in globals.custom_fields or [])
+
     @classmethod
     def translate_query(cls, q, fields):
         q = super(Ticket, cls).translate_query(q, fields)
@@ -1223,6 +1254,14 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
             else:
                 matches = None
             solr_error = None
+        except SearchUnavailable as e:
+            result = cls.search_in_mongo(app_config, user, q, limit=limit, page=page,
+                                         sort=sort, show_deleted=show_deleted,
+                                         filter=filter, **kw)
+            if result is not None:
+                return result
+            solr_error = e
+            matches = None
         except SearchError as e:
             solr_error = e
             matches = None
@@ -1254,6 +1293,104 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
                     filter_choices=tsearch.get_facets(matches),
                     solr_error=solr_error, **kw)
 
+    @classmethod
+    def search_in_mongo(cls, app_config, user, q, limit=None, page=0, sort=None,
+                        show_deleted=False, filter=None, **kw):
+        """Do a :meth:`paged_search` with :meth:`paged_query` instead, for
+        when solr is unavailable.
+
+        Only works for queries which just match ticket fields (e.g.
+        ``status:open && !assigned_to:$USER``); returns None for others.
+        The results don't include facets for the filter options.
+        """
+        mongo_query = cls.mongo_query_for_search(app_config, user, q, filter)
+        if mongo_query is None:
+            return None
+        log.info('Solr unavailable, searching tickets in mongo: %s', mongo_query)
+        mongo_sort = None
+        if sort:
+            field, direction = sort.split(',')[0].split()
+            if field.startswith('_'):
+                mongo_sort = '%s %s' % (field.rsplit('_', 1)[0], direction)
+            elif field in SOLR_SORT_TO_MONGO:
+                mongo_sort = '%s %s' % (SOLR_SORT_TO_MONGO[field], direction)
+        deleted = kw.pop('deleted', False)
+        if show_deleted and security.has_access(
+                app_config, 'delete', user, app_config.project.root_project):
+            deleted = {'$in': [False, True]}
+        result = cls.paged_query(app_config, user, mongo_query, limit=limit,
+                                 page=page, sort=mongo_sort, deleted=deleted)
+        return dict(result, q=q, sort=sort, filter=filter or {},
+                    filter_choices={}, solr_error=None, **kw)
+
+    @classmethod
+    def mongo_query_for_search(cls, app_config, user, q, filter=None):
+        """Translate the solr query ``q`` and ``filter`` of
+        :meth:`paged_search` to a mongo query, if they only match ticket
+        fields.  Returns None if they don't."""
+        from allura.lib.sqlite_solr import QueryParser, MUST, MUST_NOT
+        globals = Globals.query.get(app_config_id=app_config._id)
+
+        def field_query(name, value):
+            if name in ('status', 'labels'):
+                return {name: value}
+            if name == 'ticket_num':
+                return {name: int(value)} if value.isdigit() else None
+            if name in ('assigned_to', 'reported_by'):
+                u = User.by_username(value) if value else None
+                return {name + '_id': u._id if u else {'$in': []}}
+            if name.startswith('_') and globals and \
+                    globals.get_custom_field_solr_type(name) == '_s':
+                return {'custom_fields.' + name: value}
+            return None
+
+        def translate(node):
+            if node[0] == 'all':
+                return {}
+            if node[0] == 'term' and node[3] in ('term', 'phrase'):
+                return field_query(node[1], node[2])
+            if node[0] != 'bool':
+                return None
+            clauses = {MUST: [], MUST_NOT: []}
+            should = []
+            for occur, clause in node[1]:
+                query = translate(clause)
+                if query is None:
+                    return None
+                clauses.get(occur, should).append(query)
+            queries = clauses[MUST]
+            if should and not queries:
+                queries.append({'$or': should} if len(should) > 1 else should[0])
+            if clauses[MUST_NOT]:
+                queries.append({'$nor': clauses[MUST_NOT]})
+            if len(queries) == 1:
+                return queries[0]
+            return {'$and': queries} if queries else {}
+
+        try:
+            query = translate(QueryParser().parse(inject_user(q, user) or '*:*'))
+        except SolrError:
+            return None
+        if query is None:
+            return None
+        queries = [query] if query else []
+        for name, values in (filter or {}).iteritems():
+            options = []
+            for v in values:
+                if v == '' or v is None:
+                    # the field is empty, see search_artifact
+                    option = field_query(name, u'')
+                    options.append(option and dict.fromkeys(option, {'$in': [None, u'']}))
+                else:
+                    options.append(field_query(name, v))
+            if None in options:
+                return None
+            if options:
+                queries.append({'$or': options} if len(options) > 1 else options[0])
+        if len(queries) > 1:
+            return {'$and': queries}
+        return queries[0] if queries else {}
+
     @classmethod
     def paged_query_or_search(cls, app_config, user, query, search_query, filter,
                               limit=None, page=0, sort=None, **kw):
@@ -1270,9 +1407,9 @@ def paged_query_or_search(cls, app_config, user, query, search_query, filter,
             solr_sort = '%s %s' % (solr_col, sort_split[1])
         if not filter:
             result = cls.paged_query(app_config, user, query, sort=sort, limit=limit, page=page, **kw)
-            t = cls.query.find().first()
-            if t:
-                search_query = cls.translate_query(search_query, t.index())
+            fields = index_fields(cls, app_config._id)
+            if fields:
+                search_query = cls.translate_query(search_query, fields)
             result['filter_choices'] = tsearch.query_filter_choices(search_query)
         else:
             result = cls.paged_search(app_config, user, search_query, filter=filter,
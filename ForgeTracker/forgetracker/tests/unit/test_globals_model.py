@@ -26,6 +26,7 @@
 from forgetracker.model import Globals
 from forgetracker.tests.unit import TrackerTestWithModel
 from allura.lib import helpers as h
+from allura.lib.search import SearchUnavailable
 
 
 class TestGlobalsModel(TrackerTestWithModel):
@@ -119,6 +120,12 @@ def test_update_bin_counts(self, mock_dt, mock_search, mock_bin):
         assert_equal(gbl._bin_counts_expire, now + timedelta(minutes=60))
         assert_equal(gbl._bin_counts_invalidated, None)
 
+        # solr is down: keep the old counts for now
+        mock_search.side_effect = SearchUnavailable('down')
+        gbl.update_bin_counts()
+        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5}])
+        assert_equal(gbl._bin_counts_expire, now + timedelta(minutes=1))
+
     def test_append_new_labels(self):
         gbl = Globals()
         assert_equal(gbl.append_new_labels([], ['tag1']), ['tag1'])
@@ -241,6 +241,20 @@ def test_ticket_move(self):
         assert_equal(post.thread.app_config_id, app2.config._id)
         assert_equal(post.app_config_id, app2.config._id)
 
+    @td.with_tool('test', 'Tickets', 'bugs', username='test-user')
+    @td.with_tool('test', 'Tickets', 'bugs2', username='test-user')
+    def test_index_fields_key(self):
+        app1 = c.project.app_instance('bugs')
+        app2 = c.project.app_instance('bugs2')
+        app1.globals.custom_fields.append(
+            {'name': '_test', 'type': 'string', 'label': 'Test field'})
+        ThreadLocalORMSession.flush_all()
+        # of the given tracker, whatever the context
+        with h.push_context(c.project._id, app_config_id=app2.config._id):
+            assert_equal(Ticket.index_fields_key(app1.config._id), (('_test', 'string'),))
+            assert_equal(Ticket.index_fields_key(app2.config._id), ())
+        assert_equal(Ticket.index_fields_key(None), None)
+
     @td.with_tool('test', 'Tickets', 'bugs', username='test-user')
     @td.with_tool('test', 'Tickets', 'bugs2', username='test-user')
     def test_ticket_move_with_different_custom_fields(self):
@@ -358,6 +372,53 @@ def test_paged_query_or_search(self, query, search, tsearch):
         assert_equal(query.call_count, 0)
         assert_equal(tsearch.query_filter_choices.call_count, 0)
 
+    def test_mongo_query_for_search(self):
+        c.app.globals.custom_fields = [dict(name='_milestone', type='milestone'),
+                                       dict(name='_size', type='number')]
+        user = User.by_username('test-user')
+        q = lambda q, filter=None: Ticket.mongo_query_for_search(
+            c.app.config, user, q, filter)
+        assert_equal(q(None), {})
+        assert_equal(q('status:open'), {'status': 'open'})
+        assert_equal(q('!status:closed && !status:wont-fix'),
+                     {'$nor': [{'status': 'closed'}, {'status': 'wont-fix'}]})
+        assert_equal(q('ticket_num:1 OR ticket_num:2'),
+                     {'$or': [{'ticket_num': 1}, {'ticket_num': 2}]})
+        assert_equal(q('assigned_to:$USER AND _milestone:"1.0"'), {'$and': [
+            {'assigned_to_id': user._id}, {'custom_fields._milestone': '1.0'}]})
+        assert_equal(q('reported_by:nobody-such'), {'reported_by_id': {'$in': []}})
+        assert_equal(q('status:open', dict(_milestone=['1.0', ''])), {'$and': [
+            {'status': 'open'},
+            {'$or': [{'custom_fields._milestone': '1.0'},
+                     {'custom_fields._milestone': {'$in': [None, '']}}]}]})
+        # anything else needs solr
+        assert_equal(q('foo'), None)
+        assert_equal(q('summary:foo'), None)
+        assert_equal(q('_size:3'), None)
+        assert_equal(q('status:op*'), None)
+        assert_equal(q('ticket_num:[1 TO 5]'), None)
+        assert_equal(q('status:(open'), None)
+        assert_equal(q('*:*', dict(summary=['foo'])), None)
+
+    @mock.patch('forgetracker.model.ticket.search_artifact')
+    def test_paged_search_in_mongo(self, search_artifact):
+        from allura.lib.search import SearchUnavailable
+        search_artifact.side_effect = SearchUnavailable('down')
+        for n, status in enumerate(['open', 'closed', 'open']):
+            Ticket(ticket_num=n + 1, summary='t%s' % n, status=status)
+        ThreadLocalORMSession.flush_all()
+        result = Ticket.paged_search(c.app.config, c.user, 'status:open',
+                                     sort='ticket_num_i asc')
+        assert_equal([t.ticket_num for t in result['tickets']], [1, 3])
+        assert_equal(result['count'], 2)
+        assert_equal(result['q'], 'status:open')
+        assert_equal(result['solr_error'], None)
+        assert_equal(result['filter_choices'], {})
+
+        result = Ticket.paged_search(c.app.config, c.user, 'summary:t1')
+        assert_equal(result['tickets'], [])
+        assert_equal(str(result['solr_error']), 'down')
+
     def test_index(self):
         idx = Ticket(ticket_num=2, summary="ticket2", labels=["mylabel", "other"]).index()
         assert_equal(idx['summary_t'], 'ticket2')
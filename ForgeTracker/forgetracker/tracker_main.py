@@ -54,7 +54,7 @@
     AdminControllerMixin,
     ConfigOption,
 )
-from allura.lib.search import search_artifact, SearchError
+from allura.lib.search import search_artifact, invalidate_index_fields, SearchError
 from allura.lib.solr import escape_solr_arg
 from allura.lib.decorators import require_post
 from allura.lib.security import (require_access, has_access, require,
@@ -1795,6 +1795,7 @@ def set_custom_fields(self, **post_data):
                                 milestone['name']
 
         self.app.globals.custom_fields = custom_fields
+        invalidate_index_fields(TM.Ticket, self.app.config._id)
         flash('Fields updated')
         redirect(request.referer)
 
@@ -0,0 +1,59 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Replace the pickled classes in ArtifactReferences with the class names from
+:class:`allura.model.index.ArtifactClassRegistry`.
+
+References that haven't been migrated still load, so this can run while
+Allura is up.
+"""
+
+import sys
+import logging
+from cPickle import loads
+
+from allura import model as M
+from allura.model.index import artifact_classes
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    test = sys.argv[-1] == 'test'
+    coll = M.ArtifactReference._collection()
+    # there are only as many distinct pickles as artifact classes
+    pickles = coll.find({'artifact_reference.cls': {'$exists': True, '$ne': None}}).distinct('artifact_reference.cls')
+    for pickled in pickles:
+        try:
+            cls = loads(str(pickled))
+        except Exception:
+            log.exception('Skipping references to a class that fails to load: %r', pickled)
+            continue
+        name = artifact_classes.name(cls)
+        query = {'artifact_reference.cls': pickled}
+        if test:
+            log.info('Would set class name %s on %s references', name, coll.find(query).count())
+            continue
+        log.info('Setting class name %s', name)
+        coll.update(query,
+                    {'$set': {'artifact_reference.cls_name': name},
+                     '$unset': {'artifact_reference.cls': 1}},
+                    multi=True)
+
+if __name__ == '__main__':
+    main()